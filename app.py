@@ -4,18 +4,36 @@ import os
 import logging
 import requests
 import copy
+import hmac
+import threading
+import time
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from openai import AzureOpenAI
 from azure.identity import ChainedTokenCredential, ManagedIdentityCredential, AzureCliCredential, DefaultAzureCredential
 from base64 import b64encode
 from flask import Flask, Response, request, jsonify, send_from_directory, redirect, session, url_for
 from dotenv import load_dotenv
-from pydub import AudioSegment
-from pydub.utils import mediainfo
 
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbservice_async import AsyncCosmosConversationClient
+from backend.history.writebehind import WriteBehindHistoryWriter
+from backend.history.conversationcache import ConversationCache
+from backend.history.sqlitedbservice import SqliteConversationClient
+from backend.history.citationstore import CitationStore
+from backend.images.imagestore import ImageStore
+from backend.speech.audioconverter import AudioConverter, AudioLimitError
+from backend.aoai.deploymentpool import DeploymentPool, check_response
+from backend.retrieval.azuresearch import AzureSearchRetriever
+from backend.retrieval.cache import RetrievalCache
+from backend.retrieval.elasticsearch import ElasticsearchRetriever
+from backend.retrieval.passages import StageTimings, trim_to_budget
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
 
 import assistants
+from assistants import upstream, usage_ledger
 import imagegeneration
 
 load_dotenv()
@@ -42,7 +60,14 @@ def assets(path):
 
 @app.route("/images/<path:path>")
 def image(path):
-    return send_from_directory("images", path)
+    # image names are content addressed, so browsers can keep them for good
+    response = send_from_directory(image_store.directory, path, max_age=IMAGES_MAX_AGE)
+    response.cache_control.immutable = True
+    image_store.touch(path)
+    return response
+
+# Cache lifetime for /images responses
+IMAGES_MAX_AGE = int(os.environ.get("IMAGES_MAX_AGE", 31536000))
 
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
@@ -77,6 +102,14 @@ AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
 AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
 AZURE_SEARCH_STRICTNESS = os.environ.get("AZURE_SEARCH_STRICTNESS", SEARCH_STRICTNESS)
+AZURE_SEARCH_RETRIEVAL_MODE = os.environ.get("AZURE_SEARCH_RETRIEVAL_MODE", "extensions") # extensions or app
+AZURE_SEARCH_QUERY_TYPES = os.environ.get("AZURE_SEARCH_QUERY_TYPES", "keyword|vector|semantic")
+AZURE_SEARCH_MAX_CONTEXT_TOKENS = int(os.environ.get("AZURE_SEARCH_MAX_CONTEXT_TOKENS", 3000))
+AZURE_SEARCH_RETRIEVAL_WORKERS = int(os.environ.get("AZURE_SEARCH_RETRIEVAL_WORKERS", 8))
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", 300)) # 0 disables the cache
+RETRIEVAL_CACHE_MAX_BYTES = int(os.environ.get("RETRIEVAL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RETRIEVAL_CACHE_INVALIDATION_KEY = os.environ.get("RETRIEVAL_CACHE_INVALIDATION_KEY")
+RETRIEVAL_CACHE_GENERATIONS_PATH = os.environ.get("RETRIEVAL_CACHE_GENERATIONS_PATH", "data/retrieval_cache.db")
 
 # AOAI Integration Settings
 AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
@@ -91,6 +124,12 @@ AZURE_OPENAI_MAX_TOKENS = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 1000)
 AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
 AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
 AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", "2023-08-01-preview")
+AZURE_OPENAI_DEPLOYMENTS = os.environ.get("AZURE_OPENAI_DEPLOYMENTS") # JSON list of {"endpoint", "model", "weight", "key"}, defaults to AZURE_OPENAI_ENDPOINT/AZURE_OPENAI_MODEL
+AZURE_OPENAI_ROUTING = os.environ.get("AZURE_OPENAI_ROUTING", "round_robin") # round_robin or least_outstanding
+AZURE_OPENAI_COOLDOWN = float(os.environ.get("AZURE_OPENAI_COOLDOWN", 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 60))
+USAGE_ADMIN_USERS = set(filter(None, os.environ.get("USAGE_ADMIN_USERS", "").split(","))) # user principal ids that may read everyone's usage
 AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
 AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo-16k") # Name of the model, e.g. 'gpt-35-turbo-16k' or 'gpt-4'
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
@@ -111,6 +150,16 @@ AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN = os.environ.get("AZURE_COSMOSDB_MONGO_V
 AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN")
 AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS")
 
+# Assistants Settings
+ASSISTANT_WARM_UP = os.environ.get("ASSISTANT_WARM_UP", "true")
+
+# Generated and assistant image settings
+ASSISTANT_IMAGES_PATH = os.environ.get("ASSISTANT_IMAGES_PATH", "images")
+ASSISTANT_IMAGES_MAX_BYTES = int(os.environ.get("ASSISTANT_IMAGES_MAX_BYTES", 512 * 1024 * 1024))
+ASSISTANT_IMAGES_THUMBNAIL_SIZE = int(os.environ.get("ASSISTANT_IMAGES_THUMBNAIL_SIZE", 768))
+ASSISTANT_IMAGES_INDEX_PATH = os.environ.get("ASSISTANT_IMAGES_INDEX_PATH", "data/images.db")
+ASSISTANT_IMAGES_MIN_AGE = float(os.environ.get("ASSISTANT_IMAGES_MIN_AGE", 3600))
+
 # Azure Bing Search Settings
 AZURE_BING_SEARCH_KEY = os.environ.get("AZURE_BING_SEARCH_KEY")
 AZURE_BING_SEARCH_URL = os.environ.get("AZURE_BING_SEARCH_URL")
@@ -119,14 +168,38 @@ AZURE_BING_SEARCH_URL = os.environ.get("AZURE_BING_SEARCH_URL")
 AZURE_SPEECH_SERVICE_REGION = os.environ.get("AZURE_SPEECH_SERVICE_REGION")
 AZURE_SPEECH_SERVICE_KEY = os.environ.get("AZURE_SPEECH_SERVICE_KEY")
 AZURE_SPEECH_SERVICE_ENDPOINT = os.environ.get("AZURE_SPEECH_SERVICE_ENDPOINT")
+SPEECH_FFMPEG_PATH = os.environ.get("SPEECH_FFMPEG_PATH", "ffmpeg")
+SPEECH_TRANSCODE_MAX_PROCESSES = int(os.environ.get("SPEECH_TRANSCODE_MAX_PROCESSES", 4))
+SPEECH_TRANSCODE_TIMEOUT = float(os.environ.get("SPEECH_TRANSCODE_TIMEOUT", 60))
+SPEECH_MAX_UPLOAD_BYTES = int(os.environ.get("SPEECH_MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+SPEECH_MAX_DURATION = float(os.environ.get("SPEECH_MAX_DURATION", 60))
 
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
 
+# Chat History Settings
+CHAT_HISTORY_PROVIDER = os.environ.get("CHAT_HISTORY_PROVIDER", "cosmosdb")
+CHAT_HISTORY_SQLITE_PATH = os.environ.get("CHAT_HISTORY_SQLITE_PATH", "data/chat_history.db")
+CHAT_HISTORY_DEDUPE_CITATIONS = os.environ.get("CHAT_HISTORY_DEDUPE_CITATIONS", "false")
+CHAT_HISTORY_TITLE_WORKERS = int(os.environ.get("CHAT_HISTORY_TITLE_WORKERS", 2))
+CHAT_HISTORY_WRITE_WORKERS = int(os.environ.get("CHAT_HISTORY_WRITE_WORKERS", 4))
+CHAT_HISTORY_WRITE_TIMEOUT = float(os.environ.get("CHAT_HISTORY_WRITE_TIMEOUT", 10))
+CHAT_HISTORY_PROVISIONAL_TITLE_LENGTH = int(os.environ.get("CHAT_HISTORY_PROVISIONAL_TITLE_LENGTH", 40))
+
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
 AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
 AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
 AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+AZURE_COSMOSDB_ENABLE_ASYNC = os.environ.get("AZURE_COSMOSDB_ENABLE_ASYNC", "false")
+AZURE_COSMOSDB_MAX_CONCURRENCY = os.environ.get("AZURE_COSMOSDB_MAX_CONCURRENCY", 16)
+AZURE_COSMOSDB_ASYNC_TIMEOUT = os.environ.get("AZURE_COSMOSDB_ASYNC_TIMEOUT", 30)
+AZURE_COSMOSDB_ENABLE_CACHE = os.environ.get("AZURE_COSMOSDB_ENABLE_CACHE", "false")
+AZURE_COSMOSDB_CACHE_SIZE = os.environ.get("AZURE_COSMOSDB_CACHE_SIZE", 1024)
+AZURE_COSMOSDB_CACHE_TTL = os.environ.get("AZURE_COSMOSDB_CACHE_TTL", 10)
+AZURE_COSMOSDB_WRITE_BEHIND = os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND", "false")
+AZURE_COSMOSDB_WRITE_BEHIND_DIR = os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND_DIR", "data/history_wal")
+AZURE_COSMOSDB_WRITE_BEHIND_BATCH_SIZE = os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND_BATCH_SIZE", 50)
+AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL = os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL", 0.5)
 
 # Elasticsearch Integration Settings
 ELASTICSEARCH_ENDPOINT = os.environ.get("ELASTICSEARCH_ENDPOINT")
@@ -142,14 +215,122 @@ ELASTICSEARCH_URL_COLUMN = os.environ.get("ELASTICSEARCH_URL_COLUMN")
 ELASTICSEARCH_VECTOR_COLUMNS = os.environ.get("ELASTICSEARCH_VECTOR_COLUMNS")
 ELASTICSEARCH_STRICTNESS = os.environ.get("ELASTICSEARCH_STRICTNESS", SEARCH_STRICTNESS)
 ELASTICSEARCH_EMBEDDING_MODEL_ID = os.environ.get("ELASTICSEARCH_EMBEDDING_MODEL_ID")
+ELASTICSEARCH_RETRIEVAL_MODE = os.environ.get("ELASTICSEARCH_RETRIEVAL_MODE", "extensions") # extensions or app
+ELASTICSEARCH_FUSION = os.environ.get("ELASTICSEARCH_FUSION", "client") # client (_msearch, fused in the app) or server (rank.rrf, licensed clusters only)
+ELASTICSEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("ELASTICSEARCH_PERMITTED_GROUPS_COLUMN") # app retrieval mode only
+ELASTICSEARCH_POOL_SIZE = int(os.environ.get("ELASTICSEARCH_POOL_SIZE", 16))
+ELASTICSEARCH_MAX_CONTEXT_TOKENS = int(os.environ.get("ELASTICSEARCH_MAX_CONTEXT_TOKENS", AZURE_SEARCH_MAX_CONTEXT_TOKENS))
 
 # Frontend Settings via Environment Variables
 AUTH_ENABLED = os.environ.get("AUTH_ENABLED", "true").lower()
 frontend_settings = { "auth_enabled": AUTH_ENABLED }
 
-# Initialize a CosmosDB client with AAD auth and containers for Chat History
-cosmos_conversation_client = None
-if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+# Conversation titles are generated off the request path
+title_executor = ThreadPoolExecutor(max_workers=CHAT_HISTORY_TITLE_WORKERS, thread_name_prefix="conversation-title")
+
+# /history/generate writes history concurrently with the model request
+history_executor = ThreadPoolExecutor(max_workers=CHAT_HISTORY_WRITE_WORKERS, thread_name_prefix="history-write")
+
+# Pool of equivalent Azure OpenAI deployments the chat calls are routed over
+aoai_pool = DeploymentPool.from_config(
+    AZURE_OPENAI_DEPLOYMENTS,
+    AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/",
+    AZURE_OPENAI_MODEL,
+    key=AZURE_OPENAI_KEY,
+    strategy=AZURE_OPENAI_ROUTING,
+    cooldown=AZURE_OPENAI_COOLDOWN,
+    max_attempts=assistants.UPSTREAM_MAX_ATTEMPTS,
+    max_wait=assistants.UPSTREAM_BACKOFF_MAX * 4)
+aoai_session = requests.Session()
+
+# Latency of each retrieval stage and of the generation that follows it
+retrieval_timings = StageTimings()
+
+# Ranked passages by query signature, flushed through /retrieval/invalidate when an index is re-indexed
+retrieval_cache = RetrievalCache(ttl=RETRIEVAL_CACHE_TTL, max_bytes=RETRIEVAL_CACHE_MAX_BYTES,
+                                 generations_path=RETRIEVAL_CACHE_GENERATIONS_PATH) if RETRIEVAL_CACHE_TTL > 0 else None
+
+# App-side retrieval against Azure AI Search or Elasticsearch, used instead of the extensions endpoint when the retrieval mode is "app"
+search_retriever = None
+retrieval_in_scope = True
+retrieval_max_context_tokens = AZURE_SEARCH_MAX_CONTEXT_TOKENS
+if AZURE_SEARCH_RETRIEVAL_MODE.lower() == "app" and DATASOURCE_TYPE == "AzureCognitiveSearch" and AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX:
+    try:
+        retrieval_in_scope = AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true"
+        search_retriever = AzureSearchRetriever(
+            SearchClient(f"https://{AZURE_SEARCH_SERVICE}.search.windows.net", AZURE_SEARCH_INDEX, AzureKeyCredential(AZURE_SEARCH_KEY)),
+            content_fields=AZURE_SEARCH_CONTENT_COLUMNS.split("|") if AZURE_SEARCH_CONTENT_COLUMNS else [],
+            title_field=AZURE_SEARCH_TITLE_COLUMN,
+            url_field=AZURE_SEARCH_URL_COLUMN,
+            filepath_field=AZURE_SEARCH_FILENAME_COLUMN,
+            vector_fields=AZURE_SEARCH_VECTOR_COLUMNS.split("|") if AZURE_SEARCH_VECTOR_COLUMNS else [],
+            semantic_configuration=AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" else None,
+            embed=lambda text: embed_query(text),
+            query_types=AZURE_SEARCH_QUERY_TYPES.split("|"),
+            top_k=int(AZURE_SEARCH_TOP_K),
+            strictness=int(AZURE_SEARCH_STRICTNESS),
+            executor=ThreadPoolExecutor(max_workers=AZURE_SEARCH_RETRIEVAL_WORKERS, thread_name_prefix="retrieval"),
+            timings=retrieval_timings,
+            index_name=AZURE_SEARCH_INDEX,
+            cache=retrieval_cache
+        )
+    except Exception as e:
+        logging.exception("Exception in app-side retrieval initialization, falling back to the extensions endpoint")
+        search_retriever = None
+elif ELASTICSEARCH_RETRIEVAL_MODE.lower() == "app" and DATASOURCE_TYPE == "Elasticsearch" and ELASTICSEARCH_ENDPOINT and ELASTICSEARCH_INDEX:
+    try:
+        retrieval_in_scope = ELASTICSEARCH_ENABLE_IN_DOMAIN.lower() == "true"
+        retrieval_max_context_tokens = ELASTICSEARCH_MAX_CONTEXT_TOKENS
+        search_retriever = ElasticsearchRetriever(
+            ELASTICSEARCH_ENDPOINT,
+            ELASTICSEARCH_INDEX,
+            content_fields=ELASTICSEARCH_CONTENT_COLUMNS.split("|") if ELASTICSEARCH_CONTENT_COLUMNS else [],
+            api_key=ELASTICSEARCH_ENCODED_API_KEY,
+            title_field=ELASTICSEARCH_TITLE_COLUMN,
+            url_field=ELASTICSEARCH_URL_COLUMN,
+            filepath_field=ELASTICSEARCH_FILENAME_COLUMN,
+            vector_fields=ELASTICSEARCH_VECTOR_COLUMNS.split("|") if ELASTICSEARCH_VECTOR_COLUMNS else [],
+            embedding_model_id=ELASTICSEARCH_EMBEDDING_MODEL_ID,
+            embed=lambda text: embed_query(text),
+            top_k=int(ELASTICSEARCH_TOP_K),
+            strictness=int(ELASTICSEARCH_STRICTNESS),
+            fusion=ELASTICSEARCH_FUSION,
+            pool_size=ELASTICSEARCH_POOL_SIZE,
+            timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT),
+            dependency=upstream["elasticsearch"],
+            timings=retrieval_timings,
+            cache=retrieval_cache
+        )
+    except Exception as e:
+        logging.exception("Exception in Elasticsearch retrieval initialization, falling back to the extensions endpoint")
+        search_retriever = None
+
+# Store for the images DALL-E and the assistants produce, served from /images; images saved conversations link to are never evicted
+image_store = ImageStore(ASSISTANT_IMAGES_PATH, ASSISTANT_IMAGES_INDEX_PATH, max_bytes=ASSISTANT_IMAGES_MAX_BYTES,
+                         min_age=ASSISTANT_IMAGES_MIN_AGE, thumbnail_size=ASSISTANT_IMAGES_THUMBNAIL_SIZE)
+
+# In-memory audio conversion for /speech_to_text
+audio_converter = AudioConverter(SPEECH_FFMPEG_PATH, max_processes=SPEECH_TRANSCODE_MAX_PROCESSES, timeout=SPEECH_TRANSCODE_TIMEOUT)
+
+# pooled connections to the regional speech recognition host
+speech_session = requests.Session()
+speech_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SPEECH_TRANSCODE_MAX_PROCESSES))
+
+# Initialize the Chat History provider: a local SQLite database, or a CosmosDB client with AAD auth and containers
+conversation_client = None
+conversation_cache = None
+if AZURE_COSMOSDB_ENABLE_CACHE.lower() == "true":
+    conversation_cache = ConversationCache(maxsize=int(AZURE_COSMOSDB_CACHE_SIZE), ttl=float(AZURE_COSMOSDB_CACHE_TTL))
+citation_store = None
+if CHAT_HISTORY_DEDUPE_CITATIONS.lower() == "true":
+    citation_store = CitationStore()
+if CHAT_HISTORY_PROVIDER.lower() == "sqlite":
+    try:
+        conversation_client = SqliteConversationClient(database_path=CHAT_HISTORY_SQLITE_PATH, citation_store=citation_store)
+    except Exception as e:
+        logging.exception("Exception in SQLite chat history initialization")
+        conversation_client = None
+elif AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
     try :
         cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
 
@@ -158,15 +339,56 @@ if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERS
         else:
             credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
-        cosmos_conversation_client = CosmosConversationClient(
-            cosmosdb_endpoint=cosmos_endpoint, 
-            credential=credential, 
-            database_name=AZURE_COSMOSDB_DATABASE,
-            container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
-        )
+        if AZURE_COSMOSDB_ENABLE_ASYNC.lower() == "true":
+            ## every history call goes through an async client on a shared background event loop; reads and deletes fan out concurrently
+            try:
+                if not AZURE_COSMOSDB_ACCOUNT_KEY:
+                    from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+                    async_credential = AsyncDefaultAzureCredential()
+                else:
+                    async_credential = AZURE_COSMOSDB_ACCOUNT_KEY
+
+                conversation_client = AsyncCosmosConversationClient(
+                    cosmosdb_endpoint=cosmos_endpoint,
+                    credential=credential,
+                    database_name=AZURE_COSMOSDB_DATABASE,
+                    container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+                    async_credential=async_credential,
+                    cache=conversation_cache,
+                    citation_store=citation_store,
+                    max_concurrency=int(AZURE_COSMOSDB_MAX_CONCURRENCY),
+                    timeout=float(AZURE_COSMOSDB_ASYNC_TIMEOUT)
+                )
+            except Exception as e:
+                logging.exception("Exception in async CosmosDB initialization, falling back to the synchronous client")
+                conversation_client = None
+
+        if not conversation_client:
+            conversation_client = CosmosConversationClient(
+                cosmosdb_endpoint=cosmos_endpoint, 
+                credential=credential, 
+                database_name=AZURE_COSMOSDB_DATABASE,
+                container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+                cache=conversation_cache,
+                citation_store=citation_store
+            )
     except Exception as e:
         logging.exception("Exception in CosmosDB initialization", e)
-        cosmos_conversation_client = None
+        conversation_client = None
+
+# Optionally acknowledge /history/update writes from a local write-ahead log and flush them in the background
+history_writer = None
+if conversation_client and AZURE_COSMOSDB_WRITE_BEHIND.lower() == "true":
+    try:
+        history_writer = WriteBehindHistoryWriter(
+            conversation_client,
+            wal_directory=AZURE_COSMOSDB_WRITE_BEHIND_DIR,
+            batch_size=int(AZURE_COSMOSDB_WRITE_BEHIND_BATCH_SIZE),
+            flush_interval=float(AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL)
+        )
+    except Exception as e:
+        logging.exception("Exception in chat history write-behind initialization")
+        history_writer = None
 
 
 def is_chat_model():
@@ -184,13 +406,57 @@ def should_use_data():
         if DEBUG_LOGGING:
             logging.debug("Using Azure CosmosDB Mongo vcore")
         return True
+
+    if ELASTICSEARCH_ENDPOINT and ELASTICSEARCH_INDEX:
+        if DEBUG_LOGGING:
+            logging.debug("Using Elasticsearch")
+        return True
     
     return False
 
 
+def get_azure_openai_token():
+    # Check if Azure token is still valid
+    global AzureOpenAIAccessToken
+    if not AzureOpenAIAccessToken or datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on) < datetime.datetime.now():
+        AzureOpenAIAccessToken = Credential.get_token("https://cognitiveservices.azure.com")
+        logging.error(f"Token expires at: {datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on)}")
+
+    return AzureOpenAIAccessToken.token
+
 def format_as_ndjson(obj: dict) -> str:
     return json.dumps(obj, ensure_ascii=False) + "\n"
 
+def aoai_client(deployment):
+    ## failover and retries are handled by aoai_pool, not by the SDK
+    return AzureOpenAI(api_key = deployment.key or get_azure_openai_token(), azure_endpoint = deployment.endpoint,
+                       api_version = AZURE_OPENAI_PREVIEW_API_VERSION, max_retries = 0,
+                       timeout = httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT))
+
+def run_on_pool(dependency, call, hold=False):
+    ## aoai_pool fails over and retries; the dependency adds its circuit breaker and metrics, not a second retry loop
+    return upstream[dependency].call(lambda: aoai_pool.run(call, hold=hold), retry=False)
+
+def extensions_endpoint(deployment):
+    return f"{deployment.endpoint}openai/deployments/{deployment.model}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+
+def extensions_headers(deployment, headers):
+    ## each deployment authenticates against its own resource: with its key, or with an Entra ID token when it has none
+    if deployment.key:
+        return dict(headers, **{'api-key': deployment.key})
+    return dict(headers, Authorization=f"Bearer {get_azure_openai_token()}")
+
+def release_after(stream, deployment):
+    ## keep the deployment acquired while its response streams, and score it by how the stream ended
+    error = None
+    try:
+        yield from stream
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        aoai_pool.release(deployment, error)
+
 def fetchUserGroups(userToken, nextLink=None):
     # Recursively fetch group membership
     if nextLink:
@@ -202,7 +468,7 @@ def fetchUserGroups(userToken, nextLink=None):
         'Authorization': "bearer " + userToken
     }
     try :
-        r = requests.get(endpoint, headers=headers)
+        r = upstream["graph"].call(lambda: requests.get(endpoint, headers=headers, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)), idempotent=True)
         if r.status_code != 200:
             if DEBUG_LOGGING:
                 logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
@@ -231,6 +497,12 @@ def generateFilterString(userToken):
     return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
 
 
+def generateElasticsearchFilter(userToken):
+    # The same group check as a query DSL clause, for app-side Elasticsearch retrieval
+    userGroups = fetchUserGroups(userToken)
+    return json.dumps({"terms": {ELASTICSEARCH_PERMITTED_GROUPS_COLUMN: [obj['id'] for obj in userGroups]}})
+
+
 
 def prepare_body_headers_with_data(request):
     request_messages = request.json["messages"]
@@ -317,45 +589,37 @@ def prepare_body_headers_with_data(request):
         )
 
     elif DATASOURCE_TYPE == "Elasticsearch":
+        query_type = ELASTICSEARCH_QUERY_TYPE
+
         body["dataSources"].append(
             {
-                "messages": request_messages,
-                "temperature": float(AZURE_OPENAI_TEMPERATURE),
-                "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-                "top_p": float(AZURE_OPENAI_TOP_P),
-                "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-                "stream": SHOULD_STREAM,
-                "dataSources": [
-                    {
-                        "type": "AzureCognitiveSearch",
-                        "parameters": {
-                            "endpoint": ELASTICSEARCH_ENDPOINT,
-                            "encodedApiKey": ELASTICSEARCH_ENCODED_API_KEY,
-                            "indexName": ELASTICSEARCH_INDEX,
-                            "fieldsMapping": {
-                                "contentFields": ELASTICSEARCH_CONTENT_COLUMNS.split("|") if ELASTICSEARCH_CONTENT_COLUMNS else [],
-                                "titleField": ELASTICSEARCH_TITLE_COLUMN if ELASTICSEARCH_TITLE_COLUMN else None,
-                                "urlField": ELASTICSEARCH_URL_COLUMN if ELASTICSEARCH_URL_COLUMN else None,
-                                "filepathField": ELASTICSEARCH_FILENAME_COLUMN if ELASTICSEARCH_FILENAME_COLUMN else None,
-                                "vectorFields": ELASTICSEARCH_VECTOR_COLUMNS.split("|") if ELASTICSEARCH_VECTOR_COLUMNS else []
-                            },
-                            "inScope": True if ELASTICSEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                            "topNDocuments": int(ELASTICSEARCH_TOP_K),
-                            "queryType": ELASTICSEARCH_QUERY_TYPE,
-                            "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
-                            "embeddingEndpoint": AZURE_OPENAI_EMBEDDING_ENDPOINT,
-                            "embeddingKey": AZURE_OPENAI_EMBEDDING_KEY,
-                            "embeddingModelId": ELASTICSEARCH_EMBEDDING_MODEL_ID,
-                            "strictness": int(ELASTICSEARCH_STRICTNESS)
-                        }
-                    }
-                ]
+                "type": "Elasticsearch",
+                "parameters": {
+                    "endpoint": ELASTICSEARCH_ENDPOINT,
+                    "encodedApiKey": ELASTICSEARCH_ENCODED_API_KEY,
+                    "indexName": ELASTICSEARCH_INDEX,
+                    "fieldsMapping": {
+                        "contentFields": ELASTICSEARCH_CONTENT_COLUMNS.split("|") if ELASTICSEARCH_CONTENT_COLUMNS else [],
+                        "titleField": ELASTICSEARCH_TITLE_COLUMN if ELASTICSEARCH_TITLE_COLUMN else None,
+                        "urlField": ELASTICSEARCH_URL_COLUMN if ELASTICSEARCH_URL_COLUMN else None,
+                        "filepathField": ELASTICSEARCH_FILENAME_COLUMN if ELASTICSEARCH_FILENAME_COLUMN else None,
+                        "vectorFields": ELASTICSEARCH_VECTOR_COLUMNS.split("|") if ELASTICSEARCH_VECTOR_COLUMNS else []
+                    },
+                    "inScope": True if ELASTICSEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
+                    "topNDocuments": int(ELASTICSEARCH_TOP_K),
+                    "queryType": query_type,
+                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
+                    "strictness": int(ELASTICSEARCH_STRICTNESS)
+                }
             }
         )
+        if ELASTICSEARCH_EMBEDDING_MODEL_ID:
+            ## the embedding model deployed in Elasticsearch builds the query vectors
+            body["dataSources"][0]["parameters"]["embeddingModelId"] = ELASTICSEARCH_EMBEDDING_MODEL_ID
     else:
         raise Exception(f"DATASOURCE_TYPE is not configured or unknown: {DATASOURCE_TYPE}")
 
-    if "vector" in query_type.lower():
+    if "vector" in query_type.lower() and not body["dataSources"][0]["parameters"].get("embeddingModelId"):
         if AZURE_OPENAI_EMBEDDING_NAME:
             body["dataSources"][0]["parameters"]["embeddingDeploymentName"] = AZURE_OPENAI_EMBEDDING_NAME
         else:
@@ -375,17 +639,24 @@ def prepare_body_headers_with_data(request):
 
     headers = {
         'Content-Type': 'application/json',
-        'api-key': AZURE_OPENAI_KEY,
         "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/3.0.0"
     }
 
     return body, headers
 
 
-def stream_with_data(body, headers, endpoint, history_metadata={}):
-    s = requests.Session()
+def stream_with_data(body, headers, history_metadata={}, on_complete=None):
+    deployment = None
+    error = None
+    ## the retrieved documents go into the prompt, so they count as prompt tokens
+    context_text = []
+    completion_text = []
     try:
-        with s.post(endpoint, json=body, headers=headers, stream=True) as r:
+        deployment, r = run_on_pool("aoai_extensions",
+            lambda d: check_response(aoai_session.post(extensions_endpoint(d), json=body, headers=extensions_headers(d, headers), stream=True,
+                                                       timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))),
+            hold=True)
+        with r:
             for line in r.iter_lines(chunk_size=10):
                 response = {
                     "id": "",
@@ -419,6 +690,7 @@ def stream_with_data(body, headers, endpoint, history_metadata={}):
                     role = lineJson["choices"][0]["messages"][0]["delta"].get("role")
 
                     if role == "tool":
+                        context_text.append(lineJson["choices"][0]["messages"][0]["delta"].get("content") or "")
                         response["choices"][0]["messages"].append(lineJson["choices"][0]["messages"][0]["delta"])
                         yield format_as_ndjson(response)
                     elif role == "assistant": 
@@ -432,13 +704,20 @@ def stream_with_data(body, headers, endpoint, history_metadata={}):
                     else:
                         deltaText = lineJson["choices"][0]["messages"][0]["delta"]["content"]
                         if deltaText != "[DONE]":
+                            completion_text.append(deltaText or "")
                             response["choices"][0]["messages"].append({
                                 "role": "assistant",
                                 "content": deltaText
                             })
                             yield format_as_ndjson(response)
     except Exception as e:
-        yield format_as_ndjson({"error" + str(e)})
+        error = e
+        yield format_as_ndjson({"error": str(e)})
+    finally:
+        if deployment:
+            aoai_pool.release(deployment, error)
+            if on_complete:
+                on_complete(deployment, "".join(completion_text), "".join(context_text))
 
 def formatApiResponseNoStreaming(rawResponse):
     if 'error' in rawResponse:
@@ -511,16 +790,24 @@ def formatApiResponseStreaming(rawResponse):
 
     return response
 
-def conversation_with_data(request_body):
+def conversation_with_data(request_body, user_id=None):
+    if search_retriever:
+        return conversation_with_app_retrieval(request_body, user_id)
+
     body, headers = prepare_body_headers_with_data(request)
-    base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    endpoint = f"{base_url}openai/deployments/{AZURE_OPENAI_MODEL}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
     history_metadata = request_body.get("history_metadata", {})
 
     if not SHOULD_STREAM:
-        r = requests.post(endpoint, headers=headers, json=body)
+        def post(d):
+            r = check_response(aoai_session.post(extensions_endpoint(d), headers=extensions_headers(d, headers), json=body,
+                                                 timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)))
+            return d, r
+        deployment, r = run_on_pool("aoai_extensions", post)
         status_code = r.status_code
         r = r.json()
+        if status_code == 200:
+            usage_ledger.record_usage(user_id, deployment.name, "chat_with_data", r.get("usage"), prompt_messages=body["messages"],
+                                      completion_text=(r.get("choices") or [{}])[0].get("message", {}).get("content"))
         if AZURE_OPENAI_PREVIEW_API_VERSION == "2023-06-01-preview":
             r['history_metadata'] = history_metadata
             return Response(format_as_ndjson(r), status=status_code)
@@ -530,7 +817,113 @@ def conversation_with_data(request_body):
             return Response(format_as_ndjson(result), status=status_code)
 
     else:
-        return Response(stream_with_data(body, headers, endpoint, history_metadata), mimetype='text/event-stream')
+        def record_usage(deployment, completion_text, context_text):
+            prompt_messages = body["messages"] + [{"role": "tool", "content": context_text}]
+            usage_ledger.record(user_id, deployment.name, "chat_with_data", prompt_messages=prompt_messages, completion_text=completion_text)
+        return Response(stream_with_data(body, headers, history_metadata, on_complete=record_usage), mimetype='text/event-stream')
+
+def embed_query(text):
+    if AZURE_OPENAI_EMBEDDING_NAME:
+        response = run_on_pool("aoai", lambda d: aoai_client(d).embeddings.create(model=AZURE_OPENAI_EMBEDDING_NAME, input=text))
+        return response.data[0].embedding
+    ## AZURE_OPENAI_EMBEDDING_ENDPOINT is the full embeddings URL, including the deployment and api-version
+    r = upstream["aoai_embeddings"].call(lambda: aoai_session.post(AZURE_OPENAI_EMBEDDING_ENDPOINT, headers={'api-key': AZURE_OPENAI_EMBEDDING_KEY},
+                                                                   json={"input": text}, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)))
+    r.raise_for_status()
+    return r.json()["data"][0]["embedding"]
+
+def grounded_messages(request_messages, passages):
+    ## the system message carries the retrieved passages, cited as [doc1], [doc2], ... like the extensions endpoint does
+    documents = "\n\n".join(f"[doc{i}] {passage.get('title') or ''}\n{passage['content']}" for i, passage in enumerate(passages, start=1))
+    in_scope = retrieval_in_scope
+    system_message = (f"{AZURE_OPENAI_SYSTEM_MESSAGE}\n\n"
+                      + ("Answer only from the retrieved documents below. If they don't contain the answer, say that the requested information is not available in the retrieved data.\n" if in_scope else "")
+                      + f"Cite the documents you use as [doc1], [doc2] and so on.\n\n## Retrieved documents\n{documents}")
+    messages = [{"role": "system", "content": system_message}]
+    messages.extend({"role": m["role"], "content": m["content"]} for m in request_messages if m and m.get("role") in ("user", "assistant"))
+    return messages
+
+def conversation_with_app_retrieval(request_body, user_id=None):
+    request_messages = request_body["messages"]
+    history_metadata = request_body.get("history_metadata", {})
+    query = request_messages[-1]["content"]
+
+    filter = None
+    if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN and isinstance(search_retriever, AzureSearchRetriever):
+        filter = generateFilterString(request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', ""))
+    elif ELASTICSEARCH_PERMITTED_GROUPS_COLUMN and isinstance(search_retriever, ElasticsearchRetriever):
+        filter = generateElasticsearchFilter(request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', ""))
+
+    started = time.monotonic()
+    passages = trim_to_budget(search_retriever.retrieve(query, filter), retrieval_max_context_tokens, usage_ledger.estimator)
+    retrieval_ms = 1000 * (time.monotonic() - started)
+    citations = [{
+        "content": p["content"], "id": p.get("id"), "title": p.get("title"), "filepath": p.get("filepath"),
+        "url": p.get("url"), "metadata": None, "chunk_id": p.get("chunk_id"), "reindex_id": None
+    } for p in passages]
+    tool_message = {"role": "tool", "content": json.dumps({"citations": citations, "intent": json.dumps([query])})}
+    server_timing = {"Server-Timing": f"retrieval;dur={retrieval_ms:.1f}"}
+
+    def frame(messages, completion=None):
+        return format_as_ndjson({
+            "id": completion.id if completion else "",
+            "model": completion.model if completion else "",
+            "created": completion.created if completion else 0,
+            "object": completion.object if completion else "",
+            "choices": [{
+                "messages": messages
+            }],
+            "history_metadata": history_metadata
+        })
+
+    if not passages and retrieval_in_scope:
+        ## nothing to ground an in-domain answer on, so don't spend a completion on it
+        content = "The requested information is not available in the retrieved data. Please try another query or topic."
+        return Response(frame([tool_message, {"role": "assistant", "content": content}]), headers=server_timing, mimetype='text/event-stream')
+
+    messages = grounded_messages(request_messages, passages)
+    generation_started = time.monotonic()
+    deployment, response = run_on_pool("aoai", lambda d: aoai_client(d).chat.completions.create(
+        model=d.model,
+        messages=messages,
+        temperature=float(AZURE_OPENAI_TEMPERATURE),
+        max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
+        top_p=float(AZURE_OPENAI_TOP_P),
+        stop=AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
+        stream=SHOULD_STREAM
+    ), hold=True)
+
+    if not SHOULD_STREAM:
+        aoai_pool.release(deployment)
+        retrieval_timings.record("generation", time.monotonic() - generation_started)
+        usage_ledger.record_usage(user_id, deployment.name, "chat_with_data", response.usage)
+        assistant_message = {"role": "assistant", "content": response.choices[0].message.content}
+        return Response(frame([tool_message, assistant_message], response), headers=server_timing)
+
+    def stream():
+        completion_text = []
+        error = None
+        try:
+            yield frame([tool_message])
+            for chunk in response:
+                if not completion_text:
+                    retrieval_timings.record("generation_first_token", time.monotonic() - generation_started)
+                    completion_text.append("")
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    completion_text.append(delta)
+                    yield frame([{"role": "assistant", "content": delta}], chunk)
+            retrieval_timings.record("generation", time.monotonic() - generation_started)
+        except Exception as e:
+            ## the status line is gone by now, so the error goes to the client as a frame, like stream_with_data does
+            error = e
+            logging.exception("Exception in the app retrieval stream")
+            yield format_as_ndjson({"error": str(e)})
+        finally:
+            aoai_pool.release(deployment, error)
+            usage_ledger.record(user_id, deployment.name, "chat_with_data", prompt_messages=messages, completion_text="".join(completion_text))
+
+    return Response(stream(), headers=server_timing, mimetype='text/event-stream')
 
 def search(query: str) -> list:
     """
@@ -543,7 +936,8 @@ def search(query: str) -> list:
 
     headers = {"Ocp-Apim-Subscription-Key": AZURE_BING_SEARCH_KEY}
     params = {"q": query, "textDecorations": False}
-    response = requests.get(AZURE_BING_SEARCH_URL, headers=headers, params=params)
+    response = upstream["bing"].call(lambda: requests.get(AZURE_BING_SEARCH_URL, headers=headers, params=params,
+                                                          timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)), idempotent=True)
     response.raise_for_status()
     search_results = response.json()
 
@@ -554,50 +948,49 @@ def search(query: str) -> list:
 
     return json.dumps(output)
 
-def stream_without_data(response, history_metadata={}):
+def stream_without_data(response, history_metadata={}, on_complete=None):
     responseText = ""
+    completion_text = []
 
-    for line in response:
-        # logging.debug(f"LINE: {line}")
-
-        # Check if the chunk has any choices
-        if len(line.choices) > 0:
-            delta = line.choices[0].delta
-            # logging.debug(f"{delta.role} : {delta.content}")
-            deltaText = delta.content
-        else:
-            deltaText = ""
-        if deltaText and deltaText != "[DONE]":
-            # logging.debug(f"DELTA TEXT: {deltaText}")
-
-            responseText = deltaText
-
-        response_obj = {
-            "id": line.id,
-            "model": line.model,
-            "created": line.created,
-            "object": line.object,
-            "choices": [{
-                "messages": [{
-                    "role": "assistant",
-                    "content": responseText
-                }]
-            }],
-            "history_metadata": history_metadata
-        }
-        yield format_as_ndjson(response_obj)
+    try:
+        for line in response:
+            # logging.debug(f"LINE: {line}")
+
+            # Check if the chunk has any choices
+            if len(line.choices) > 0:
+                delta = line.choices[0].delta
+                # logging.debug(f"{delta.role} : {delta.content}")
+                deltaText = delta.content
+            else:
+                deltaText = ""
+            if deltaText and deltaText != "[DONE]":
+                # logging.debug(f"DELTA TEXT: {deltaText}")
+
+                responseText = deltaText
+                completion_text.append(deltaText)
+
+            response_obj = {
+                "id": line.id,
+                "model": line.model,
+                "created": line.created,
+                "object": line.object,
+                "choices": [{
+                    "messages": [{
+                        "role": "assistant",
+                        "content": responseText
+                    }]
+                }],
+                "history_metadata": history_metadata
+            }
+            yield format_as_ndjson(response_obj)
+    finally:
+        ## a stream the client abandoned still used its tokens
+        if on_complete:
+            on_complete("".join(completion_text))
 
-def conversation_without_data(request_body):
+def conversation_without_data(request_body, user_id=None):
     logging.error("Using MSI Authentication")
 
-    # Check if Azure token is still valid
-    global AzureOpenAIAccessToken
-    if not AzureOpenAIAccessToken or datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on) < datetime.datetime.now():
-        AzureOpenAIAccessToken = Credential.get_token("https://cognitiveservices.azure.com")
-        logging.error(f"Token expires at: {datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on)}")
-
-    client = AzureOpenAI(api_key = AzureOpenAIAccessToken.token, azure_endpoint = AZURE_OPENAI_ENDPOINT, api_version = AZURE_OPENAI_PREVIEW_API_VERSION)
-
     request_messages = request_body["messages"]
     messages = [
         {
@@ -625,19 +1018,21 @@ def conversation_without_data(request_body):
                                 {"type": "image_url", "image_url": {"url": message["image"]}}]
                 })
 
-    response = client.chat.completions.create(
-        model=AZURE_OPENAI_MODEL,
+    deployment, response = run_on_pool("aoai", lambda d: aoai_client(d).chat.completions.create(
+        model=d.model,
         messages = messages,
         temperature=float(AZURE_OPENAI_TEMPERATURE),
         max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
         top_p=float(AZURE_OPENAI_TOP_P),
         stop=AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
         stream=SHOULD_STREAM
-    )
+    ), hold=True)
 
     history_metadata = request_body.get("history_metadata", {})
 
     if not SHOULD_STREAM:
+        aoai_pool.release(deployment)
+        usage_ledger.record_usage(user_id, deployment.name, "chat", response.usage)
         response_obj = {
             "id": response,
             "model": response.model,
@@ -654,49 +1049,73 @@ def conversation_without_data(request_body):
 
         return jsonify(response_obj), 200
     else:
-        return Response(stream_without_data(response, history_metadata), mimetype='text/event-stream')
+        ## streamed chunks carry no usage, so the ledger estimates it from the messages and the streamed text
+        record_usage = lambda completion_text: usage_ledger.record(user_id, deployment.name, "chat", prompt_messages=messages,
+                                                                   completion_text=completion_text)
+        return Response(release_after(stream_without_data(response, history_metadata, record_usage), deployment), mimetype='text/event-stream')
 
 @app.route("/conversation", methods=["GET", "POST"])
 def conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
     assistant_type = request.args.get('assistants')
+    run_async = request.args.get('async', 'false').lower() == 'true'
     request_body = request.json
 
     logging.error(f"Assistant Type: {assistant_type}, user_id: {user_id}")
 
-    return conversation_internal(request_body, assistant_type, user_id)
+    return conversation_internal(request_body, assistant_type, user_id, run_async)
+
+@app.route("/conversation/jobs/<job_id>", methods=["GET"])
+def conversation_job(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+
+    job = assistants.assistant_jobs.get(job_id, user_id)
+    if not job:
+        return jsonify({"error": f"Job {job_id} was not found."}), 404
+    return jsonify(job), 200
 
-def conversation_internal(request_body, assistant_type, user_id=None):
+@app.route("/conversation/jobs/<job_id>/stream", methods=["GET"])
+def conversation_job_stream(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+
+    if not assistants.assistant_jobs.get(job_id, user_id):
+        return jsonify({"error": f"Job {job_id} was not found."}), 404
+    ## clients that reconnect pass the number of frames they already have
+    after = request.args.get('after', 0, type=int)
+    return Response(assistants.assistant_jobs.stream(job_id, after), mimetype='text/event-stream')
+
+def conversation_internal(request_body, assistant_type, user_id=None, run_async=False):
     if (assistant_type is None):
         try:
             use_data = should_use_data()
             if use_data:
-                return conversation_with_data(request_body)
+                return conversation_with_data(request_body, user_id)
             else:
-                return conversation_without_data(request_body)
+                return conversation_without_data(request_body, user_id)
         except Exception as e:
             logging.exception("Exception in /conversation")
             return jsonify({"error": str(e)}), 500
     elif assistant_type not in assistants.assistant_types:
         return jsonify({"error": "Invalid assistant type"}), 400
     
-    return conversation_with_assistant(request_body, assistant_type, user_id)
+    return conversation_with_assistant(request_body, assistant_type, user_id, run_async)
 
-def conversation_with_assistant(request_body, assistant_type, user_id):
+def conversation_with_assistant(request_body, assistant_type, user_id, run_async=False):
     try:
-        # Check if Azure token is still valid
-        global AzureOpenAIAccessToken
-        if not AzureOpenAIAccessToken or datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on) < datetime.datetime.now():
-            AzureOpenAIAccessToken = Credential.get_token("https://cognitiveservices.azure.com")
-            logging.error(f"Token expires at: {datetime.datetime.fromtimestamp(AzureOpenAIAccessToken.expires_on)}")
-
         if assistant_type == "dalle":
-            client = AzureOpenAI(api_key = AzureOpenAIAccessToken.token, azure_endpoint = AZURE_OPENAI_DALLE_ENDPOINT, api_version = AZURE_OPENAI_PREVIEW_API_VERSION)
-            return imagegeneration.conversation_internal_with_dalle(client, request_body, AZURE_OPENAI_DALLE_MODEL)
+            client = AzureOpenAI(api_key = get_azure_openai_token(), azure_endpoint = AZURE_OPENAI_DALLE_ENDPOINT, api_version = AZURE_OPENAI_PREVIEW_API_VERSION)
+            return imagegeneration.conversation_internal_with_dalle(client, request_body, AZURE_OPENAI_DALLE_MODEL, image_store)
         else:
-            client = AzureOpenAI(api_key = AzureOpenAIAccessToken.token, azure_endpoint = AZURE_OPENAI_ENDPOINT, api_version = AZURE_OPENAI_PREVIEW_API_VERSION)
-            return assistants.conversation_internal_with_assistant(client, request_body, assistant_type, user_id, AZURE_OPENAI_MODEL)
+            ## assistants, threads and files live in one resource, so assistant runs stay on the primary deployment
+            deployment = aoai_pool.primary
+            client = aoai_client(deployment)
+            if run_async:
+                return assistants.submit_assistant_job(client, request_body, assistant_type, user_id, deployment.model, image_store=image_store)
+            return assistants.conversation_internal_with_assistant(client, request_body, assistant_type, user_id, deployment.model, SHOULD_STREAM,
+                                                            image_store=image_store)
     except Exception as e:
         logging.exception("Exception in /conversation_with_assistant")
         return jsonify({"error": str(e)}), 500
@@ -712,30 +1131,28 @@ def add_conversation():
 
     try:
         # make sure cosmos is configured
-        if not cosmos_conversation_client:
-            raise Exception("CosmosDB is not configured")
+        if not conversation_client:
+            raise Exception("Chat history is not configured")
+
+        ## Format the incoming message object in the "chat/completions" messages format
+        messages = request.json["messages"]
+        if not (len(messages) > 0 and messages[-1]['role'] == "user"):
+            raise Exception("No user message found")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
+        new_conversation = None
         if not conversation_id:
-            title = generate_title(request.json["messages"])
-            conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
-            conversation_id = conversation_dict['id']
+            ## start with a provisional title; the generated one is patched in later and shows up on the next history refresh
+            title = provisional_title(messages)
+            new_conversation = conversation_client.build_conversation(user_id, title)
+            conversation_id = new_conversation['id']
             history_metadata['title'] = title
-            history_metadata['date'] = conversation_dict['createdAt']
-            
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request.json["messages"]
-        if len(messages) > 0 and messages[-1]['role'] == "user":
-            cosmos_conversation_client.create_message(
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1]
-            )
-        else:
-            raise Exception("No user message found")
-        
+            history_metadata['date'] = new_conversation['createdAt']
+
+        ## write the conversation and the user message to history while the model request runs
+        history_write = history_executor.submit(write_generate_history, user_id, conversation_id, new_conversation, messages)
+
         # Submit request to Chat Completions for response
         request_body = request.json
         history_metadata['conversation_id'] = conversation_id
@@ -744,12 +1161,55 @@ def add_conversation():
 
         logging.error(f"Assistant Type: {assistant_type}, conversation_id: {conversation_id}")
 
-        return conversation_internal(request_body, assistant_type, user_id)
+        return with_history_write_result(app.make_response(conversation_internal(request_body, assistant_type, user_id)), history_write)
        
     except Exception as e:
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
 
+def write_generate_history(user_id, conversation_id, new_conversation, messages):
+    if new_conversation:
+        conversation_client.create_conversation(user_id=user_id, conversation=new_conversation)
+    created = conversation_client.create_message(
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=messages[-1]
+    )
+    if not created:
+        raise Exception("Failed to save the message to chat history")
+    if new_conversation:
+        title_executor.submit(update_generated_title, user_id, conversation_id, new_conversation['title'], messages)
+
+def with_history_write_result(response, history_write):
+    ## report failed history writes: a trailing NDJSON frame on streamed responses, a
+    ## "history_error" field (or header, for bodies that aren't a JSON object) otherwise
+    def history_error():
+        try:
+            history_write.result(timeout=CHAT_HISTORY_WRITE_TIMEOUT)
+            return None
+        except Exception as e:
+            logging.error(f"Failed to write chat history: {e}")
+            return f"The conversation could not be saved to chat history: {e}"
+
+    if response.is_streamed:
+        body = response.response
+        def stream():
+            yield from body
+            error = history_error()
+            if error:
+                yield format_as_ndjson({"error": error})
+        response.response = stream()
+    else:
+        error = history_error()
+        if error:
+            payload = response.get_json(silent=True)
+            if isinstance(payload, dict):
+                payload["history_error"] = error
+                response.set_data(json.dumps(payload))
+            else:
+                response.headers["X-History-Error"] = error.replace("\r", " ").replace("\n", " ")
+    return response
+
 
 @app.route("/history/update", methods=["POST"])
 def update_conversation():
@@ -761,8 +1221,8 @@ def update_conversation():
 
     try:
         # make sure cosmos is configured
-        if not cosmos_conversation_client:
-            raise Exception("CosmosDB is not configured")
+        if not conversation_client:
+            raise Exception("Chat history is not configured")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         if not conversation_id:
@@ -771,22 +1231,30 @@ def update_conversation():
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
         messages = request.json["messages"]
-        if len(messages) > 0 and messages[-1]['role'] == "assistant":
+        if len(messages) > 0 and messages[-1]['role'] == "assistant" and history_writer:
+            ## acknowledge once the writes are in the local log; the background worker flushes them to cosmos
+            if len(messages) > 1 and messages[-2].get('role', None) == "tool":
+                history_writer.submit(conversation_id, user_id, messages[-2])
+            history_writer.submit(conversation_id, user_id, messages[-1])
+        elif len(messages) > 0 and messages[-1]['role'] == "assistant":
             if len(messages) > 1 and messages[-2].get('role', None) == "tool":
                 # write the tool message first
-                cosmos_conversation_client.create_message(
+                conversation_client.create_message(
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2]
                 )
             # write the assistant message
-            cosmos_conversation_client.create_message(
+            conversation_client.create_message(
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1]
             )
         else:
             raise Exception("No bot messages found")
+
+        ## keep the images the answer links to for as long as the conversation exists
+        image_store.reference(user_id, conversation_id, messages[-1]['content'])
         
         # Submit request to Chat Completions for response
         response = {'success': True}
@@ -808,11 +1276,12 @@ def delete_conversation():
         if not conversation_id:
             return jsonify({"error": "conversation_id is required"}), 400
         
-        ## delete the conversation messages from cosmos first
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        if history_writer:
+            history_writer.discard(user_id, conversation_id)
 
-        ## Now delete the conversation 
-        deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation_id)
+        ## delete the conversation messages from cosmos first, then the conversation
+        deleted_messages, deleted_conversation = conversation_client.delete_conversation_and_messages(user_id, conversation_id)
+        image_store.release(user_id, conversation_id)
 
         return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -829,7 +1298,7 @@ def list_conversations():
     user_id = authenticated_user['user_principal_id']
 
     ## get the conversations from cosmos
-    conversations = cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=25)
+    conversations = conversation_client.get_conversations(user_id, offset=offset, limit=25)
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -849,13 +1318,16 @@ def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## get the conversation object and the related messages from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
+    conversation, conversation_messages = conversation_client.get_conversation_with_messages(user_id, conversation_id)
+
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
-    
-    # get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
+
+    ## include writes that were acknowledged but haven't been flushed to cosmos yet
+    if history_writer:
+        stored_ids = {msg['id'] for msg in conversation_messages}
+        conversation_messages = conversation_messages + [msg for msg in history_writer.pending_messages(user_id, conversation_id) if msg['id'] not in stored_ids]
 
     ## format the messages in the bot frontend format
     messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt']} for msg in conversation_messages]
@@ -874,7 +1346,7 @@ def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
     
     ## get the conversation from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
+    conversation = conversation_client.get_conversation(user_id, conversation_id)
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
 
@@ -883,7 +1355,7 @@ def rename_conversation():
     if not title:
         return jsonify({"error": "title is required"}), 400
     conversation['title'] = title
-    updated_conversation = cosmos_conversation_client.upsert_conversation(conversation)
+    updated_conversation = conversation_client.upsert_conversation(conversation)
 
     return jsonify(updated_conversation), 200
 
@@ -895,17 +1367,19 @@ def delete_all_conversations():
 
     # get conversations for user
     try:
-        conversations = cosmos_conversation_client.get_conversations(user_id, offset=0, limit=None)
+        conversations = conversation_client.get_conversations(user_id, offset=0, limit=None)
         if not conversations:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-        
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = cosmos_conversation_client.delete_messages(conversation['id'], user_id)
 
-            ## Now delete the conversation 
-            deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
+        ## drop pending writes first so they can't recreate messages of the conversations being deleted
+        if history_writer:
+            for conversation in conversations:
+                history_writer.discard(user_id, conversation['id'])
+
+        # delete each conversation, its messages first
+        conversation_client.delete_conversations(user_id, conversations)
+        for conversation in conversations:
+            image_store.release(user_id, conversation['id'])
 
         return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
     
@@ -927,7 +1401,10 @@ def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## delete the conversation messages from cosmos
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        if history_writer:
+            history_writer.discard(user_id, conversation_id)
+        deleted_messages = conversation_client.delete_messages(conversation_id, user_id)
+        image_store.release(user_id, conversation_id)
 
         return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -936,13 +1413,54 @@ def clear_messages():
 
 @app.route("/history/ensure", methods=["GET"])
 def ensure_cosmos():
-    if not AZURE_COSMOSDB_ACCOUNT:
+    if not AZURE_COSMOSDB_ACCOUNT and CHAT_HISTORY_PROVIDER.lower() != "sqlite":
         return jsonify({"error": "CosmosDB is not configured"}), 404
     
-    if not cosmos_conversation_client or not cosmos_conversation_client.ensure():
-        return jsonify({"error": "CosmosDB is not working"}), 500
+    if not conversation_client or not conversation_client.ensure():
+        return jsonify({"error": f"{CHAT_HISTORY_PROVIDER} chat history is not working"}), 500
+
+    return jsonify({"message": f"{CHAT_HISTORY_PROVIDER} chat history is configured and working"}), 200
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    metrics = {}
+    if history_writer:
+        metrics["history_write_behind"] = history_writer.metrics()
+    if conversation_cache:
+        metrics["history_cache"] = conversation_cache.metrics()
+    metrics["aoai_deployments"] = aoai_pool.metrics()
+    metrics["upstream"] = upstream.metrics()
+    metrics["usage_ledger"] = usage_ledger.metrics()
+    if search_retriever:
+        metrics["retrieval"] = retrieval_timings.metrics()
+    if retrieval_cache:
+        metrics["retrieval_cache"] = retrieval_cache.metrics()
+    metrics["google_search_cache"] = dict(assistants.google_search_cache.metrics(), coalesced=assistants.google_search_flight.coalesced)
+
+    return jsonify(metrics), 200
+
+@app.route("/usage", methods=["GET"])
+def get_usage():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
 
-    return jsonify({"message": "CosmosDB is configured and working"}), 200
+    ## token usage since the start of the last `days` UTC days; admins can pass scope=all for every user
+    days = request.args.get('days', 30, type=int)
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+    if request.args.get('scope') == 'all':
+        if user_id not in USAGE_ADMIN_USERS:
+            return jsonify({"error": "Only usage admins can read the usage of all users"}), 403
+        return jsonify(dict(usage_ledger.usage(since=since), since=since)), 200
+    return jsonify(dict(usage_ledger.usage(user_id, since=since), user_id=user_id, since=since)), 200
+
+@app.route("/retrieval/invalidate", methods=["POST"])
+def invalidate_retrieval_cache():
+    ## called by the ingestion scripts after they re-index; authenticated with a shared key rather than a user
+    if not RETRIEVAL_CACHE_INVALIDATION_KEY or not hmac.compare_digest(request.headers.get('X-Invalidation-Key', ''), RETRIEVAL_CACHE_INVALIDATION_KEY):
+        return jsonify({"error": "Invalid or missing invalidation key"}), 403
+    index = (request.get_json(silent=True) or {}).get('index')
+    dropped = retrieval_cache.invalidate(index) if retrieval_cache else 0
+    return jsonify({"index": index, "dropped": dropped}), 200
 
 @app.route("/frontend_settings", methods=["GET"])  
 def get_frontend_settings():
@@ -974,28 +1492,15 @@ def speech_to_text():
         if not AZURE_SPEECH_SERVICE_REGION or not AZURE_SPEECH_SERVICE_KEY:
             return jsonify({"error": "Azure Speech Service is not configured"}), 404
 
+        # Reject oversized uploads before reading them
+        if request.content_length and request.content_length > SPEECH_MAX_UPLOAD_BYTES:
+            return jsonify({"error": f"The recording is larger than {SPEECH_MAX_UPLOAD_BYTES} bytes"}), 413
+
         # Get the audio file from the request
         audio_file = request.files.get('audio')
 
         if not audio_file:
             return {"error": "No audio file provided"}, 400
-        
-        # save the audio file to a temp file
-        if DEBUG_LOGGING:
-            logging.debug(f"Saving audio file to temp file")
-            # save file under data folder
-        
-        audio_file.save("data/audio.wav")
-        audio_info = mediainfo("data/audio.wav")
-        logging.debug(f"Audio file sample rate: {audio_info['sample_rate']}")
-        logging.debug(f"Audio file channels: {audio_info['channels']}")
-        logging.debug(f"Audio file codec_name: {audio_info['codec_name']}")
-
-        # Convert the audio file to the correct format
-        audio = AudioSegment.from_file("data/audio.wav")
-
-        audio = audio.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        audio.export("data/audio_converted.wav", format="wav")
 
         logging.debug(f"region: {AZURE_SPEECH_SERVICE_REGION}")
 
@@ -1004,15 +1509,27 @@ def speech_to_text():
         url = f"https://{AZURE_SPEECH_SERVICE_REGION}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=en-US"
         headers = {
             "Ocp-Apim-Subscription-Key": f"{AZURE_SPEECH_SERVICE_KEY}",
-            "Content-Type": "audio/wav",
+            "Content-Type": "audio/wav; codecs=audio/pcm; samplerate=16000",
         }
 
-        # Open the audio file in binary mode
-        with open("data/audio_converted.wav", "rb") as audio_file:
-            data = audio_file.read()
+        # Convert the audio to 16 kHz mono PCM16 WAV (passed through when it already is) and upload it
+        # with chunked transfer encoding while ffmpeg is still converting
+        conversion_errors = []
+        def audio_chunks():
+            try:
+                yield from audio_converter.stream_wav(audio_file.read(), max_duration=SPEECH_MAX_DURATION)
+            except Exception as e:
+                conversion_errors.append(e)
+                raise
 
-        # Make the POST request
-        response = requests.post(url, headers=headers, data=data)
+        try:
+            ## the body is a one-shot stream, so this call isn't retried
+            response = upstream["speech"].call(lambda: speech_session.post(url, headers=headers, data=audio_chunks(), timeout=SPEECH_TRANSCODE_TIMEOUT + 30), retry=False)
+        except Exception:
+            # report why the upload was cut short rather than the aborted request
+            if conversion_errors:
+                raise conversion_errors[0]
+            raise
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -1029,11 +1546,16 @@ def speech_to_text():
         else:
             logging.error(f"Request failed with status code: {response.status_code}")
             return jsonify({"error": f"Request failed with status code: {response.status_code}, text: {response}"}), 500
+    except AudioLimitError as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        # the upload isn't audio ffmpeg can read
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.exception("Exception in /audio/stt")
         return jsonify({"error": str(e)}), 500
 
-def generate_title(conversation_messages):
+def generate_title(conversation_messages, user_id=None):
     ## make sure the messages are sorted by _ts descending
     title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
 
@@ -1042,21 +1564,72 @@ def generate_title(conversation_messages):
 
     try:
         ## Submit prompt to Chat Completions for response
-        base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        openai.api_type = "azure"
-        openai.api_base = base_url
-        openai.api_version = "2023-03-15-preview"
-        openai.api_key = AZURE_OPENAI_KEY
-        completion = openai.ChatCompletion.create(    
-            engine=AZURE_OPENAI_MODEL,
-            messages=messages,
-            temperature=1,
-            max_tokens=64 
-        )
-        title = json.loads(completion['choices'][0]['message']['content'])['title']
+        def create(d):
+            completion = aoai_client(d).chat.completions.create(
+                model=d.model,
+                messages=messages,
+                temperature=1,
+                max_tokens=64
+            )
+            usage_ledger.record_usage(user_id, d.name, "title", completion.usage)
+            return completion
+        completion = run_on_pool("aoai", create)
+        title = json.loads(completion.choices[0].message.content)['title']
         return title
     except Exception as e:
-        return messages[-2]['content']
+        logging.error(f"Failed to generate a conversation title: {e}")
+        return None
+
+def provisional_title(conversation_messages):
+    ## the first user message, cut at a word boundary
+    content = " ".join(str(conversation_messages[-1].get('content', '')).split())
+    if len(content) <= CHAT_HISTORY_PROVISIONAL_TITLE_LENGTH:
+        return content
+    cut = content[:CHAT_HISTORY_PROVISIONAL_TITLE_LENGTH].rsplit(" ", 1)[0]
+    return (cut or content[:CHAT_HISTORY_PROVISIONAL_TITLE_LENGTH]) + "..."
+
+def update_generated_title(user_id, conversation_id, provisional, conversation_messages):
+    try:
+        title = generate_title(conversation_messages, user_id)
+        if not title or title == provisional:
+            return
+        ## a conditional title-only write: conversations that were deleted or renamed in the meantime are left alone,
+        ## and message writes that touched the conversation concurrently aren't overwritten
+        conversation_client.update_title(user_id, conversation_id, title, if_title=provisional)
+    except Exception as e:
+        logging.exception("Exception updating the conversation title")
+
+def warm_up_assistants():
+    try:
+        assistants.warm_up(aoai_client(aoai_pool.primary), aoai_pool.primary.model)
+    except Exception as e:
+        logging.exception("Exception in assistant warm-up")
+
+def delete_expired_assistant_thread(assistant_type, thread_id):
+    assistants.delete_thread(aoai_client(aoai_pool.primary), thread_id)
+
+# Background work is started by a worker's first request rather than at import, so it runs in the
+# worker process (threads started before uwsgi forks the workers don't survive the fork)
+background_work_started = False
+background_work_lock = threading.Lock()
+
+@app.before_request
+def start_background_work():
+    global background_work_started
+    if background_work_started:
+        return
+    with background_work_lock:
+        if background_work_started:
+            return
+        background_work_started = True
+
+    # Resolve the assistant definitions so the first assistant request doesn't pay for it
+    if ASSISTANT_WARM_UP.lower() == "true" and AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_MODEL:
+        threading.Thread(target=warm_up_assistants, name="assistant-warm-up", daemon=True).start()
+
+    # Delete the remote threads of idle or evicted (user, assistant) pairs; one worker on the machine does the sweeping
+    if AZURE_OPENAI_ENDPOINT:
+        assistants.thread_registry.start_sweeper(delete_expired_assistant_thread, assistants.ASSISTANT_THREAD_SWEEP_INTERVAL)
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -1,18 +1,30 @@
+import hashlib
 import io
 import json
 import os
+import threading
 import time
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 from typing import Iterable, Optional
 
-from openai import AzureOpenAI
+from openai import AzureOpenAI, NotFoundError
+from openai.types.beta.assistant import Assistant
 from openai.types.beta.threads.message_content_image_file import MessageContentImageFile
 from openai.types.beta.threads.message_content_text import MessageContentText
 from openai.types.beta.threads.messages import MessageFile
 from PIL import Image
-from flask import jsonify
+from flask import Response, jsonify
+from requests.adapters import HTTPAdapter
+
+from backend.aoai.usageledger import UsageLedger
+from backend.assistants.assistantindex import AssistantIndex
+from backend.assistants.jobs import AssistantJobs
+from backend.assistants.threadregistry import ThreadRegistry
+from backend.cache import TTLCache, SingleFlight
+from backend.resilience import Resilience
 
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
@@ -21,26 +33,142 @@ if DEBUG_LOGGING:
     logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
+# Assistant run polling settings
+ASSISTANT_RUN_TIMEOUT = float(os.environ.get("ASSISTANT_RUN_TIMEOUT", 120))
+ASSISTANT_POLL_INITIAL_WAIT = float(os.environ.get("ASSISTANT_POLL_INITIAL_WAIT", 0.1))
+ASSISTANT_POLL_MAX_WAIT = float(os.environ.get("ASSISTANT_POLL_MAX_WAIT", 2.0))
+
+# Page size used to read back the messages of a run
+ASSISTANT_MESSAGES_PAGE_SIZE = int(os.environ.get("ASSISTANT_MESSAGES_PAGE_SIZE", 10))
+
+# Assistant tool call settings
+ASSISTANT_TOOL_TIMEOUT = float(os.environ.get("ASSISTANT_TOOL_TIMEOUT", 30))
+ASSISTANT_TOOL_MAX_WORKERS = int(os.environ.get("ASSISTANT_TOOL_MAX_WORKERS", 8))
+
+# Google Search tool settings
+AZURE_GOOGLE_SEARCH_CACHE_TTL = float(os.environ.get("AZURE_GOOGLE_SEARCH_CACHE_TTL", 900))
+AZURE_GOOGLE_SEARCH_CACHE_SIZE = int(os.environ.get("AZURE_GOOGLE_SEARCH_CACHE_SIZE", 1024))
+AZURE_GOOGLE_SEARCH_MAX_SNIPPET_LENGTH = int(os.environ.get("AZURE_GOOGLE_SEARCH_MAX_SNIPPET_LENGTH", 300))
+
+# Assistant definition index settings
+ASSISTANT_INDEX_PATH = os.environ.get("ASSISTANT_INDEX_PATH", "data/assistants.db")
+
+# Assistant background job settings
+ASSISTANT_JOBS_PATH = os.environ.get("ASSISTANT_JOBS_PATH", "data/assistant_jobs.db")
+ASSISTANT_JOB_MAX_WORKERS = int(os.environ.get("ASSISTANT_JOB_MAX_WORKERS", 4))
+ASSISTANT_JOB_MAX_PENDING = int(os.environ.get("ASSISTANT_JOB_MAX_PENDING", 32))
+ASSISTANT_JOB_TTL = float(os.environ.get("ASSISTANT_JOB_TTL", 3600))
+ASSISTANT_JOB_LEASE = float(os.environ.get("ASSISTANT_JOB_LEASE", 60))
+
+# Upstream call resilience settings, shared with app.py
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", 3))
+UPSTREAM_BACKOFF_BASE = float(os.environ.get("UPSTREAM_BACKOFF_BASE", 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.environ.get("UPSTREAM_BACKOFF_MAX", 8))
+UPSTREAM_BREAKER_THRESHOLD = int(os.environ.get("UPSTREAM_BREAKER_THRESHOLD", 5))
+UPSTREAM_BREAKER_RESET = float(os.environ.get("UPSTREAM_BREAKER_RESET", 30))
+UPSTREAM_HEDGING = os.environ.get("UPSTREAM_HEDGING", "false").lower() == "true"
+
+# Token usage ledger settings, shared with app.py
+USAGE_LEDGER_PATH = os.environ.get("USAGE_LEDGER_PATH", "data/usage_ledger.ndjson")
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 30))
+USAGE_RETENTION_DAYS = int(os.environ.get("USAGE_RETENTION_DAYS", 90)) # 0 keeps every day
+
+# Assistant thread registry settings
+ASSISTANT_THREADS_PATH = os.environ.get("ASSISTANT_THREADS_PATH", "data/assistant_threads.db")
+ASSISTANT_THREAD_TTL = float(os.environ.get("ASSISTANT_THREAD_TTL", 86400))
+ASSISTANT_THREAD_MAX_ENTRIES = int(os.environ.get("ASSISTANT_THREAD_MAX_ENTRIES", 10000))
+ASSISTANT_THREAD_SWEEP_INTERVAL = float(os.environ.get("ASSISTANT_THREAD_SWEEP_INTERVAL", 300))
+
 # define a dictionary to map with assistant name and assistant object
 assistant_types = { 'web', 'math', 'dalle' }
 personal_assistants = {}
 
-# define a dictionary to map with assistant name, user_id and thread_id, the assistant_name and user_id are the key
-personal_assistant_threads = {}
+# retries, circuit breakers and hedging for every upstream service, by name
+upstream = Resilience(max_attempts=UPSTREAM_MAX_ATTEMPTS, base_delay=UPSTREAM_BACKOFF_BASE, max_delay=UPSTREAM_BACKOFF_MAX,
+                      failure_threshold=UPSTREAM_BREAKER_THRESHOLD, reset_timeout=UPSTREAM_BREAKER_RESET, hedging=UPSTREAM_HEDGING)
 
-def conversation_internal_with_assistant(client : AzureOpenAI, request_body : any, assistant_type : str, user_id : str, deployment_model : str) :
-    # retrieve the assistant or create a new one
-    global personal_assistants
-    
+# per-user token usage of every completion path
+usage_ledger = UsageLedger(USAGE_LEDGER_PATH, flush_interval=USAGE_FLUSH_INTERVAL, retention_days=USAGE_RETENTION_DAYS)
+
+# name -> assistant id index shared by the worker processes on this machine
+assistant_index = AssistantIndex(ASSISTANT_INDEX_PATH)
+
+# background runs for clients that ask for a job id instead of waiting on the request
+assistant_jobs = AssistantJobs(ASSISTANT_JOBS_PATH, max_workers=ASSISTANT_JOB_MAX_WORKERS, max_pending=ASSISTANT_JOB_MAX_PENDING,
+                               ttl=ASSISTANT_JOB_TTL, stream_timeout=ASSISTANT_RUN_TIMEOUT + 60, lease=ASSISTANT_JOB_LEASE)
+
+# (user_id, assistant type) -> thread_id registry shared by the worker processes on this machine
+thread_registry = ThreadRegistry(ASSISTANT_THREADS_PATH, ttl=ASSISTANT_THREAD_TTL, max_entries=ASSISTANT_THREAD_MAX_ENTRIES)
+
+def conversation_internal_with_assistant(client : AzureOpenAI, request_body : any, assistant_type : str, user_id : str, deployment_model : str, stream : bool = False, image_store = None) :
     try:
-        assistant = personal_assistants.get(assistant_type)
-        if assistant is None:
-            assistant = retrieve_and_create_assistant(client, assistant_type, deployment_model)
-            personal_assistants[assistant_type] = assistant
+        thread_id, run = start_run(client, request_body, assistant_type, user_id, deployment_model)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        # Handle error appropriately
+        return jsonify({"error": str(e)}), 500
+
+    history_metadata = request_body.get("history_metadata", {})
+    try:
+        logging.error(f"processing ...")
+        prompt = request_body["messages"][-1]["content"]
+        if stream:
+            return Response(stream_run(client, thread_id, run, history_metadata,
+                                       on_complete=lambda completed, text: record_run_usage(user_id, completed, prompt, text),
+                                       image_store=image_store),
+                            mimetype='text/event-stream')
+
+        # poll the run till completion
+        run = poll_run_till_completion(client, thread_id, run.id, assistant_tools,
+                                       timeout=ASSISTANT_RUN_TIMEOUT, initial_wait=ASSISTANT_POLL_INITIAL_WAIT, max_wait=ASSISTANT_POLL_MAX_WAIT)
+
+        # retrieve and print messages
+        return retrieve_messages_and_respond(client, thread_id, run.id, history_metadata,
+                                             on_complete=lambda text: record_run_usage(user_id, run, prompt, text),
+                                             image_store=image_store)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         # Handle error appropriately
         return jsonify({"error": str(e)}), 500
+
+def submit_assistant_job(client : AzureOpenAI, request_body : any, assistant_type : str, user_id : str, deployment_model : str, image_store = None) :
+    """
+    Start the assistant run on the job executor instead of the request thread
+
+    @return: Flask response with the job id, or 503 when too many jobs are in progress
+
+    """
+    def run_job():
+        try:
+            thread_id, run = start_run(client, request_body, assistant_type, user_id, deployment_model)
+        except Exception as e:
+            logging.error(f"An error occurred: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        prompt = request_body["messages"][-1]["content"]
+        yield from stream_run(client, thread_id, run, request_body.get("history_metadata", {}),
+                              on_complete=lambda completed, text: record_run_usage(user_id, completed, prompt, text),
+                              image_store=image_store)
+
+    job_id = assistant_jobs.submit(user_id, run_job)
+    if job_id is None:
+        return jsonify({"error": "Too many assistant runs in progress, try again later"}), 503
+    return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+def start_run(client : AzureOpenAI, request_body : any, assistant_type : str, user_id : str, deployment_model : str) :
+    """
+    Post the latest user message to the user's thread for the assistant type and start a run
+
+    @return: Thread ID and the created run
+
+    """
+    # retrieve the assistant or create a new one
+    global personal_assistants
+
+    assistant = personal_assistants.get(assistant_type)
+    if assistant is None:
+        assistant = retrieve_and_create_assistant(client, assistant_type, deployment_model)
+        personal_assistants[assistant_type] = assistant
     
     # get the user messages and history metadata
     request_messages = request_body["messages"]
@@ -56,66 +184,78 @@ def conversation_internal_with_assistant(client : AzureOpenAI, request_body : an
     logging.error(f"history_metadata: {history_metadata}")
 
     # retrieve the assistant thread or create a new one
-    global personal_assistant_threads
-
-    try:
-        # get thread_id from assistant_type and user_id
-        newThread = True
-        if user_id in personal_assistant_threads and assistant_type in personal_assistant_threads[user_id]:
-            thread_id = personal_assistant_threads[user_id][assistant_type]
-            newThread = False
-        else:
-            thread_id = None
-            logging.error(f"No existing thread found by {user_id} for {assistant_type}")
+    # get thread_id from assistant_type and user_id
+    thread_id = thread_registry.get(user_id, assistant_type)
+    if thread_id is None:
+        logging.error(f"No existing thread found by {user_id} for {assistant_type}")
 
-        if thread_id is not None and len(request_messages) == 1:
-            # delete the old thread
-            client.beta.threads.delete(thread_id)
-            newThread = True
-            logging.error(f"Deleted the old thread: {thread_id}")
+    if thread_id is None or len(request_messages) == 1:
+        thread_id = start_thread(client, user_id, assistant_type)
 
-        if newThread:
-            thread = client.beta.threads.create()
-            thread_id = thread.id
-            personal_assistant_threads[user_id] = { assistant_type: thread_id }
+    logging.error(f"thread_id: {thread_id}")
 
-            logging.error(f"Created a new thread: {thread_id}")
+    # create a new message in the assistant thread
+    client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
 
-        logging.error(f"thread_id: {thread_id}")
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        # Handle error appropriately
-        return jsonify({"error": str(e)}), 500
+    logging.error(f"Instruction {assistant.instructions}")
 
+    # create a new run in the assistant thread
     try:
-        # create a new message in the assistant thread
-        client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
-
-        logging.error(f"Instruction {assistant.instructions}")
-
-        # create a new run in the assistant thread
         run = client.beta.threads.runs.create(
             assistant_id=assistant.id,
             thread_id=thread_id,
             instructions=assistant.instructions
         )
+    except NotFoundError:
+        # the indexed assistant was deleted remotely; resolve it again and retry once
+        logging.error(f"Assistant {assistant.id} no longer exists, resolving {assistant_type} again")
+        assistant_index.remove(assistant.name)
+        assistant = retrieve_and_create_assistant(client, assistant_type, deployment_model)
+        personal_assistants[assistant_type] = assistant
+        run = client.beta.threads.runs.create(
+            assistant_id=assistant.id,
+            thread_id=thread_id,
+            instructions=assistant.instructions
+        )
+    return thread_id, run
+    
+def start_thread(client : AzureOpenAI, user_id : str, assistant_type : str, attempts : int = 3) -> str:
+    """
+    Create a new thread and register it in place of the user's old (or expired) one.
+    When a concurrent request registered its thread first, ours is deleted and theirs
+    is used, so no remote thread is left without a registry entry for the sweeper
 
-        logging.error(f"processing ...")
-        available_functions = {"search_google": google_search}
-
-        # poll the run till completion
-        poll_run_till_completion(client, thread_id, run.id, available_functions, 10, 3)
+    @return: Thread ID
+    """
+    for _ in range(attempts):
+        old_thread_id = thread_registry.peek(user_id, assistant_type)
+        thread = client.beta.threads.create()
+        if thread_registry.replace(user_id, assistant_type, old_thread_id, thread.id):
+            logging.error(f"Created a new thread: {thread.id}")
+            if old_thread_id is not None:
+                delete_thread(client, old_thread_id)
+                logging.error(f"Deleted the old thread: {old_thread_id}")
+            return thread.id
+
+        delete_thread(client, thread.id)
+        thread_id = thread_registry.get(user_id, assistant_type)
+        if thread_id is not None:
+            return thread_id
+    raise Exception(f"Could not register a thread for {assistant_type}")
+
+def delete_thread(client : AzureOpenAI, thread_id : str) -> None:
+    """
+    Delete an assistant thread, treating a thread that is already gone as deleted
 
-        # retrieve and print messages
-        return retrieve_messages_and_respond(client, thread_id, history_metadata)
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        # Handle error appropriately
-        return jsonify({"error": str(e)}), 500
-    
-def retrieve_and_create_assistant(client : AzureOpenAI, assistant_type : str, deployment_model : str) :
-    logging.error(f"assistant_type: {assistant_type}")
+    @param client: OpenAI client
+    @param thread_id: Thread ID
+    """
+    try:
+        client.beta.threads.delete(thread_id)
+    except NotFoundError:
+        pass
 
+def assistant_definition(assistant_type : str) -> dict:
     if assistant_type == "math":
         assistant_name = "Math Tutor"
         assistant_instructions = "You are a personal math tutor. Write and run code to answer math questions."
@@ -145,140 +285,456 @@ def retrieve_and_create_assistant(client : AzureOpenAI, assistant_type : str, de
                 },
             }
         ]
+    else:
+        raise Exception(f"No assistant is defined for assistant type {assistant_type}")
 
-    # retrieve assistants and find the assistant
-    assistants = client.beta.assistants.list()
-    assistant = None
+    return {"name": assistant_name, "instructions": assistant_instructions, "tools": tools}
 
-    for a in assistants:
-        if a.name == assistant_name:
-            assistant = a
-            break
+def definition_hash(definition : dict, deployment_model : str) -> str:
+    canonical = json.dumps(dict(definition, model=deployment_model), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
-    if assistant is None:
-        assistant = client.beta.assistants.create(
-            name=assistant_name,
-            instructions=assistant_instructions,
-            tools=tools,
-            model=deployment_model,
-        )
-        logging.debug(f"{assistant_name}: {assistant}")
-    else:
-        logging.debug(f"{assistant_name} already exists: {assistant}")
+def indexed_assistant(assistant_id : str, definition : dict, deployment_model : str, expected_hash : str) -> Assistant:
+    # the definition hash matches, so the definition holds everything the remote assistant would return
+    return Assistant.construct(id=assistant_id, object="assistant", name=definition["name"], instructions=definition["instructions"],
+                               tools=definition["tools"], model=deployment_model, metadata={"definition_hash": expected_hash})
+
+def retrieve_and_create_assistant(client : AzureOpenAI, assistant_type : str, deployment_model : str) :
+    logging.error(f"assistant_type: {assistant_type}")
+
+    definition = assistant_definition(assistant_type)
+    assistant_name = definition["name"]
+    expected_hash = definition_hash(definition, deployment_model)
+
+    with assistant_index.resolving():
+        # an assistant this machine wrote from the same definition needs no round-trip at all
+        assistant = None
+        entry = assistant_index.get(assistant_name)
+        if entry is not None and entry[1] == expected_hash:
+            return indexed_assistant(entry[0], definition, deployment_model, expected_hash)
+
+        # otherwise look it up by id when this machine has resolved it before
+        if entry is not None:
+            try:
+                assistant = client.beta.assistants.retrieve(entry[0])
+            except Exception as e:
+                logging.error(f"Indexed assistant {assistant_name} ({entry[0]}) could not be retrieved: {e}")
+                assistant_index.remove(assistant_name)
+
+        # otherwise retrieve assistants and find the assistant
+        if assistant is None:
+            for a in client.beta.assistants.list():
+                if a.name == assistant_name:
+                    assistant = a
+                    break
+
+        if assistant is None:
+            assistant = client.beta.assistants.create(
+                name=assistant_name,
+                instructions=definition["instructions"],
+                tools=definition["tools"],
+                model=deployment_model,
+                metadata={"definition_hash": expected_hash},
+            )
+            logging.debug(f"{assistant_name}: {assistant}")
+        elif (assistant.metadata or {}).get("definition_hash") != expected_hash:
+            # instructions, tools or model changed since the assistant was last written
+            assistant = client.beta.assistants.update(
+                assistant.id,
+                instructions=definition["instructions"],
+                tools=definition["tools"],
+                model=deployment_model,
+                metadata=dict(assistant.metadata or {}, definition_hash=expected_hash),
+            )
+            logging.debug(f"{assistant_name} updated: {assistant}")
+        else:
+            logging.debug(f"{assistant_name} already exists: {assistant}")
+
+        assistant_index.put(assistant_name, assistant.id, expected_hash)
 
     return assistant
 
-def poll_run_till_completion(
+def warm_up(client : AzureOpenAI, deployment_model : str) -> None:
+    """
+    Resolve every assistant definition ahead of the first request
+
+    @param client: OpenAI client
+    @param deployment_model: Model deployment the assistants run on
+
+    """
+    for assistant_type in assistant_types:
+        if assistant_type == "dalle" or assistant_type in personal_assistants:
+            continue
+        try:
+            personal_assistants[assistant_type] = retrieve_and_create_assistant(client, assistant_type, deployment_model)
+        except Exception as e:
+            logging.error(f"Failed to warm up the {assistant_type} assistant: {e}")
+
+def poll_run(
     client: AzureOpenAI,
     thread_id: str,
     run_id: str,
     available_functions: dict,
-    max_steps: int = 10,
-    wait: int = 3,
-) -> None:
+    timeout: float = 120,
+    initial_wait: float = 0.1,
+    max_wait: float = 2.0,
+    backoff: float = 2.0,
+) -> Iterable:
     """
-    Poll a run until it is completed or failed or exceeds a certain number of iterations (MAX_STEPS)
-    with a preset wait in between polls
+    Poll a run until it is completed or failed, starting with a short wait between polls
+    and backing off exponentially up to max_wait, until the wall-clock timeout expires.
+    Yields the run after every poll; a run that requires action is yielded before its
+    tool calls are executed, and the completed run is yielded last
 
     @param client: OpenAI client
     @param thread_id: Thread ID
     @param run_id: Run ID
-    @param assistant_id: Assistant ID
-    @param max_steps: Maximum number of steps to poll
-    @param wait: Wait time in seconds between polls
+    @param available_functions: AssistantTools the run may call, by name
+    @param timeout: Seconds the run may take before it is cancelled
+    @param initial_wait: Wait time in seconds before the second poll
+    @param max_wait: Upper bound for the wait time between polls
+    @param backoff: Factor the wait time grows by after each poll
+    @return: Iterator over the polled runs
 
     """
 
     if (client is None and thread_id is None) or run_id is None:
         if DEBUG_LOGGING: logging.error("Client, Thread ID and Run ID are required.")
         raise Exception("Client, Thread ID and Run ID are required.")
-   
+
+    deadline = time.monotonic() + timeout
+    wait = initial_wait
     cnt = 0
-    while cnt < max_steps:
+    while True:
         run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        
+
         logging.error(f"Poll {cnt}: {run.status}")
         cnt += 1
         if run.status == "requires_action":
+            yield run
             tool_responses = []
             if (
                 run.required_action.type == "submit_tool_outputs"
                 and run.required_action.submit_tool_outputs.tool_calls is not None
             ):
                 tool_calls = run.required_action.submit_tool_outputs.tool_calls
-
-                for call in tool_calls:
-                    if call.type == "function":
-                        if call.function.name not in available_functions:
-                            raise Exception("Function requested by the model does not exist")
-                        function_to_call = available_functions[call.function.name]
-                        tool_response = function_to_call(**json.loads(call.function.arguments))
-                        tool_responses.append({"tool_call_id": call.id, "output": tool_response})
+                tool_responses = execute_tool_calls(tool_calls, available_functions)
 
             run = client.beta.threads.runs.submit_tool_outputs(
                 thread_id=thread_id, run_id=run.id, tool_outputs=tool_responses
             )
-        if run.status == "failed":
-            if DEBUG_LOGGING: logging.error("Run failed.")
-            raise Exception("Run failed.")
+            # the run picks up again right away, so go back to polling quickly
+            wait = initial_wait
+        if run.status in ("failed", "cancelled", "expired"):
+            if DEBUG_LOGGING: logging.error(f"Run {run.status}.")
+            raise Exception(f"Run {run.status}.")
+        yield run
         if run.status == "completed":
             logging.error("Run completed.")
-            break
+            return
+        if time.monotonic() + wait > deadline:
+            # don't leave the run going (and holding the thread) once nobody is waiting for it
+            cancel_run(client, thread_id, run_id)
+            raise Exception(f"Run did not complete within {timeout} seconds.")
         time.sleep(wait)
+        wait = min(max_wait, wait * backoff)
 
-def retrieve_messages_and_respond(
-    client: AzureOpenAI, thread_id: str, history_metadata: dict
-) -> any:
+def poll_run_till_completion(client: AzureOpenAI, thread_id: str, run_id: str, available_functions: dict, **kwargs) -> any:
     """
-    Retrieve a list of messages in a thread and print it out with the query and response
+    Poll a run until it is completed, see poll_run for the keyword arguments
+
+    @return: The completed run
+
+    """
+    for run in poll_run(client, thread_id, run_id, available_functions, **kwargs):
+        pass
+    return run
+
+def cancel_run(client: AzureOpenAI, thread_id: str, run_id: str) -> None:
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logging.error(f"Failed to cancel run {run_id}: {e}")
+
+def record_run_usage(user_id: str, run, prompt: str, completion_text: str) -> None:
+    # runs report usage on newer API versions; otherwise the ledger estimates it from the user message and the reply
+    usage_ledger.record_usage(user_id, run.model, "assistant", getattr(run, "usage", None),
+                              prompt_messages=[{"role": "user", "content": prompt}], completion_text=completion_text)
+
+def stream_run(client: AzureOpenAI, thread_id: str, run, history_metadata: dict, on_complete=None, image_store=None) -> Iterable[str]:
+    """
+    Poll a run and stream it as NDJSON frames shaped like the chat completion frames:
+    status frames carry an "assistant_status" and no messages, text frames carry the
+    content of each assistant message as soon as the run step that wrote it completes
 
     @param client: OpenAI client
     @param thread_id: Thread ID
-    @param verbose: Print verbose output
-    @param out_dir: Output directory to save images
-    @return: Messages object
+    @param run: The created run
+    @param history_metadata: History metadata to echo back
+    @param on_complete: Called with the completed run and its text once the run completes
+    @param image_store: ImageStore that keeps the images the run produces
+    @return: Iterator over NDJSON lines
 
     """
 
-    if client is None and thread_id is None:
-        print("Client and Thread ID are required.")
-        raise Exception("Client and Thread ID are required.")
-    
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
+    def frame(messages, status=None):
+        response_obj = {
+            "id": run.id,
+            "model": run.model,
+            "created": run.created_at,
+            "object": "thread.run",
+            "choices": [{
+                "messages": messages
+            }],
+            "history_metadata": history_metadata
+        }
+        if status is not None:
+            response_obj["assistant_status"] = status
+        return json.dumps(response_obj, ensure_ascii=False) + "\n"
+
+    seen_steps = set()
+    sent_messages = 0
+    sent_text = []
+
+    def new_step_frames():
+        nonlocal sent_messages
+        for step in client.beta.threads.runs.steps.list(thread_id=thread_id, run_id=run.id, order="asc", limit=ASSISTANT_MESSAGES_PAGE_SIZE):
+            if step.id in seen_steps:
+                continue
+            if step.type == "tool_calls":
+                # announce tool calls once, as soon as the step lists them
+                tools = [call.function.name if call.type == "function" else call.type for call in step.step_details.tool_calls]
+                if tools:
+                    seen_steps.add(step.id)
+                    yield frame([], {"status": "tool_calls", "tools": tools})
+            elif step.status == "completed":
+                seen_steps.add(step.id)
+                message = client.beta.threads.messages.retrieve(thread_id=thread_id, message_id=step.step_details.message_creation.message_id)
+                content = render_message_content(client, message, image_store)
+                if sent_messages:
+                    content = "\n\n" + content
+                sent_messages += 1
+                sent_text.append(content)
+                yield frame([{"role": "assistant", "content": content}])
+
+    completed = False
+    try:
+        yield frame([], {"status": run.status})
+        last_status = run.status
+        for polled in poll_run(client, thread_id, run.id, assistant_tools,
+                               timeout=ASSISTANT_RUN_TIMEOUT, initial_wait=ASSISTANT_POLL_INITIAL_WAIT, max_wait=ASSISTANT_POLL_MAX_WAIT):
+            if polled.status != last_status:
+                last_status = polled.status
+                yield frame([], {"status": polled.status})
+            if polled.status != "queued":
+                yield from new_step_frames()
+        completed = True
+        if on_complete:
+            on_complete(polled, "".join(sent_text))
+        if not sent_messages:
+            raise Exception(f"Run {run.id} didn't add any assistant messages.")
+    except GeneratorExit:
+        # the client went away; stop the run instead of letting it finish for nobody
+        if not completed:
+            cancel_run(client, thread_id, run.id)
+        raise
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        yield json.dumps({"error": str(e)}) + "\n"
 
-    for message in messages:
-        if message.role == "assistant":
+class AssistantTool():
+    """
+    A function the assistants may call. Tools that are safe to run concurrently are
+    executed in parallel with the other calls of the same run step.
+    """
+
+    def __init__(self, name: str, function, concurrent_safe: bool = True, timeout: float = ASSISTANT_TOOL_TIMEOUT):
+        self.name = name
+        self.function = function
+        self.concurrent_safe = concurrent_safe
+        self.timeout = timeout
+
+    def __call__(self, **kwargs):
+        return self.function(**kwargs)
+
+# define a dictionary to map with tool name and the AssistantTool the assistants may call
+assistant_tools = {}
+
+def register_tool(name: str, function, concurrent_safe: bool = True, timeout: float = ASSISTANT_TOOL_TIMEOUT) -> AssistantTool:
+    tool = AssistantTool(name, function, concurrent_safe, timeout)
+    assistant_tools[name] = tool
+    return tool
+
+def tool_error(message: str) -> str:
+    return json.dumps({"error": message})
+
+class ToolCallFuture():
+    """
+    A tool call submitted to an executor. Its timeout counts from when the call starts
+    running, not from when it was queued. A call that hasn't started by then is cancelled.
+    A running call can't be interrupted, so it is left to finish on its own.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, tool: AssistantTool, call):
+        self.tool = tool
+        self.call = call
+        self.started = threading.Event()
+        self.started_at = None
+        self.future = executor.submit(self._invoke)
+
+    def _invoke(self):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return self.tool(**json.loads(self.call.function.arguments))
+
+    def result(self):
+        if not self.started.wait(self.tool.timeout):
+            self.future.cancel()
+            raise FutureTimeoutError()
+        return self.future.result(timeout=max(0, self.started_at + self.tool.timeout - time.monotonic()))
+
+def execute_tool_calls(tool_calls: list, available_tools: dict) -> list:
+    """
+    Execute the tool calls of one run step, concurrently where the tools allow it
+
+    @param tool_calls: Tool calls from the run's required action
+    @param available_tools: AssistantTools by name
+    @return: Tool outputs in the order of the calls; failures and timeouts become error outputs
+
+    """
+
+    outputs = {}
+    concurrent_calls = []
+    serial_calls = []
+    for call in tool_calls:
+        if call.type != "function":
+            continue
+        tool = available_tools.get(call.function.name)
+        if tool is None:
+            outputs[call.id] = tool_error(f"Function {call.function.name} does not exist")
+        elif tool.concurrent_safe:
+            concurrent_calls.append((call, tool))
+        else:
+            serial_calls.append((call, tool))
+
+    # every run step gets executors of its own, so its calls never queue behind another run's
+    executors = []
+    pending = []
+    if concurrent_calls:
+        executors.append(ThreadPoolExecutor(max_workers=min(ASSISTANT_TOOL_MAX_WORKERS, len(concurrent_calls)), thread_name_prefix="assistant-tool"))
+        pending = [ToolCallFuture(executors[-1], tool, call) for call, tool in concurrent_calls]
+    try:
+        # a single worker runs the tools that aren't safe to run concurrently, so each one only
+        # starts once the previous one has returned, even if that one timed out
+        if serial_calls:
+            executors.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix="assistant-tool-serial"))
+            for call, tool in serial_calls:
+                collect_tool_output(ToolCallFuture(executors[-1], tool, call), outputs)
+        for tool_call in pending:
+            collect_tool_output(tool_call, outputs)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return [{"tool_call_id": call.id, "output": outputs[call.id]} for call in tool_calls if call.id in outputs]
+
+def collect_tool_output(tool_call: ToolCallFuture, outputs: dict) -> None:
+    call, tool = tool_call.call, tool_call.tool
+    try:
+        output = tool_call.result()
+        outputs[call.id] = output if isinstance(output, str) else json.dumps(output)
+    except FutureTimeoutError:
+        logging.error(f"Tool call {call.function.name} timed out after {tool.timeout} seconds")
+        outputs[call.id] = tool_error(f"{call.function.name} timed out after {tool.timeout} seconds")
+    except Exception as e:
+        logging.error(f"Tool call {call.function.name} failed: {e}")
+        outputs[call.id] = tool_error(f"{call.function.name} failed: {e}")
+
+def list_run_messages(client: AzureOpenAI, thread_id: str, run_id: str, limit: int = ASSISTANT_MESSAGES_PAGE_SIZE) -> list:
+    """
+    List the assistant messages a run added to a thread, oldest first, reading the
+    thread newest first and stopping at the first message the run didn't write
+
+    @param client: OpenAI client
+    @param thread_id: Thread ID
+    @param run_id: Run ID
+    @param limit: Page size of the message listing
+    @return: List of messages
+
+    """
+    run_messages = []
+    # the page iterator only fetches the next page when the run wrote more than a page of messages
+    for message in client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=limit):
+        if message.run_id != run_id:
             break
+        if message.role == "assistant":
+            run_messages.append(message)
+    run_messages.reverse()
+    return run_messages
+
+def render_message_content(client: AzureOpenAI, message, image_store=None) -> str:
+    """
+    Render the text and image content of an assistant message as markdown/html
+
+    @param client: OpenAI client
+    @param message: Thread message
+    @param image_store: ImageStore that keeps image content; images are left out without one
+    @return: Rendered content
 
+    """
     assistantContent = ""
     for item in message.content:
         # Determine the content type
         if isinstance(item, MessageContentText):
             logging.error(f"{message.role}:\n{item.text.value}\n")
             assistantContent += item.text.value
-        elif isinstance(item, MessageContentImageFile):
-            # Retrieve image from file id
-            response_content = client.files.content(item.image_file.file_id)
-            data_in_bytes = response_content.read()
-
-            # save image to file
-            with open(f"./images/{thread_id}.jpg", "wb") as img_file:
-                img_file.write(data_in_bytes)
-
-            logging.error(f"Image saved to file: ./images/{thread_id}.jpg")
-            
-            assistantContent += f"<img src=\"./images/{thread_id}.jpg\" alt=\"Example image\" width=\"100%\" height=\"auto\" display=\"block\" />"
+        elif isinstance(item, MessageContentImageFile) and image_store is not None:
+            # download the image (unless it is already cached) and show its thumbnail, linked to the full image
+            image_name, thumbnail_name = image_store.save_file(client, item.image_file.file_id)
+
+            logging.error(f"Image saved to file: {image_store.directory}/{image_name}")
+
+            assistantContent += f"<a href=\"./images/{image_name}\" target=\"_blank\"><img src=\"./images/{thumbnail_name}\" alt=\"Example image\" width=\"100%\" height=\"auto\" display=\"block\" /></a>"
+    return assistantContent
+
+def retrieve_messages_and_respond(
+    client: AzureOpenAI, thread_id: str, run_id: str, history_metadata: dict, on_complete=None, image_store=None
+) -> any:
+    """
+    Retrieve the assistant messages of a run and respond with them combined
+
+    @param client: OpenAI client
+    @param thread_id: Thread ID
+    @param run_id: Run ID
+    @param history_metadata: History metadata to echo back
+    @param on_complete: Called with the combined text of the messages
+    @param image_store: ImageStore that keeps the images of the messages
+    @return: Flask response
+
+    """
+
+    if client is None and thread_id is None:
+        print("Client and Thread ID are required.")
+        raise Exception("Client and Thread ID are required.")
+    
+    messages = list_run_messages(client, thread_id, run_id)
+    if not messages:
+        raise Exception(f"Run {run_id} didn't add any assistant messages.")
+
+    assistantContent = "\n\n".join(render_message_content(client, message, image_store) for message in messages)
     
     logging.error(f"Assistant:\n{assistantContent}\n")
+    if on_complete:
+        on_complete(assistantContent)
 
     response_obj = {
-        "id": message.id,
+        "id": messages[-1].id,
         "model": "gpt-3.5-turbo",
-        "created": message.created_at,
-        "object": message.object,
+        "created": messages[0].created_at,
+        "object": messages[-1].object,
         "choices": [{
             "messages": [{
-                "role": message.role,
+                "role": "assistant",
                 "content": assistantContent
             }]
         }],
@@ -287,14 +743,31 @@ def retrieve_messages_and_respond(
 
     return jsonify(response_obj), 200
 
+# pooled session, results cache and in-flight coalescing shared by every search_google call in this process
+google_search_session = requests.Session()
+google_search_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=ASSISTANT_TOOL_MAX_WORKERS))
+google_search_cache = TTLCache(maxsize=AZURE_GOOGLE_SEARCH_CACHE_SIZE, ttl=AZURE_GOOGLE_SEARCH_CACHE_TTL)
+google_search_flight = SingleFlight()
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
 def google_search(query: str) -> list:
     """
-    Perform a google search against the given query
+    Perform a google search against the given query, answering repeated queries from
+    the cache and sharing one request between identical concurrent queries
 
     @param query: Search query
     @return: List of search results
 
     """
+    key = normalize_query(query)
+    output = google_search_cache.get(key)
+    if output is None:
+        output = google_search_flight.do(key, lambda: fetch_google_results(key))
+    return output
+
+def fetch_google_results(query: str) -> str:
     search_url = "https://www.googleapis.com/customsearch/v1"
     search_engine_id = os.environ.get("AZURE_GOOGLE_SEARCH_ENGINE_ID")
     api_key = os.environ.get("AZURE_GOOGLE_SEARCH_KEY")
@@ -302,13 +775,19 @@ def google_search(query: str) -> list:
     params = {  "key": api_key,
                 "cx": search_engine_id,
                 "q": query}
-    response = requests.get(search_url, params=params)
+    response = upstream["google_search"].call(lambda: google_search_session.get(search_url, params=params, timeout=ASSISTANT_TOOL_TIMEOUT), idempotent=True)
+    response.raise_for_status()
 
     search_results = response.json()
 
     output = []
 
-    for result in search_results["items"]:
-        output.append({"title": result["title"], "link": result["link"], "snippet": result["snippet"]})
+    # keep snippets short, they end up in the run's prompt tokens
+    for result in search_results.get("items", []):
+        output.append({"title": result["title"], "link": result["link"], "snippet": result.get("snippet", "")[:AZURE_GOOGLE_SEARCH_MAX_SNIPPET_LENGTH]})
+
+    output = json.dumps(output)
+    google_search_cache.set(query, output)
+    return output
 
-    return json.dumps(output)
+register_tool("search_google", google_search, concurrent_safe=True)
@@ -0,0 +1,217 @@
+import json
+import threading
+import time
+
+import openai
+import requests
+
+## status codes that say "this deployment, right now" rather than "this request"
+UNAVAILABLE_STATUS_CODES = { 408, 429, 500, 502, 503, 504 }
+
+
+class Deployment():
+    """
+    One Azure OpenAI deployment of the pool, with the routing state kept for it.
+    """
+
+    def __init__(self, endpoint: str, model: str, weight: int = 1, key: str = None, name: str = None):
+        self.endpoint = endpoint if endpoint.endswith("/") else endpoint + "/"
+        self.model = model
+        self.weight = max(1, int(weight))
+        self.key = key
+        self.name = name or f"{self.endpoint}{model}"
+        self.outstanding = 0
+        self.health = 1.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.current_weight = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now):
+        return self.cooldown_until <= now
+
+
+class DeploymentUnavailable(Exception):
+    """
+    Raised by pool calls that got a throttled or failed HTTP response back, so the
+    pool can fail over to another deployment.
+    """
+
+    def __init__(self, status_code: int, retry_after: float = None, message: str = ""):
+        super().__init__(message or f"Deployment returned status code {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return None
+
+
+def check_response(response):
+    ## raise DeploymentUnavailable for a requests response the pool should fail over on
+    if response.status_code in UNAVAILABLE_STATUS_CODES:
+        raise DeploymentUnavailable(response.status_code, parse_retry_after(response.headers))
+    return response
+
+
+def unavailable_error(error):
+    ## returns (True, retry after) when error means the deployment should cool down, (False, None) otherwise
+    if isinstance(error, DeploymentUnavailable):
+        return True, error.retry_after
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code in UNAVAILABLE_STATUS_CODES:
+            return True, parse_retry_after(error.response.headers)
+        return False, None
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout)):
+        return True, None
+    return False, None
+
+
+class DeploymentPool():
+    """
+    Routes Azure OpenAI calls over a pool of equivalent deployments, either by smooth
+    weighted round-robin or by fewest outstanding requests per unit of weight.
+    Throttled or failing deployments lose health and sit out a cool-down (the
+    Retry-After when the service sends one), and the call fails over to the next.
+    Once every deployment has failed, the call waits for the first one to come back,
+    up to max_attempts calls in all; this is the only retry layer for pool calls.
+    """
+
+    def __init__(self, deployments: list, strategy: str = "round_robin", cooldown: float = 10, max_cooldown: float = 120,
+                 max_attempts: int = 3, max_wait: float = 30):
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment")
+        if strategy not in ("round_robin", "least_outstanding"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        names = [d.name for d in deployments]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            ## routing state and failover exclusions are keyed by name
+            raise ValueError(f"Deployment names must be unique: {', '.join(duplicates)}")
+        self.deployments = deployments
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: str, endpoint: str, model: str, key: str = None, **kwargs):
+        ## config is a JSON list of {"endpoint", "model", "weight", "key"}; without it the pool is the single configured deployment.
+        ## key belongs to the configured endpoint's resource, so only deployments there that bring no key of their own get it
+        endpoint = endpoint if endpoint.endswith("/") else endpoint + "/"
+        if config:
+            deployments = [Deployment(d["endpoint"], d.get("model", model), d.get("weight", 1), d.get("key"), d.get("name"))
+                           for d in json.loads(config)]
+            for deployment in deployments:
+                if deployment.key is None and deployment.endpoint == endpoint:
+                    deployment.key = key
+        else:
+            deployments = [Deployment(endpoint, model, key=key)]
+        return cls(deployments, **kwargs)
+
+    @property
+    def primary(self):
+        return self.deployments[0]
+
+    def acquire(self, exclude=()):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [d for d in self.deployments if d.name not in exclude]
+            if not candidates:
+                return None
+            available = [d for d in candidates if d.available(now)]
+            if not available:
+                ## everything is cooling down; the one that comes back first is the best bet
+                deployment = min(candidates, key=lambda d: d.cooldown_until)
+            elif self.strategy == "least_outstanding":
+                deployment = min(available, key=lambda d: ((d.outstanding + 1) / (d.weight * d.health), -d.weight))
+            else:
+                ## smooth weighted round-robin, with each weight scaled by the deployment's health
+                total = 0.0
+                for d in available:
+                    d.current_weight += d.weight * d.health
+                    total += d.weight * d.health
+                deployment = max(available, key=lambda d: d.current_weight)
+                deployment.current_weight -= total
+            deployment.outstanding += 1
+            deployment.requests += 1
+            return deployment
+
+    def release(self, deployment, error=None):
+        unavailable, retry_after = unavailable_error(error) if error is not None else (False, None)
+        with self._lock:
+            deployment.outstanding -= 1
+            if unavailable:
+                deployment.errors += 1
+                deployment.failures += 1
+                deployment.health = max(0.1, deployment.health * 0.5)
+                cooldown = retry_after if retry_after is not None else self.cooldown * 2 ** (deployment.failures - 1)
+                deployment.cooldown_until = time.monotonic() + min(cooldown, self.max_cooldown)
+            elif error is None:
+                deployment.failures = 0
+                deployment.health = min(1.0, deployment.health + 0.25)
+        return unavailable
+
+    def run(self, call, hold: bool = False):
+        """
+        Call call(deployment) on the routed deployment, failing over to the others while
+        deployments are throttled or unavailable. With hold, the deployment stays
+        acquired and (deployment, result) is returned; release it when the stream ends.
+        """
+        tried = set()
+        attempts = max(self.max_attempts, len(self.deployments))
+        for attempt in range(1, attempts + 1):
+            if len(tried) >= len(self.deployments):
+                ## every deployment failed this round; the next one is whichever comes out of its cool-down first
+                wait = self.next_available_in()
+                if wait > self.max_wait:
+                    raise error
+                time.sleep(wait)
+                tried.clear()
+            deployment = self.acquire(exclude=tried)
+            tried.add(deployment.name)
+            try:
+                result = call(deployment)
+            except Exception as e:
+                if not self.release(deployment, e) or attempt == attempts:
+                    raise
+                error = e
+                continue
+            if hold:
+                return deployment, result
+            self.release(deployment)
+            return result
+
+    def next_available_in(self):
+        with self._lock:
+            return max(0.0, min(d.cooldown_until for d in self.deployments) - time.monotonic())
+
+    def metrics(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'name': d.name,
+                'weight': d.weight,
+                'outstanding': d.outstanding,
+                'health': round(d.health, 2),
+                'cooling_down_seconds': round(max(0.0, d.cooldown_until - now), 1),
+                'requests': d.requests,
+                'errors': d.errors
+            } for d in self.deployments]
@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+## tokens added per chat message and to prime the reply, as in OpenAI's counting guide
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+## a low detail image, the cheapest an image part can be
+TOKENS_PER_IMAGE = 85
+## the ledger file is compacted once it holds this many more lines than there are distinct totals
+COMPACT_SLACK = 10000
+## days of usage kept; older days are skipped when the file is read and dropped when it is compacted
+RETENTION_DAYS = 90
+
+
+class TokenEstimator():
+    """
+    Estimates token counts for responses that come back without usage (streams).
+    Uses tiktoken when it is installed, and about four characters per token otherwise.
+    The encoding is loaded on first use (it may have to be downloaded), not at import.
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    if tiktoken is not None:
+                        try:
+                            self._encoding = tiktoken.get_encoding(self.encoding_name)
+                        except Exception as e:
+                            logging.error(f"Failed to load the {self.encoding_name} encoding, token counts will be approximate: {e}")
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self.encoding
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def count_messages(self, messages: list) -> int:
+        tokens = TOKENS_PER_REPLY
+        for message in messages or []:
+            tokens += TOKENS_PER_MESSAGE + self.count(message.get("role", ""))
+            content = message.get("content")
+            if isinstance(content, list):
+                for part in content:
+                    if part.get("type") == "image_url":
+                        tokens += TOKENS_PER_IMAGE
+                    else:
+                        tokens += self.count(part.get("text", ""))
+            else:
+                tokens += self.count(content if isinstance(content, str) else json.dumps(content or ""))
+        return tokens
+
+
+class UsageLedger():
+    """
+    Per-user token usage, by UTC day, deployment and source (chat, title, assistant, ...).
+
+    record() only puts the event on a queue, so it costs the request nothing measurable.
+    A background thread estimates the tokens of streamed responses, aggregates the events
+    in memory and appends the deltas to an NDJSON file every flush_interval seconds.
+
+    Every worker process appends to the same file, so totals are built from the file when
+    read (only the lines appended since the last read are parsed) plus this process's
+    unflushed deltas; other processes' deltas show up once they flush. The file is
+    compacted to one line per total once it has grown well past that. Days older than
+    retention_days (0 keeps everything) are left out of the totals and the compacted file.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 30, max_queue: int = 100000, estimator: TokenEstimator = None,
+                 compact_slack: int = COMPACT_SLACK, retention_days: int = RETENTION_DAYS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_slack = compact_slack
+        self.retention_days = retention_days
+        self.estimator = estimator or TokenEstimator()
+        self._queue = queue.Queue(maxsize=max_queue)
+        ## (day, user_id, deployment, source) -> counters, as read from the file and as recorded here but not flushed yet
+        self._totals = {}
+        self._pending = {}
+        ## how far the file has been read: (device, inode) of the file, byte offset and line count
+        self._file_id = None
+        self._offset = 0
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.recorded = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.compactions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._thread.start()
+
+    def record(self, user_id: str, deployment: str, source: str, prompt_tokens: int = None, completion_tokens: int = None,
+               prompt_messages: list = None, completion_text: str = None):
+        ## counts the service reported win; otherwise they are estimated from the messages and text off the request path
+        try:
+            self._queue.put_nowait((time.time(), user_id or "anonymous", deployment or "", source,
+                                    prompt_tokens, completion_tokens, prompt_messages, completion_text))
+        except queue.Full:
+            self.dropped += 1
+
+    def record_usage(self, user_id: str, deployment: str, source: str, usage, **kwargs):
+        ## usage is an SDK usage object, a usage dict from a REST response, or None
+        if isinstance(usage, dict):
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        else:
+            prompt_tokens, completion_tokens = getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+        self.record(user_id, deployment, source, prompt_tokens, completion_tokens, **kwargs)
+
+    @contextmanager
+    def _file_lock(self):
+        ## appends and compactions from every worker process are serialized
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _first_kept_day(self):
+        if not self.retention_days:
+            return None
+        return time.strftime("%Y-%m-%d", time.gmtime(time.time() - (self.retention_days - 1) * 86400))
+
+    def _read(self):
+        ## fold the lines appended since the last read into the totals; a compacted (replaced) file is read from the start
+        first_kept_day = self._first_kept_day()
+        if first_kept_day:
+            ## days that aged out since the last read
+            for key in [key for key in self._totals if key[0] < first_kept_day]:
+                del self._totals[key]
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self._totals, self._file_id, self._offset, self._lines = {}, None, 0, 0
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._file_id or stat.st_size < self._offset:
+                self._totals, self._file_id, self._offset, self._lines = {}, file_id, 0, 0
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    ## another process is still writing it
+                    break
+                self._offset += len(line)
+                self._lines += 1
+                try:
+                    entry = json.loads(line)
+                    key = (entry["day"], entry["user_id"], entry["deployment"], entry["source"])
+                except (ValueError, KeyError):
+                    ## a line cut short by a crash mid-write
+                    continue
+                if first_kept_day and key[0] < first_kept_day:
+                    continue
+                self._add(self._totals, key, entry)
+
+    @staticmethod
+    def _lines_of(totals):
+        return "".join(json.dumps(dict(counters, day=day, user_id=user_id, deployment=deployment, source=source)) + "\n"
+                       for (day, user_id, deployment, source), counters in totals.items())
+
+    def _compact(self):
+        ## rewrite the file as one line per total; called with the file lock held and the file read to its end
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self._lines_of(self._totals))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        stat = os.stat(self.path)
+        self._file_id, self._offset, self._lines = (stat.st_dev, stat.st_ino), stat.st_size, len(self._totals)
+        self.compactions += 1
+
+    @staticmethod
+    def _add(totals, key, counters):
+        current = totals.setdefault(key, { 'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_requests': 0 })
+        for name in current:
+            current[name] += counters.get(name, 0)
+
+    def _aggregate(self, event):
+        timestamp, user_id, deployment, source, prompt_tokens, completion_tokens, prompt_messages, completion_text = event
+        estimated = prompt_tokens is None or completion_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = self.estimator.count_messages(prompt_messages)
+        if completion_tokens is None:
+            completion_tokens = self.estimator.count(completion_text)
+        counters = { 'requests': 1, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                     'estimated_requests': 1 if estimated else 0 }
+        key = (time.strftime("%Y-%m-%d", time.gmtime(timestamp)), user_id, deployment, source)
+        with self._lock:
+            self._add(self._pending, key, counters)
+            self.recorded += 1
+
+    def _drain(self, timeout=None, batch_size=10000):
+        ## bounded, so a steady stream of events can't hold off the flush
+        events = []
+        try:
+            events.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(events) < batch_size:
+                events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        for event in events:
+            try:
+                self._aggregate(event)
+            except Exception as e:
+                logging.error(f"Failed to record token usage: {e}")
+
+    def flush(self):
+        """
+        Aggregate everything recorded so far and append the deltas to the ledger file
+        """
+        with self._flush_lock:
+            self._drain()
+            ## the deltas leave _pending only once they are in the file, so reads never count them twice or miss them
+            with self._lock:
+                if not self._pending:
+                    return
+                try:
+                    with self._file_lock():
+                        with open(self.path, "a", encoding="utf-8") as f:
+                            f.write(self._lines_of(self._pending))
+                        self.flushed += len(self._pending)
+                        self._pending = {}
+                        self._read()
+                        if self._lines > len(self._totals) + self.compact_slack:
+                            self._compact()
+                except OSError as e:
+                    logging.error(f"Failed to write the usage ledger, keeping {len(self._pending)} entries for the next flush: {e}")
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            self._drain(timeout=max(0.01, next_flush - time.monotonic()))
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+
+    def usage(self, user_id: str = None, since: str = None) -> dict:
+        """
+        Totals per day, per deployment and per source, for one user or for everyone;
+        since is an inclusive YYYY-MM-DD day
+        """
+        result = { 'days': {}, 'deployments': {}, 'sources': {} }
+        if user_id is None:
+            result['users'] = {}
+        with self._lock:
+            self._read()
+            items = [(key, dict(counters)) for key, counters in self._totals.items()]
+            items += [(key, dict(counters)) for key, counters in self._pending.items()]
+        for (day, entry_user, deployment, source), counters in items:
+            if (user_id is not None and entry_user != user_id) or (since and day < since):
+                continue
+            self._add(result, 'total', counters)
+            self._add(result['days'], day, counters)
+            self._add(result['deployments'], deployment, counters)
+            self._add(result['sources'], source, counters)
+            if user_id is None:
+                self._add(result['users'], entry_user, counters)
+        result.setdefault('total', { 'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_requests': 0 })
+        return result
+
+    def metrics(self):
+        return { 'queued': self._queue.qsize(), 'recorded': self.recorded, 'dropped': self.dropped, 'flushed': self.flushed,
+                 'compactions': self.compactions }
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assistants (
+    name TEXT PRIMARY KEY,
+    assistantId TEXT NOT NULL,
+    definitionHash TEXT NOT NULL,
+    updatedAt REAL NOT NULL
+);
+"""
+
+SELECT_ASSISTANT = "SELECT assistantId, definitionHash FROM assistants WHERE name = ?"
+UPSERT_ASSISTANT = """INSERT INTO assistants (name, assistantId, definitionHash, updatedAt) VALUES (?, ?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET assistantId = excluded.assistantId, definitionHash = excluded.definitionHash, updatedAt = excluded.updatedAt"""
+DELETE_ASSISTANT = "DELETE FROM assistants WHERE name = ?"
+
+
+class AssistantIndex():
+    """
+    A name -> (assistant id, definition hash) index kept in a small SQLite file,
+    so every worker process on the machine resolves an assistant without listing
+    all the assistants in the resource.
+    """
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        self._local = threading.local()
+        self._thread_lock = threading.Lock()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, name):
+        row = self._connection().execute(SELECT_ASSISTANT, (name,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, name, assistant_id, definition_hash):
+        self._connection().execute(UPSERT_ASSISTANT, (name, assistant_id, definition_hash, time.time()))
+
+    def remove(self, name):
+        self._connection().execute(DELETE_ASSISTANT, (name,))
+
+    @contextmanager
+    def resolving(self):
+        ## serialize resolution across threads and processes so concurrent cold starts don't create duplicates
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.database_path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
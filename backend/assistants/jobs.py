@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    userId TEXT NOT NULL,
+    status TEXT NOT NULL,
+    createdAt REAL NOT NULL,
+    updatedAt REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_frames (
+    jobId TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    frame TEXT NOT NULL,
+    PRIMARY KEY (jobId, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs (updatedAt);
+"""
+
+INSERT_JOB = "INSERT INTO jobs (id, userId, status, createdAt, updatedAt) VALUES (?, ?, 'pending', ?, ?)"
+## a job another worker gave up on as abandoned stays failed
+UPDATE_JOB_STATUS = "UPDATE jobs SET status = ?, updatedAt = ? WHERE id = ? AND status IN ('pending', 'running')"
+SELECT_JOB = "SELECT id, status, createdAt, updatedAt, (SELECT COUNT(*) FROM job_frames WHERE jobId = id) FROM jobs WHERE id = ? AND userId = ?"
+SELECT_JOB_STATUS = "SELECT status, updatedAt FROM jobs WHERE id = ?"
+INSERT_FRAME = "INSERT INTO job_frames (jobId, seq, frame) VALUES (?, ?, ?)"
+## unfinished jobs' updatedAt is a heartbeat of the worker process that runs them
+HEARTBEAT_JOBS = "UPDATE jobs SET updatedAt = ? WHERE id IN (SELECT value FROM json_each(?)) AND status IN ('pending', 'running')"
+FAIL_ABANDONED_JOBS = "UPDATE jobs SET status = 'failed', updatedAt = ? WHERE updatedAt < ? AND status IN ('pending', 'running') RETURNING id"
+APPEND_FRAME = "INSERT INTO job_frames (jobId, seq, frame) SELECT ?, COALESCE(MAX(seq) + 1, 0), ? FROM job_frames WHERE jobId = ?"
+SELECT_FRAMES = "SELECT seq, frame FROM job_frames WHERE jobId = ? AND seq >= ? ORDER BY seq"
+DELETE_EXPIRED_FRAMES = "DELETE FROM job_frames WHERE jobId IN (SELECT id FROM jobs WHERE updatedAt < ? AND status IN ('completed', 'failed'))"
+DELETE_EXPIRED_JOBS = "DELETE FROM jobs WHERE updatedAt < ? AND status IN ('completed', 'failed')"
+
+FINISHED = ("completed", "failed")
+
+
+class AssistantJobs():
+    """
+    Runs assistant conversations on a bounded background executor and records the
+    NDJSON frames they produce in a SQLite file, so a client can read a job's status
+    and stream its frames from any worker process, whichever one runs the job.
+    """
+
+    def __init__(self, database_path: str, max_workers: int = 4, max_pending: int = 32, ttl: float = 3600,
+                 stream_timeout: float = 300, poll_interval: float = 0.25, lease: float = 60):
+        self.database_path = database_path
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.stream_timeout = stream_timeout
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = 0
+        ## ids of the jobs this process has queued or is running, kept alive by the heartbeat
+        self._active = set()
+        self._heartbeat = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="assistant-job")
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def submit(self, user_id, produce_frames):
+        ## produce_frames returns an iterator of NDJSON lines; returns the job id, or None when this worker is full
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        connection = self._connection()
+        self.fail_abandoned()
+        connection.execute(DELETE_EXPIRED_FRAMES, (now - self.ttl,))
+        connection.execute(DELETE_EXPIRED_JOBS, (now - self.ttl,))
+        connection.execute(INSERT_JOB, (job_id, user_id, now, now))
+        with self._lock:
+            self._active.add(job_id)
+            self._start_heartbeat()
+        self._executor.submit(self._run, job_id, produce_frames)
+        return job_id
+
+    def _start_heartbeat(self):
+        ## called with the lock held
+        if self._heartbeat is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.lease / 3)
+                with self._lock:
+                    active = list(self._active)
+                if not active:
+                    continue
+                try:
+                    self._connection().execute(HEARTBEAT_JOBS, (time.time(), json.dumps(active)))
+                except Exception as e:
+                    logging.error(f"Assistant job heartbeat failed: {e}")
+
+        self._heartbeat = threading.Thread(target=run, name="assistant-job-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def fail_abandoned(self):
+        ## jobs whose worker process died (or was recycled) stop heartbeating; mark them failed
+        ## with an error frame, so their readers finish and the expiry purge removes them
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            abandoned = [row[0] for row in connection.execute(FAIL_ABANDONED_JOBS, (now, now - self.lease)).fetchall()]
+            for job_id in abandoned:
+                frame = json.dumps({"error": "The assistant job was abandoned by the worker running it"}) + "\n"
+                connection.execute(APPEND_FRAME, (job_id, frame, job_id))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if abandoned:
+            logging.warning(f"Marked {len(abandoned)} abandoned assistant jobs as failed")
+        return abandoned
+
+    def _run(self, job_id, produce_frames):
+        connection = self._connection()
+        status = "completed"
+        seq = 0
+        try:
+            connection.execute(UPDATE_JOB_STATUS, ("running", time.time(), job_id))
+            for frame in produce_frames():
+                connection.execute(INSERT_FRAME, (job_id, seq, frame))
+                seq += 1
+                if "error" in json.loads(frame):
+                    status = "failed"
+        except Exception as e:
+            logging.exception(f"Assistant job {job_id} failed")
+            connection.execute(INSERT_FRAME, (job_id, seq, json.dumps({"error": str(e)}) + "\n"))
+            status = "failed"
+        finally:
+            connection.execute(UPDATE_JOB_STATUS, (status, time.time(), job_id))
+            with self._lock:
+                self._pending -= 1
+                self._active.discard(job_id)
+
+    def get(self, job_id, user_id):
+        row = self._connection().execute(SELECT_JOB, (job_id, user_id)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'status': row[1],
+            'createdAt': row[2],
+            'updatedAt': row[3],
+            'frames': row[4]
+        }
+
+    def stream(self, job_id, after: int = 0):
+        ## yields the job's frames from seq `after` on, following the job until it finishes
+        connection = self._connection()
+        deadline = time.monotonic() + self.stream_timeout
+        while True:
+            row = connection.execute(SELECT_JOB_STATUS, (job_id,)).fetchone()
+            for seq, frame in connection.execute(SELECT_FRAMES, (job_id, after)).fetchall():
+                after = seq + 1
+                yield frame
+            if row is None or row[0] in FINISHED:
+                return
+            if row[1] < time.time() - self.lease:
+                ## the job's frames and status are picked up on the next pass
+                self.fail_abandoned()
+                continue
+            if time.monotonic() > deadline:
+                yield json.dumps({"error": f"Job {job_id} did not finish within {self.stream_timeout} seconds"}) + "\n"
+                return
+            time.sleep(self.poll_interval)
@@ -0,0 +1,146 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    userId TEXT NOT NULL,
+    assistantType TEXT NOT NULL,
+    threadId TEXT NOT NULL,
+    lastUsed REAL NOT NULL,
+    PRIMARY KEY (userId, assistantType)
+);
+CREATE INDEX IF NOT EXISTS idx_threads_last_used ON threads (lastUsed);
+"""
+
+## touching on read keeps lastUsed an LRU clock; an expired row reads as missing
+TOUCH_THREAD = "UPDATE threads SET lastUsed = ? WHERE userId = ? AND assistantType = ? AND lastUsed >= ? RETURNING threadId"
+UPSERT_THREAD = """INSERT INTO threads (userId, assistantType, threadId, lastUsed) VALUES (?, ?, ?, ?)
+    ON CONFLICT(userId, assistantType) DO UPDATE SET threadId = excluded.threadId, lastUsed = excluded.lastUsed"""
+DELETE_THREAD = "DELETE FROM threads WHERE userId = ? AND assistantType = ? RETURNING threadId"
+## expired rows included, unlike get()
+SELECT_THREAD = "SELECT threadId FROM threads WHERE userId = ? AND assistantType = ?"
+## compare-and-swap on the registered thread, so of two concurrent replacements exactly one wins
+CLAIM_THREAD = """INSERT INTO threads (userId, assistantType, threadId, lastUsed) VALUES (?, ?, ?, ?)
+    ON CONFLICT(userId, assistantType) DO NOTHING RETURNING threadId"""
+SWAP_THREAD = "UPDATE threads SET threadId = ?, lastUsed = ? WHERE userId = ? AND assistantType = ? AND threadId = ? RETURNING threadId"
+## DELETE ... RETURNING is atomic, so when several workers sweep, each thread is handed to exactly one of them
+DELETE_EXPIRED = "DELETE FROM threads WHERE rowid IN (SELECT rowid FROM threads WHERE lastUsed < ? ORDER BY lastUsed LIMIT ?) RETURNING assistantType, threadId"
+DELETE_OVER_CAPACITY = "DELETE FROM threads WHERE rowid IN (SELECT rowid FROM threads ORDER BY lastUsed DESC LIMIT ? OFFSET ?) RETURNING assistantType, threadId"
+
+
+class ThreadRegistry():
+    """
+    Maps (user, assistant type) to the user's assistant thread in a SQLite file shared
+    by every worker process, with TTL expiry and a cap on the number of entries.
+    Threads that drop out of the registry are handed to a sweeper for remote deletion.
+    """
+
+    def __init__(self, database_path: str, ttl: float = 86400, max_entries: int = 10000):
+        self.database_path = database_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+        self._sweeper_lock_file = None
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, user_id, assistant_type):
+        now = time.time()
+        row = self._connection().execute(TOUCH_THREAD, (now, user_id, assistant_type, now - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def put(self, user_id, assistant_type, thread_id):
+        self._connection().execute(UPSERT_THREAD, (user_id, assistant_type, thread_id, time.time()))
+
+    def peek(self, user_id, assistant_type):
+        ## the registered thread, even an expired one, without touching it
+        row = self._connection().execute(SELECT_THREAD, (user_id, assistant_type)).fetchone()
+        return row[0] if row else None
+
+    def replace(self, user_id, assistant_type, old_thread_id, thread_id) -> bool:
+        ## register thread_id only while old_thread_id (None: no thread) is still the registered one
+        if old_thread_id is None:
+            row = self._connection().execute(CLAIM_THREAD, (user_id, assistant_type, thread_id, time.time())).fetchone()
+        else:
+            row = self._connection().execute(SWAP_THREAD, (thread_id, time.time(), user_id, assistant_type, old_thread_id)).fetchone()
+        return row is not None
+
+    def remove(self, user_id, assistant_type):
+        row = self._connection().execute(DELETE_THREAD, (user_id, assistant_type)).fetchone()
+        return row[0] if row else None
+
+    def evict(self, batch_size: int = 100):
+        ## remove expired entries, then the least recently used ones past capacity, and return (assistant type, thread id) pairs
+        connection = self._connection()
+        evicted = connection.execute(DELETE_EXPIRED, (time.time() - self.ttl, batch_size)).fetchall()
+        evicted += connection.execute(DELETE_OVER_CAPACITY, (batch_size, self.max_entries)).fetchall()
+        return evicted
+
+    def sweep(self, delete_remote, batch_size: int = 100):
+        deleted = 0
+        while True:
+            evicted = self.evict(batch_size)
+            for assistant_type, thread_id in evicted:
+                try:
+                    delete_remote(assistant_type, thread_id)
+                    deleted += 1
+                except Exception as e:
+                    logging.error(f"Failed to delete expired assistant thread {thread_id}: {e}")
+            if len(evicted) < batch_size:
+                return deleted
+
+    def _claim_sweeper(self):
+        ## one sweeper per machine: the process holding the lock file sweeps, the others check back every interval
+        if fcntl is None or self._sweeper_lock_file is not None:
+            return True
+        lock_file = open(self.database_path + ".sweeper.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._sweeper_lock_file = lock_file
+        return True
+
+    def start_sweeper(self, delete_remote, interval: float = 300):
+        ## sweep periodically on a daemon thread; delete_remote is called with each evicted assistant type and thread id
+        with self._sweeper_lock:
+            if self._sweeper is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        if not self._claim_sweeper():
+                            continue
+                        deleted = self.sweep(delete_remote)
+                        if deleted:
+                            logging.info(f"Deleted {deleted} expired assistant threads")
+                    except Exception as e:
+                        logging.error(f"Assistant thread sweep failed: {e}")
+
+            self._sweeper = threading.Thread(target=run, name="assistant-thread-sweeper", daemon=True)
+            self._sweeper.start()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import zlib
+
+from backend.cache import TTLCache
+
+REF_KEY = "$ref"
+
+
+class CitationStore():
+    """
+    Splits the citations out of tool messages so each distinct chunk is stored once,
+    compressed and keyed by its content hash, while history documents keep only refs.
+    Blobs are immutable, so anything this process has written or read is remembered.
+    """
+
+    def __init__(self, maxsize: int = 4096, compression_level: int = 6):
+        self.compression_level = compression_level
+        ## hash -> compressed blob, for citations this process already wrote or loaded
+        self._blobs = TTLCache(maxsize=maxsize, ttl=float("inf"))
+
+    @staticmethod
+    def citation_hash(citation: dict) -> str:
+        canonical = json.dumps(citation, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def encode(self, citation: dict) -> bytes:
+        return zlib.compress(json.dumps(citation, ensure_ascii=False).encode("utf-8"), self.compression_level)
+
+    def decode(self, blob: bytes) -> dict:
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    def split(self, content: str):
+        ## returns the content with citations replaced by refs, and the blobs the store doesn't have yet
+        try:
+            tool_content = json.loads(content)
+        except (TypeError, json.decoder.JSONDecodeError):
+            return content, {}
+        if not isinstance(tool_content, dict) or not isinstance(tool_content.get("citations"), list):
+            return content, {}
+
+        new_blobs = {}
+        refs = []
+        for citation in tool_content["citations"]:
+            if not isinstance(citation, dict) or REF_KEY in citation:
+                refs.append(citation)
+                continue
+            citation_hash = self.citation_hash(citation)
+            if self._blobs.peek(citation_hash) is None:
+                new_blobs[citation_hash] = self.encode(citation)
+            refs.append({REF_KEY: citation_hash})
+        tool_content["citations"] = refs
+        return json.dumps(tool_content, ensure_ascii=False), new_blobs
+
+    def remember(self, blobs: dict):
+        for citation_hash, blob in blobs.items():
+            self._blobs.set(citation_hash, blob)
+
+    def refs(self, content: str):
+        try:
+            tool_content = json.loads(content)
+        except (TypeError, json.decoder.JSONDecodeError):
+            return []
+        if not isinstance(tool_content, dict) or not isinstance(tool_content.get("citations"), list):
+            return []
+        return [c[REF_KEY] for c in tool_content["citations"] if isinstance(c, dict) and REF_KEY in c]
+
+    def lookup(self, hashes) -> dict:
+        ## the remembered blobs among hashes; rehydration resolves against this copy, so an entry
+        ## the LRU evicts meanwhile is still at hand
+        blobs = {}
+        for citation_hash in hashes:
+            blob = self._blobs.get(citation_hash)
+            if blob is not None:
+                blobs[citation_hash] = blob
+        return blobs
+
+    def join(self, content: str, blobs: dict):
+        ## rehydrate refs from blobs (see lookup); a ref whose blob isn't stored at all can only be dropped
+        tool_content = json.loads(content)
+        citations = []
+        for citation in tool_content["citations"]:
+            if isinstance(citation, dict) and REF_KEY in citation:
+                blob = blobs.get(citation[REF_KEY])
+                if blob is None:
+                    logging.error(f"Citation {citation[REF_KEY]} was not found in chat history storage")
+                    continue
+                citation = self.decode(blob)
+            citations.append(citation)
+        tool_content["citations"] = citations
+        return json.dumps(tool_content, ensure_ascii=False)
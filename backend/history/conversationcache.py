@@ -0,0 +1,75 @@
+import copy
+import threading
+
+from backend.cache import TTLCache
+
+
+class ConversationCache():
+    """
+    Per-user cache of conversation headers and of the first page of each user's
+    conversation list (newest first). Writers update it write-through; the short
+    TTL bounds how stale it can get when another worker process writes.
+    Everything handed out is a copy, so callers are free to mutate what they get.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 10):
+        self.headers = TTLCache(maxsize=maxsize, ttl=ttl)
+        ## user_id -> {limit: [conversation, ...]}
+        self.lists = TTLCache(maxsize=maxsize, ttl=ttl)
+        ## cached pages are patched in place, so guard them against concurrent request threads
+        self._lock = threading.Lock()
+
+    def get_conversation(self, user_id, conversation_id):
+        conversation = self.headers.get((user_id, conversation_id))
+        return copy.deepcopy(conversation) if conversation else None
+
+    def peek_conversation(self, user_id, conversation_id):
+        conversation = self.headers.peek((user_id, conversation_id))
+        return copy.deepcopy(conversation) if conversation else None
+
+    def put_conversation(self, conversation, bump: bool = False):
+        ## bump moves the conversation to the front of the cached lists, as a newer updatedAt would
+        conversation = copy.deepcopy(conversation)
+        user_id = conversation['userId']
+        self.headers.set((user_id, conversation['id']), conversation)
+
+        with self._lock:
+            pages = self.lists.peek(user_id)
+            if not pages:
+                return
+            for limit, conversations in pages.items():
+                index = next((i for i, c in enumerate(conversations) if c['id'] == conversation['id']), None)
+                if bump:
+                    if index is not None:
+                        del conversations[index]
+                    conversations.insert(0, conversation)
+                    del conversations[limit:]
+                elif index is not None:
+                    conversations[index] = conversation
+
+    def remove_conversation(self, user_id, conversation_id):
+        self.headers.pop((user_id, conversation_id))
+        ## the next conversation past the cached page is unknown, so drop the lists instead of patching them
+        with self._lock:
+            self.lists.pop(user_id)
+
+    def get_conversations(self, user_id, limit):
+        with self._lock:
+            pages = self.lists.get(user_id)
+            if not pages or limit not in pages:
+                return None
+            return copy.deepcopy(pages[limit])
+
+    def put_conversations(self, user_id, limit, conversations):
+        with self._lock:
+            pages = self.lists.peek(user_id) or {}
+            pages[limit] = copy.deepcopy(conversations)
+            self.lists.set(user_id, pages)
+        for conversation in conversations:
+            self.headers.set((user_id, conversation['id']), copy.deepcopy(conversation))
+
+    def metrics(self):
+        return {
+            'conversations': self.headers.metrics(),
+            'conversation_lists': self.lists.metrics()
+        }
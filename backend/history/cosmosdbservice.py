@@ -1,13 +1,62 @@
+import base64
 import os
 import uuid
 from datetime import datetime
 from flask import Flask, request
 from azure.identity import DefaultAzureCredential  
-from azure.cosmos import CosmosClient, PartitionKey  
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from azure.core import MatchConditions
+
+from backend.history.citationstore import CitationStore
+from backend.history.conversationcache import ConversationCache
+from backend.history.historyprovider import HistoryProvider
+
+
+## query text and parameters are shared with the async client in cosmosdbservice_async
+def conversations_query(user_id, limit, sort_order = 'DESC', offset = 0):
+    parameters = [
+        {
+            'name': '@userId',
+            'value': user_id
+        }
+    ]
+    query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+    if limit is not None:
+        query += f" offset {offset} limit {limit}"
+    return query, parameters
+
+def conversation_query(user_id, conversation_id):
+    parameters = [
+        {
+            'name': '@conversationId',
+            'value': conversation_id
+        },
+        {
+            'name': '@userId',
+            'value': user_id
+        }
+    ]
+    query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+    return query, parameters
+
+def messages_query(user_id, conversation_id):
+    parameters = [
+        {
+            'name': '@conversationId',
+            'value': conversation_id
+        },
+        {
+            'name': '@userId',
+            'value': user_id
+        }
+    ]
+    query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+    return query, parameters
+
   
-class CosmosConversationClient():
+class CosmosConversationClient(HistoryProvider):
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, cache: ConversationCache = None, citation_store: CitationStore = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
@@ -15,6 +64,8 @@ class CosmosConversationClient():
         self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         self.database_client = self.cosmosdb_client.get_database_client(database_name)
         self.container_client = self.database_client.get_container_client(container_name)
+        self.cache = cache
+        self.citation_store = citation_store
 
     def ensure(self):
         try:
@@ -29,33 +80,80 @@ class CosmosConversationClient():
         except:
             return False
 
-    def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+    def create_conversation(self, user_id, title = '', conversation = None):
+        ## pass a conversation from build_conversation to store one whose id is already known
+        conversation = conversation or self.build_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = self.container_client.upsert_item(conversation)  
         if resp:
+            if self.cache:
+                self.cache.put_conversation(resp, bump=True)
             return resp
         else:
             return False
     
     def upsert_conversation(self, conversation):
-        resp = self.container_client.upsert_item(conversation)
+        if not self.cache:
+            resp = self.container_client.upsert_item(conversation)
+            if resp:
+                return resp
+            else:
+                return False
+
+        original = self.cache.peek_conversation(conversation['userId'], conversation['id'])
+        if conversation.get('_etag'):
+            resp = self._upsert_conversation_if_not_modified(conversation, original)
+        else:
+            resp = self.container_client.upsert_item(conversation)
         if resp:
+            ## a newer updatedAt moves the conversation to the top of the cached list
+            bump = original is None or original.get('updatedAt') != resp.get('updatedAt')
+            self.cache.put_conversation(resp, bump=bump)
             return resp
         else:
             return False
 
+    def _upsert_conversation_if_not_modified(self, conversation, original, retries: int = 3):
+        ## the header may have come from the cache, so only overwrite the version it was read from
+        for _ in range(retries):
+            try:
+                return self.container_client.upsert_item(conversation, etag=conversation['_etag'], match_condition=MatchConditions.IfNotModified)
+            except exceptions.CosmosAccessConditionFailedError:
+                ## another worker changed it since; reapply just our changes on top of the current version
+                changes = {k: v for k, v in conversation.items() if not k.startswith('_') and (original or {}).get(k) != v}
+                self.cache.remove_conversation(conversation['userId'], conversation['id'])
+                current = self._query_conversation(conversation['userId'], conversation['id'])
+                if not current:
+                    return False
+                if 'updatedAt' in changes:
+                    changes['updatedAt'] = max(changes['updatedAt'], current.get('updatedAt', ''))
+                original = dict(current)
+                current.update(changes)
+                conversation = current
+        return self.container_client.upsert_item(conversation)
+
+    def update_title(self, user_id, conversation_id, title, if_title = None, retries: int = 3):
+        ## set the title on the current version only, so a concurrent message write (and its updatedAt) is never overwritten
+        for _ in range(retries):
+            conversation = self._query_conversation(user_id, conversation_id)
+            if not conversation or (if_title is not None and conversation.get('title') != if_title):
+                return False
+            conversation['title'] = title
+            try:
+                resp = self.container_client.upsert_item(conversation, etag=conversation['_etag'], match_condition=MatchConditions.IfNotModified)
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+            if self.cache:
+                self.cache.put_conversation(resp)
+            return resp
+        return False
+
     def delete_conversation(self, user_id, conversation_id):
         conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)        
         if conversation:
             resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+            if self.cache:
+                self.cache.remove_conversation(user_id, conversation_id)
             return resp
         else:
             return True
@@ -63,7 +161,7 @@ class CosmosConversationClient():
         
     def delete_messages(self, conversation_id, user_id):
         ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
+        messages = self.get_messages(user_id, conversation_id, rehydrate=False)
         response_list = []
         if messages:
             for message in messages:
@@ -73,18 +171,18 @@ class CosmosConversationClient():
 
 
     def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
-        parameters = [
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-            
+        ## only the first page, newest first, is cached; that's what every sidebar refresh asks for
+        cacheable = self.cache is not None and limit is not None and int(offset) == 0 and sort_order == 'DESC'
+        if cacheable:
+            conversations = self.cache.get_conversations(user_id, limit)
+            if conversations is not None:
+                return conversations
+
+        query, parameters = conversations_query(user_id, limit, sort_order, offset)
         conversations = list(self.container_client.query_items(query=query, parameters=parameters,
                                                                                enable_cross_partition_query =True))
+        if cacheable:
+            self.cache.put_conversations(user_id, limit, conversations)
         ## if no conversations are found, return None
         if len(conversations) == 0:
             return []
@@ -92,17 +190,18 @@ class CosmosConversationClient():
             return conversations
 
     def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+        if self.cache:
+            conversation = self.cache.get_conversation(user_id, conversation_id)
+            if conversation:
+                return conversation
+
+        conversation = self._query_conversation(user_id, conversation_id)
+        if conversation and self.cache:
+            self.cache.put_conversation(conversation)
+        return conversation
+
+    def _query_conversation(self, user_id, conversation_id):
+        query, parameters = conversation_query(user_id, conversation_id)
         conversation = list(self.container_client.query_items(query=query, parameters=parameters,
                                                                                enable_cross_partition_query =True))
         ## if no conversations are found, return None
@@ -111,47 +210,76 @@ class CosmosConversationClient():
         else:
             return conversation[0]
  
-    def create_message(self, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': str(uuid.uuid4()),
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
-        
-        resp = self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
-    
+    def create_messages(self, conversation_id, user_id, messages: list):
+        ## write already built message documents (see build_message) in order, then touch the parent conversation once
+        ## upserts keep this idempotent, so a batch can safely be retried after a partial failure
+        responses = []
+        messages = self.dehydrate_messages(messages)
+        for message in messages:
+            resp = self.container_client.upsert_item(message)
+            if not resp:
+                return False
+            responses.append(resp)
 
+        self._touch_conversation(user_id, conversation_id, messages[-1]['createdAt'])
+        return responses
 
-    def get_messages(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+    def _touch_conversation(self, user_id, conversation_id, updated_at, retries: int = 3):
+        ## only updatedAt changes, written with an If-Match on the version it was read from, so a title
+        ## written concurrently (generated title, rename) is never replaced by the stale copy
+        conversation = self.get_conversation(user_id, conversation_id)
+        for _ in range(retries):
+            if not conversation:
+                return False
+            conversation['updatedAt'] = max(updated_at, conversation.get('updatedAt', ''))
+            try:
+                resp = self.container_client.upsert_item(conversation, etag=conversation['_etag'], match_condition=MatchConditions.IfNotModified)
+            except exceptions.CosmosAccessConditionFailedError:
+                if self.cache:
+                    self.cache.remove_conversation(user_id, conversation_id)
+                conversation = self._query_conversation(user_id, conversation_id)
+                continue
+            if self.cache:
+                self.cache.put_conversation(resp, bump=True)
+            return resp
+        return False
+
+    def get_messages(self, user_id, conversation_id, rehydrate=True):
+        query, parameters = messages_query(user_id, conversation_id)
         messages = list(self.container_client.query_items(query=query, parameters=parameters,
                                                                      enable_cross_partition_query =True))
         ## if no messages are found, return false
         if len(messages) == 0:
             return []
+        elif rehydrate:
+            return self.rehydrate_messages(messages)
         else:
             return messages
 
+    def _citation_partition(self, citation_hash):
+        ## citations are shared across users, so spread them over a fixed set of partitions by hash prefix
+        return f"citations-{citation_hash[:2]}"
+
+    def citation_document(self, citation_hash, blob):
+        return {
+            'id': f"citation-{citation_hash}",
+            'type': 'citation',
+            'userId': self._citation_partition(citation_hash),
+            'data': base64.b64encode(blob).decode('ascii')
+        }
+
+    def save_citations(self, blobs: dict):
+        for citation_hash, blob in blobs.items():
+            self.container_client.upsert_item(self.citation_document(citation_hash, blob))
+
+    def get_citations(self, hashes: list) -> dict:
+        ## one query for the whole batch instead of a point read per hash; the citation partitions are fixed, so it goes cross-partition
+        parameters = [
+            {
+                'name': '@ids',
+                'value': [f"citation-{citation_hash}" for citation_hash in hashes]
+            }
+        ]
+        query = "SELECT c.id, c.data FROM c WHERE c.type = 'citation' AND ARRAY_CONTAINS(@ids, c.id)"
+        items = self.container_client.query_items(query=query, parameters=parameters, enable_cross_partition_query=True)
+        return {item['id'][len("citation-"):]: base64.b64decode(item['data']) for item in items}
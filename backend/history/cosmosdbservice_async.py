@@ -0,0 +1,166 @@
+import asyncio
+import concurrent.futures
+import threading
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+
+from backend.history.citationstore import CitationStore
+from backend.history.conversationcache import ConversationCache
+from backend.history.cosmosdbservice import CosmosConversationClient, conversation_query, messages_query
+
+
+class BackgroundEventLoop():
+    """
+    Runs an asyncio event loop on a daemon thread so synchronous Flask views can
+    share one set of async clients (and their connection pools) across requests.
+    """
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="cosmos-aio", daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout: float = None):
+        ## submit the coroutine to the background loop and block the calling thread until it finishes;
+        ## past the timeout it is cancelled, so a stalled loop can't hold a request thread forever
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+class LoopContainerClient():
+    """
+    The container calls CosmosConversationClient makes, served by an azure.cosmos.aio
+    container on the background event loop and blocking the calling thread until done.
+    """
+
+    def __init__(self, container, event_loop: BackgroundEventLoop):
+        self.container = container
+        self.event_loop = event_loop
+
+    def read(self):
+        return self.event_loop.run(self.container.read())
+
+    def upsert_item(self, body, **kwargs):
+        return self.event_loop.run(self.container.upsert_item(body, **kwargs))
+
+    def read_item(self, item, partition_key):
+        return self.event_loop.run(self.container.read_item(item=item, partition_key=partition_key))
+
+    def delete_item(self, item, partition_key):
+        return self.event_loop.run(self.container.delete_item(item=item, partition_key=partition_key))
+
+    def query_items(self, query, parameters=None, enable_cross_partition_query=None, **kwargs):
+        ## aio queries go across partitions unless they are given a partition key
+        async def collect():
+            return [item async for item in self.container.query_items(query=query, parameters=parameters, **kwargs)]
+
+        return self.event_loop.run(collect())
+
+
+class AsyncCosmosConversationClient(CosmosConversationClient):
+    """
+    The CosmosDB chat history client on an azure.cosmos.aio client, run on a background
+    event loop. Every call, writes included, shares the aio client's connection pool;
+    the fan-out paths (reading a conversation with its messages, deleting messages and
+    conversations, saving citations) also run their requests concurrently.
+    """
+
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, async_credential: any = None,
+                 cache: ConversationCache = None, citation_store: CitationStore = None, max_concurrency: int = 16, timeout: float = 30):
+        ## no synchronous CosmosClient: the container calls of the base class go through container_client below
+        self.cosmosdb_endpoint = cosmosdb_endpoint
+        self.credential = credential
+        self.database_name = database_name
+        self.container_name = container_name
+        self.cache = cache
+        self.citation_store = citation_store
+        self.max_concurrency = max_concurrency
+        self.event_loop = BackgroundEventLoop(timeout)
+        ## a single aio client owns the aiohttp session, so every call made through it shares its connection pool
+        self.event_loop.run(self._connect(async_credential or credential))
+        self.container_client = LoopContainerClient(self.aio_container_client, self.event_loop)
+
+    async def _connect(self, credential):
+        ## created on the loop so the client and the semaphore bind to it
+        self.aio_cosmosdb_client = AsyncCosmosClient(self.cosmosdb_endpoint, credential=credential)
+        self.cosmosdb_client = self.aio_cosmosdb_client
+        self.database_client = self.aio_cosmosdb_client.get_database_client(self.database_name)
+        self.aio_container_client = self.database_client.get_container_client(self.container_name)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def close(self):
+        self.event_loop.run(self.aio_cosmosdb_client.close())
+
+    async def _query(self, user_id, query, parameters):
+        return [item async for item in self.aio_container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+
+    async def _upsert_item(self, body):
+        async with self._semaphore:
+            return await self.aio_container_client.upsert_item(body)
+
+    async def _delete_item(self, item_id, user_id):
+        async with self._semaphore:
+            try:
+                return await self.aio_container_client.delete_item(item=item_id, partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+    async def _delete_messages(self, conversation_id, user_id):
+        messages = await self._query(user_id, *messages_query(user_id, conversation_id))
+        if messages:
+            return list(await asyncio.gather(*[self._delete_item(message['id'], user_id) for message in messages]))
+
+    async def _delete_conversation_and_messages(self, user_id, conversation_id):
+        deleted_messages = await self._delete_messages(conversation_id, user_id)
+        deleted_conversation = await self._delete_item(conversation_id, user_id)
+        return deleted_messages, deleted_conversation
+
+    def get_conversation_with_messages(self, user_id, conversation_id):
+        if self.cache and self.cache.get_conversation(user_id, conversation_id):
+            return super().get_conversation_with_messages(user_id, conversation_id)
+
+        async def read():
+            ## the conversation header and message queries don't depend on each other
+            return await asyncio.gather(
+                self._query(user_id, *conversation_query(user_id, conversation_id)),
+                self._query(user_id, *messages_query(user_id, conversation_id))
+            )
+
+        conversations, messages = self.event_loop.run(read())
+        if not conversations:
+            return None, None
+        if self.cache:
+            self.cache.put_conversation(conversations[0])
+        return conversations[0], self.rehydrate_messages(messages)
+
+    def delete_messages(self, conversation_id, user_id):
+        return self.event_loop.run(self._delete_messages(conversation_id, user_id))
+
+    def save_citations(self, blobs: dict):
+        async def save_all():
+            await asyncio.gather(*[self._upsert_item(self.citation_document(citation_hash, blob)) for citation_hash, blob in blobs.items()])
+
+        self.event_loop.run(save_all())
+
+    def delete_conversation_and_messages(self, user_id, conversation_id):
+        try:
+            return self.event_loop.run(self._delete_conversation_and_messages(user_id, conversation_id))
+        finally:
+            if self.cache:
+                self.cache.remove_conversation(user_id, conversation_id)
+
+    def delete_conversations(self, user_id, conversations: list):
+        async def delete_all():
+            return await asyncio.gather(*[self._delete_conversation_and_messages(user_id, conversation['id']) for conversation in conversations])
+
+        try:
+            return self.event_loop.run(delete_all())
+        finally:
+            if self.cache:
+                for conversation in conversations:
+                    self.cache.remove_conversation(user_id, conversation['id'])
@@ -0,0 +1,149 @@
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+
+class HistoryProvider(ABC):
+    """
+    The chat history interface app.py talks to. Conversations and messages are
+    plain dicts shaped like the CosmosDB documents, whichever store backs them.
+    """
+
+    ## set to a CitationStore to keep tool message citations out of the message documents
+    citation_store = None
+
+    @abstractmethod
+    def ensure(self):
+        pass
+
+    @abstractmethod
+    def create_conversation(self, user_id, title = '', conversation = None):
+        pass
+
+    @abstractmethod
+    def upsert_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    def update_title(self, user_id, conversation_id, title, if_title = None):
+        ## change only the title of the stored conversation, and only while it is still if_title when one is given
+        pass
+
+    @abstractmethod
+    def delete_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    def delete_messages(self, conversation_id, user_id):
+        pass
+
+    @abstractmethod
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        pass
+
+    @abstractmethod
+    def get_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    def create_messages(self, conversation_id, user_id, messages: list):
+        pass
+
+    @abstractmethod
+    def get_messages(self, user_id, conversation_id):
+        pass
+
+    def build_conversation(self, user_id, title = ''):
+        created_at = datetime.utcnow().isoformat()
+        return {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            'userId': user_id,
+            'title': title
+        }
+
+    def build_message(self, conversation_id, user_id, input_message: dict, message_id=None, created_at=None):
+        created_at = created_at or datetime.utcnow().isoformat()
+        return {
+            'id': message_id or str(uuid.uuid4()),
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+    def create_message(self, conversation_id, user_id, input_message: dict):
+        message = self.build_message(conversation_id, user_id, input_message)
+        resp = self.create_messages(conversation_id, user_id, [message])
+        if resp:
+            return resp[0]
+        else:
+            return False
+
+    def get_conversation_with_messages(self, user_id, conversation_id):
+        ## (None, None) when the conversation doesn't exist or belongs to someone else
+        conversation = self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return None, None
+        return conversation, self.get_messages(user_id, conversation_id)
+
+    def delete_conversation_and_messages(self, user_id, conversation_id):
+        ## messages go first so a failure never leaves orphaned messages without their conversation
+        deleted_messages = self.delete_messages(conversation_id, user_id)
+        deleted_conversation = self.delete_conversation(user_id, conversation_id)
+        return deleted_messages, deleted_conversation
+
+    def delete_conversations(self, user_id, conversations: list):
+        return [self.delete_conversation_and_messages(user_id, conversation['id']) for conversation in conversations]
+
+    @abstractmethod
+    def save_citations(self, blobs: dict):
+        pass
+
+    @abstractmethod
+    def get_citations(self, hashes: list) -> dict:
+        pass
+
+    def dehydrate_messages(self, messages: list) -> list:
+        ## swap tool message citations for content-addressed refs, storing only the blobs not stored before
+        if not self.citation_store:
+            return messages
+
+        dehydrated = []
+        new_blobs = {}
+        for message in messages:
+            if message.get('role') == 'tool':
+                content, blobs = self.citation_store.split(message['content'])
+                message = dict(message, content=content)
+                new_blobs.update(blobs)
+            dehydrated.append(message)
+
+        if new_blobs:
+            self.save_citations(new_blobs)
+            self.citation_store.remember(new_blobs)
+        return dehydrated
+
+    def rehydrate_messages(self, messages: list) -> list:
+        if not self.citation_store:
+            return messages
+
+        hashes = set()
+        for message in messages:
+            if message.get('role') == 'tool':
+                hashes.update(self.citation_store.refs(message['content']))
+        blobs = self.citation_store.lookup(hashes)
+        missing = [h for h in hashes if h not in blobs]
+        if missing:
+            fetched = self.get_citations(missing)
+            self.citation_store.remember(fetched)
+            blobs.update(fetched)
+
+        for message in messages:
+            if message.get('role') == 'tool' and self.citation_store.refs(message['content']):
+                message['content'] = self.citation_store.join(message['content'], blobs)
+        return messages
@@ -0,0 +1,182 @@
+import json
+import os
+import sqlite3
+import threading
+
+from backend.history.citationstore import CitationStore
+from backend.history.historyprovider import HistoryProvider
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    userId TEXT NOT NULL,
+    createdAt TEXT NOT NULL,
+    updatedAt TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (userId, updatedAt);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    userId TEXT NOT NULL,
+    conversationId TEXT NOT NULL,
+    createdAt TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_created ON messages (conversationId, createdAt);
+CREATE TABLE IF NOT EXISTS citations (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+## statements are kept as constants so sqlite3's per-connection statement cache reuses the prepared form
+UPSERT_CONVERSATION = """INSERT INTO conversations (id, userId, createdAt, updatedAt, document) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET updatedAt = excluded.updatedAt, document = excluded.document WHERE conversations.userId = excluded.userId"""
+SELECT_CONVERSATION = "SELECT document FROM conversations WHERE id = ? AND userId = ?"
+## never moves updatedAt backwards, so a delayed or replayed message batch doesn't reorder the conversation list
+TOUCH_CONVERSATION = """UPDATE conversations SET updatedAt = MAX(updatedAt, ?1), document = json_set(document, '$.updatedAt', MAX(updatedAt, ?1))
+    WHERE id = ?2 AND userId = ?3"""
+SELECT_CONVERSATIONS_DESC = "SELECT document FROM conversations WHERE userId = ? ORDER BY updatedAt DESC LIMIT ? OFFSET ?"
+SELECT_CONVERSATIONS_ASC = "SELECT document FROM conversations WHERE userId = ? ORDER BY updatedAt ASC LIMIT ? OFFSET ?"
+DELETE_CONVERSATION = "DELETE FROM conversations WHERE id = ? AND userId = ?"
+UPSERT_MESSAGE = """INSERT INTO messages (id, userId, conversationId, createdAt, document) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET document = excluded.document WHERE messages.userId = excluded.userId"""
+SELECT_MESSAGES = "SELECT document FROM messages WHERE conversationId = ? AND userId = ? ORDER BY createdAt ASC"
+DELETE_MESSAGES = "DELETE FROM messages WHERE conversationId = ? AND userId = ? RETURNING id"
+INSERT_CITATION = "INSERT OR IGNORE INTO citations (hash, data) VALUES (?, ?)"
+SELECT_CITATION = "SELECT data FROM citations WHERE hash = ?"
+
+
+class SqliteConversationClient(HistoryProvider):
+    """
+    Chat history stored in a local SQLite database, for single-node and edge
+    deployments (and for exercising the history path offline).
+    """
+
+    def __init__(self, database_path: str, timeout: float = 5.0, citation_store: CitationStore = None):
+        self.database_path = database_path
+        self.timeout = timeout
+        self.citation_store = citation_store
+        ## sqlite3 connections can't be shared between threads, so each request thread gets its own
+        self._local = threading.local()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=self.timeout, isolation_level=None, cached_statements=64)
+            ## WAL lets readers proceed while a writer commits, and NORMAL sync is durable enough with it
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def ensure(self):
+        try:
+            self._connection().execute("SELECT 1 FROM conversations LIMIT 1")
+            return True
+        except:
+            return False
+
+    def create_conversation(self, user_id, title = '', conversation = None):
+        ## pass a conversation from build_conversation to store one whose id is already known
+        conversation = conversation or self.build_conversation(user_id, title)
+        return self.upsert_conversation(conversation)
+
+    def upsert_conversation(self, conversation):
+        self._connection().execute(UPSERT_CONVERSATION, (
+            conversation['id'],
+            conversation['userId'],
+            conversation['createdAt'],
+            conversation['updatedAt'],
+            json.dumps(conversation)
+        ))
+        return conversation
+
+    def update_title(self, user_id, conversation_id, title, if_title = None):
+        connection = self._connection()
+        ## the read and the write share a transaction, so a concurrent message write can't slip in between
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(SELECT_CONVERSATION, (conversation_id, user_id)).fetchone()
+            conversation = None if row is None else json.loads(row[0])
+            if conversation is None or (if_title is not None and conversation.get('title') != if_title):
+                connection.execute("ROLLBACK")
+                return False
+            conversation['title'] = title
+            connection.execute(UPSERT_CONVERSATION, (
+                conversation['id'],
+                conversation['userId'],
+                conversation['createdAt'],
+                conversation['updatedAt'],
+                json.dumps(conversation)
+            ))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return conversation
+
+    def delete_conversation(self, user_id, conversation_id):
+        self._connection().execute(DELETE_CONVERSATION, (conversation_id, user_id))
+        return True
+
+    def delete_messages(self, conversation_id, user_id):
+        rows = self._connection().execute(DELETE_MESSAGES, (conversation_id, user_id)).fetchall()
+        if rows:
+            return [row[0] for row in rows]
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        query = SELECT_CONVERSATIONS_ASC if sort_order.upper() == 'ASC' else SELECT_CONVERSATIONS_DESC
+        ## a negative LIMIT means no limit in sqlite
+        rows = self._connection().execute(query, (user_id, -1 if limit is None else int(limit), int(offset))).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_conversation(self, user_id, conversation_id):
+        row = self._connection().execute(SELECT_CONVERSATION, (conversation_id, user_id)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def create_messages(self, conversation_id, user_id, messages: list):
+        messages = self.dehydrate_messages(messages)
+        connection = self._connection()
+        ## one transaction for the batch and the parent conversation's updatedAt
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for message in messages:
+                connection.execute(UPSERT_MESSAGE, (
+                    message['id'],
+                    message['userId'],
+                    message['conversationId'],
+                    message['createdAt'],
+                    json.dumps(message)
+                ))
+
+            connection.execute(TOUCH_CONVERSATION, (messages[-1]['createdAt'], conversation_id, user_id))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return messages
+
+    def get_messages(self, user_id, conversation_id):
+        rows = self._connection().execute(SELECT_MESSAGES, (conversation_id, user_id)).fetchall()
+        return self.rehydrate_messages([json.loads(row[0]) for row in rows])
+
+    def save_citations(self, blobs: dict):
+        self._connection().executemany(INSERT_CITATION, list(blobs.items()))
+
+    def get_citations(self, hashes: list) -> dict:
+        connection = self._connection()
+        blobs = {}
+        for citation_hash in hashes:
+            row = connection.execute(SELECT_CITATION, (citation_hash,)).fetchone()
+            if row is not None:
+                blobs[citation_hash] = bytes(row[0])
+        return blobs
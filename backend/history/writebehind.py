@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class WriteBehindHistoryWriter():
+    """
+    Acknowledges chat history message writes as soon as they are appended to a local
+    write-ahead log, and flushes them to the conversation client from a background thread.
+
+    Entries are flushed per conversation in the order they were submitted. A failing
+    conversation is retried with capped exponential backoff without blocking the others.
+    Unacknowledged entries are replayed from the log when the writer starts.
+    """
+
+    def __init__(self, conversation_client, wal_directory: str, batch_size: int = 50, flush_interval: float = 0.5,
+                 retry_backoff: float = 0.5, max_backoff: float = 30, fsync: bool = True):
+        self.conversation_client = conversation_client
+        self.wal_directory = wal_directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.fsync = fsync
+
+        self._condition = threading.Condition()
+        ## conversation_id -> {'entries': deque, 'attempts': int, 'next_attempt': float}
+        self._pending = OrderedDict()
+        ## conversations the worker is writing right now, outside the lock
+        self._in_flight = set()
+        self._seq = 0
+        self._stopped = False
+
+        self._flushed = 0
+        self._failures = 0
+        self._last_flush_lag = 0.0
+
+        os.makedirs(self.wal_directory, exist_ok=True)
+        self.wal_path, self._lock_file = self._claim_wal_file()
+        self._replay()
+        self._wal = open(self.wal_path, "a", encoding="utf-8")
+
+        self._worker = threading.Thread(target=self._run, name="history-write-behind", daemon=True)
+        self._worker.start()
+
+    def _claim_wal_file(self):
+        ## every worker process needs a log of its own; claim the first slot no other live process holds
+        ## so a restarted process picks up (and replays) the log its predecessor left behind
+        slot = 0
+        while True:
+            wal_path = os.path.join(self.wal_directory, f"history-wal.{slot}.jsonl")
+            if fcntl is None:
+                return wal_path, None
+
+            lock_file = open(wal_path + ".lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return wal_path, lock_file
+            except OSError:
+                lock_file.close()
+                slot += 1
+
+    def _replay(self):
+        if not os.path.exists(self.wal_path):
+            return
+
+        entries = OrderedDict()
+        with open(self.wal_path, "r", encoding="utf-8") as wal:
+            for line in wal:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    ## a torn final line from a crash mid-append; everything before it is intact
+                    continue
+                if record.get("op") == "put":
+                    entries[record["seq"]] = record
+                elif record.get("op") == "ack":
+                    entries.pop(record["seq"], None)
+
+        for entry in entries.values():
+            entry["enqueuedAt"] = time.time()
+            self._enqueue(entry)
+            self._seq = max(self._seq, entry["seq"])
+
+        ## compact the log down to the entries that are still outstanding
+        tmp_path = self.wal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as wal:
+            for entry in entries.values():
+                wal.write(json.dumps(entry) + "\n")
+            wal.flush()
+            os.fsync(wal.fileno())
+        os.replace(tmp_path, self.wal_path)
+
+        if entries:
+            logging.warning(f"Replaying {len(entries)} unflushed chat history writes from {self.wal_path}")
+
+    def _append(self, record):
+        self._wal.write(json.dumps(record) + "\n")
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+
+    def _enqueue(self, entry):
+        state = self._pending.get(entry["conversationId"])
+        if state is None:
+            state = {'entries': deque(), 'attempts': 0, 'next_attempt': 0.0}
+            self._pending[entry["conversationId"]] = state
+        state['entries'].append(entry)
+
+    def submit(self, conversation_id, user_id, input_message: dict):
+        ## the message document is built up front so its id and timestamp survive a replay
+        message = self.conversation_client.build_message(conversation_id, user_id, input_message)
+        with self._condition:
+            self._seq += 1
+            entry = {
+                'op': 'put',
+                'seq': self._seq,
+                'conversationId': conversation_id,
+                'userId': user_id,
+                'message': message
+            }
+            self._append(entry)
+            entry['enqueuedAt'] = time.time()
+            self._enqueue(entry)
+            self._condition.notify()
+        return message
+
+    def pending_messages(self, user_id, conversation_id):
+        ## messages that were acknowledged but not flushed yet, so reads can include them
+        with self._condition:
+            state = self._pending.get(conversation_id)
+            if not state:
+                return []
+            return [entry['message'] for entry in state['entries'] if entry['userId'] == user_id]
+
+    def discard(self, user_id, conversation_id):
+        ## drop pending writes for a conversation that is being deleted so they don't resurrect it;
+        ## a flush already under way is waited for, so the delete that follows also removes what it wrote
+        with self._condition:
+            while conversation_id in self._in_flight:
+                self._condition.wait()
+            state = self._pending.get(conversation_id)
+            if not state:
+                return
+            for entry in [entry for entry in state['entries'] if entry['userId'] == user_id]:
+                state['entries'].remove(entry)
+                self._append({'op': 'ack', 'seq': entry['seq']})
+            if not state['entries']:
+                del self._pending[conversation_id]
+
+    def _next_batch(self):
+        now = time.time()
+        batch = []
+        count = 0
+        for conversation_id, state in self._pending.items():
+            if count >= self.batch_size:
+                break
+            if state['next_attempt'] > now:
+                continue
+            entries = list(state['entries'])[:self.batch_size - count]
+            batch.append((conversation_id, entries))
+            self._in_flight.add(conversation_id)
+            count += len(entries)
+        return batch
+
+    def _flush_conversation(self, conversation_id, entries):
+        try:
+            self._write_conversation(conversation_id, entries)
+        finally:
+            with self._condition:
+                self._in_flight.discard(conversation_id)
+                self._condition.notify_all()
+
+    def _write_conversation(self, conversation_id, entries):
+        user_id = entries[0]['userId']
+        ## a conversation is owned by a single user, but keep batches homogeneous just in case
+        entries = [entry for entry in entries if entry['userId'] == user_id]
+        try:
+            resp = self.conversation_client.create_messages(conversation_id, user_id, [entry['message'] for entry in entries])
+            if resp is False:
+                raise Exception("create_messages returned no response")
+        except Exception as e:
+            with self._condition:
+                self._failures += 1
+                state = self._pending.get(conversation_id)
+                if state:
+                    state['attempts'] += 1
+                    state['next_attempt'] = time.time() + min(self.max_backoff, self.retry_backoff * (2 ** (state['attempts'] - 1)))
+            logging.error(f"Write-behind flush failed for conversation {conversation_id}: {e}")
+            return
+
+        now = time.time()
+        with self._condition:
+            state = self._pending.get(conversation_id)
+            for entry in entries:
+                self._append({'op': 'ack', 'seq': entry['seq']})
+                if state and entry in state['entries']:
+                    state['entries'].remove(entry)
+                self._flushed += 1
+                self._last_flush_lag = now - entry['enqueuedAt']
+            if state is not None:
+                state['attempts'] = 0
+                state['next_attempt'] = 0.0
+                if not state['entries']:
+                    del self._pending[conversation_id]
+            self._condition.notify_all()
+
+    def _compact(self):
+        ## with nothing outstanding every record in the log is dead weight
+        with self._condition:
+            if self._pending or self._wal.tell() == 0:
+                return
+            self._wal.truncate(0)
+            self._wal.seek(0)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                batch = self._next_batch()
+                if not batch:
+                    self._condition.wait(self.flush_interval)
+                    continue
+
+            for conversation_id, entries in batch:
+                self._flush_conversation(conversation_id, entries)
+            self._compact()
+
+    def flush(self, timeout: float = None):
+        ## block until everything submitted so far has been written, or the timeout expires
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._worker.join()
+        self._wal.close()
+        if self._lock_file:
+            self._lock_file.close()
+
+    def metrics(self):
+        with self._condition:
+            now = time.time()
+            oldest = min((state['entries'][0]['enqueuedAt'] for state in self._pending.values() if state['entries']), default=None)
+            return {
+                'queue_depth': sum(len(state['entries']) for state in self._pending.values()),
+                'pending_conversations': len(self._pending),
+                'oldest_pending_age_seconds': round(now - oldest, 3) if oldest else 0.0,
+                'last_flush_lag_seconds': round(self._last_flush_lag, 3),
+                'flushed': self._flushed,
+                'failures': self._failures
+            }
@@ -0,0 +1,220 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from PIL import Image
+
+from backend.cache import SingleFlight
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+IMAGE_EXTENSIONS = { "PNG": "png", "JPEG": "jpg", "GIF": "gif", "WEBP": "webp" }
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+## how rendered messages link to stored images, see imagegeneration.py and assistants.render_message_content
+IMAGE_LINK = re.compile(r"\./images/([A-Za-z0-9_-]+)(?:\.thumb\.jpg|\.(?:png|jpg|gif|webp))")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    key TEXT PRIMARY KEY,
+    imageName TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    lastUsed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_last_used ON images (lastUsed);
+CREATE TABLE IF NOT EXISTS image_refs (
+    key TEXT NOT NULL,
+    userId TEXT NOT NULL,
+    conversationId TEXT NOT NULL,
+    PRIMARY KEY (key, userId, conversationId)
+);
+CREATE INDEX IF NOT EXISTS idx_image_refs_conversation ON image_refs (userId, conversationId);
+"""
+
+SELECT_IMAGE = "SELECT imageName FROM images WHERE key = ?"
+UPSERT_IMAGE = """INSERT INTO images (key, imageName, bytes, lastUsed) VALUES (?, ?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET imageName = excluded.imageName, bytes = excluded.bytes, lastUsed = excluded.lastUsed"""
+## rows used in the last minute aren't rewritten, so serving an image rarely costs a write
+TOUCH_IMAGE = "UPDATE images SET lastUsed = ? WHERE key = ? AND lastUsed < ?"
+INSERT_REF = "INSERT OR IGNORE INTO image_refs (key, userId, conversationId) SELECT key, ?, ? FROM images WHERE key = ?"
+DELETE_REFS = "DELETE FROM image_refs WHERE userId = ? AND conversationId = ?"
+SELECT_TOTAL_BYTES = "SELECT COALESCE(SUM(bytes), 0) FROM images"
+SELECT_EVICTABLE = """SELECT key, imageName, bytes FROM images WHERE lastUsed < ?
+    AND NOT EXISTS (SELECT 1 FROM image_refs WHERE image_refs.key = images.key) ORDER BY lastUsed LIMIT ?"""
+DELETE_IF_UNREFERENCED = "DELETE FROM images WHERE key = ? AND NOT EXISTS (SELECT 1 FROM image_refs WHERE image_refs.key = ?) RETURNING key"
+
+
+def image_keys(content: str) -> set:
+    ## keys of the stored images a rendered message links to
+    return set(IMAGE_LINK.findall(content)) if isinstance(content, str) else set()
+
+
+class ImageStore():
+    """
+    Keeps generated and assistant output images on disk under their OpenAI file id (or
+    another content-derived key), each next to a downscaled JPEG thumbnail for the web.
+    Names never change content, so they can be served as immutable.
+
+    A SQLite index shared by the worker processes records each image and the saved
+    conversations that link to it. Past max_bytes, images no conversation references are
+    evicted least recently used first, the original together with its thumbnail. Images
+    used within min_age are kept, so one stays put while the conversation showing it is saved.
+    """
+
+    def __init__(self, directory: str, index_path: str, max_bytes: int = 512 * 1024 * 1024, min_age: float = 3600,
+                 thumbnail_size: int = 768, chunk_size: int = 64 * 1024):
+        self.directory = os.path.abspath(directory)
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.thumbnail_size = thumbnail_size
+        self.chunk_size = chunk_size
+        self._flight = SingleFlight()
+        self._local = threading.local()
+        self._thread_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+        ## the index lives outside the served directory
+        index_directory = os.path.dirname(index_path)
+        if index_directory:
+            os.makedirs(index_directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _exclusive(self):
+        ## installing and evicting files is serialized across threads and processes, so an eviction
+        ## never removes the files of an image that is being stored again under the same key
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.index_path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key_of(name: str) -> str:
+        if name.endswith(THUMBNAIL_SUFFIX):
+            return name[:-len(THUMBNAIL_SUFFIX)]
+        return name.rsplit(".", 1)[0]
+
+    def cached(self, key):
+        row = self._connection().execute(SELECT_IMAGE, (key,)).fetchone()
+        if row is None or not os.path.exists(os.path.join(self.directory, row[0])):
+            return None
+        return row[0], key + THUMBNAIL_SUFFIX
+
+    def save_file(self, client, file_id):
+        ## returns (image name, thumbnail name) relative to the store directory
+        def download(image_file):
+            with client.files.with_streaming_response.content(file_id) as response:
+                for chunk in response.iter_bytes(self.chunk_size):
+                    image_file.write(chunk)
+
+        return self.save(file_id, download)
+
+    def save_url(self, key, get_url, session):
+        ## stores the image get_url() points at under key; get_url is only called when key isn't cached yet
+        def download(image_file):
+            with session.get(get_url(), stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(self.chunk_size):
+                    image_file.write(chunk)
+
+        return self.save(key, download)
+
+    def save(self, key, download):
+        ## download(file) writes the image; concurrent saves of the same key in this process share one download
+        names = self.cached(key)
+        if names is not None:
+            self.touch(names[0], force=True)
+            return names
+        return self._flight.do(key, lambda: self._download(key, download))
+
+    def _download(self, key, download):
+        ## write to a private temp file and rename into place, so other workers never see a partial image
+        temp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        thumbnail_temp_path = temp_path + THUMBNAIL_SUFFIX
+        try:
+            with open(temp_path, "wb") as image_file:
+                download(image_file)
+
+            with Image.open(temp_path) as image:
+                image_name = f"{key}.{IMAGE_EXTENSIONS.get(image.format, 'png')}"
+                thumbnail = image.convert("RGB")
+                thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            thumbnail.save(thumbnail_temp_path, "JPEG", quality=85, optimize=True)
+            size = os.path.getsize(temp_path) + os.path.getsize(thumbnail_temp_path)
+
+            with self._exclusive():
+                os.replace(temp_path, os.path.join(self.directory, image_name))
+                os.replace(thumbnail_temp_path, os.path.join(self.directory, key + THUMBNAIL_SUFFIX))
+                self._connection().execute(UPSERT_IMAGE, (key, image_name, size, time.time()))
+        finally:
+            for path in (temp_path, thumbnail_temp_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self.cleanup()
+        return image_name, key + THUMBNAIL_SUFFIX
+
+    def touch(self, name, force: bool = False):
+        ## lastUsed is the LRU clock
+        now = time.time()
+        self._connection().execute(TOUCH_IMAGE, (now, self.key_of(name), now if force else now - 60))
+
+    def reference(self, user_id, conversation_id, content: str):
+        ## record that a saved message of the conversation links to the images in content
+        keys = image_keys(content)
+        if keys:
+            self._connection().executemany(INSERT_REF, [(user_id, conversation_id, key) for key in keys])
+
+    def release(self, user_id, conversation_id):
+        ## the conversation (or its messages) was deleted; its images can be evicted once nothing else links to them
+        self._connection().execute(DELETE_REFS, (user_id, conversation_id))
+
+    def cleanup(self, batch_size: int = 100):
+        connection = self._connection()
+        total = connection.execute(SELECT_TOTAL_BYTES).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        with self._exclusive():
+            while total > self.max_bytes:
+                candidates = connection.execute(SELECT_EVICTABLE, (time.time() - self.min_age, batch_size)).fetchall()
+                if not candidates:
+                    logging.warning(f"The image store is over {self.max_bytes} bytes, but every image is referenced or recently used")
+                    return
+                for key, image_name, size in candidates:
+                    ## re-checked in the delete, so a conversation that just started linking to the image keeps it
+                    if connection.execute(DELETE_IF_UNREFERENCED, (key, key)).fetchone() is None:
+                        continue
+                    for name in (image_name, key + THUMBNAIL_SUFFIX):
+                        try:
+                            os.remove(os.path.join(self.directory, name))
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logging.error(f"Failed to remove cached image {name}: {e}")
+                    total -= size
+                    if total <= self.max_bytes:
+                        return
@@ -0,0 +1,243 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+import requests
+
+from backend.aoai.deploymentpool import DeploymentUnavailable, parse_retry_after
+
+RETRYABLE_STATUS_CODES = { 408, 429, 500, 502, 503, 504 }
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def retry_signal(error=None, response=None):
+    ## returns (retryable, retry after) for a failed call or a requests response
+    if response is not None:
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            return True, parse_retry_after(response.headers)
+        return False, None
+    if isinstance(error, DeploymentUnavailable):
+        return True, error.retry_after
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code in RETRYABLE_STATUS_CODES:
+            return True, parse_retry_after(error.response.headers)
+        return False, None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return retry_signal(response=error.response)
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout)):
+        return True, None
+    return False, None
+
+
+class CircuitBreaker():
+    """
+    Stops calling a dependency after failure_threshold consecutive failures. After
+    reset_timeout one trial call is let through; its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_neutral(self):
+        ## the call failed for reasons of its own (a bad request, say), which says nothing about the dependency;
+        ## the failure count is left alone, and a half-open circuit lets the next trial through
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trips += 1
+            self._trial_in_flight = False
+
+
+class Dependency():
+    """
+    Calls to one upstream service: retries with jittered exponential backoff that honors
+    Retry-After, a circuit breaker, and optional hedging of idempotent calls once they
+    run past the p95 latency seen so far. Counters are kept for /metrics.
+    """
+
+    def __init__(self, name: str, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8,
+                 breaker: CircuitBreaker = None, hedging: bool = False, hedge_executor: ThreadPoolExecutor = None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.hedging = hedging
+        self.hedge_executor = hedge_executor
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self.counters = { 'calls': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0, 'hedges': 0, 'hedge_wins': 0 }
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def p95(self):
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def delay(self, attempt, retry_after):
+        ## full jitter, but never sooner than the service asked for
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, retry_after or 0)
+
+    def call(self, function, idempotent: bool = False, retry: bool = True):
+        """
+        Call function() under this dependency's policies. A requests response with a
+        retryable status is retried like an error, and returned as is once the
+        attempts run out. Pass retry=False for calls whose request can't be replayed.
+        """
+        self._count('calls')
+        attempts = self.max_attempts if retry else 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                self._count('short_circuited')
+                raise CircuitOpenError(f"{self.name} is unavailable, its circuit breaker is open")
+
+            error = result = None
+            try:
+                result = self._hedged(function) if idempotent and self.hedging else self._timed(function)
+                retryable, retry_after = retry_signal(response=result) if isinstance(result, requests.Response) else (False, None)
+            except Exception as e:
+                error = e
+                retryable, retry_after = retry_signal(error=e)
+
+            if not retryable:
+                if error is not None:
+                    self.breaker.record_neutral()
+                    raise error
+                self.breaker.record_success()
+                return result
+
+            self.breaker.record_failure()
+            self._count('failures')
+            last_attempt = attempt == attempts - 1
+            if last_attempt or (retry_after or 0) > self.max_delay * 4:
+                if error is not None:
+                    raise error
+                return result
+            delay = self.delay(attempt, retry_after)
+            logging.error(f"{self.name} call failed ({error or result.status_code}), retrying in {delay:.2f}s")
+            self._count('retries')
+            time.sleep(delay)
+
+    def _timed(self, function):
+        started = time.monotonic()
+        result = function()
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def _hedged(self, function):
+        ## send a second, identical request when the first is slower than p95, and take whichever finishes first
+        hedge_after = self.p95()
+        if hedge_after is None or self.hedge_executor is None:
+            return self._timed(function)
+        first = self.hedge_executor.submit(self._timed, function)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        self._count('hedges')
+        second = self.hedge_executor.submit(self._timed, function)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        other = second if winner is first else first
+        if winner is second:
+            self._count('hedge_wins')
+        if winner.exception() is not None:
+            ## the other request may still succeed
+            return other.result()
+        self._discard(other)
+        return winner.result()
+
+    @staticmethod
+    def _discard(future):
+        ## the losing attempt: drop it if it hasn't started, otherwise close what it returns so its connection is freed
+        if future.cancel():
+            return
+
+        def close(done):
+            if done.cancelled() or done.exception() is not None:
+                return
+            close_result = getattr(done.result(), "close", None)
+            if callable(close_result):
+                try:
+                    close_result()
+                except Exception as e:
+                    logging.error(f"Failed to close a losing hedged response: {e}")
+
+        future.add_done_callback(close)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.counters, breaker=self.breaker.state, trips=self.breaker.trips)
+
+
+class Resilience():
+    """
+    The Dependency for each upstream service, created on first use with shared settings.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8,
+                 failure_threshold: int = 5, reset_timeout: float = 30, hedging: bool = False, hedge_workers: int = 8):
+        self.settings = dict(max_attempts=max_attempts, base_delay=base_delay, max_delay=max_delay, hedging=hedging)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge") if hedging else None
+        self._dependencies = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            dependency = self._dependencies.get(name)
+            if dependency is None:
+                dependency = self._dependencies[name] = Dependency(
+                    name, breaker=CircuitBreaker(self.failure_threshold, self.reset_timeout),
+                    hedge_executor=self._hedge_executor, **self.settings)
+            return dependency
+
+    def metrics(self):
+        with self._lock:
+            dependencies = dict(self._dependencies)
+        return { name: dependency.metrics() for name, dependency in dependencies.items() }
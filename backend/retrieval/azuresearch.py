@@ -0,0 +1,100 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.retrieval.cache import CachingRetriever, RetrievalCache
+from backend.retrieval.passages import StageTimings, reciprocal_rank_fusion
+
+QUERY_TYPES = ("keyword", "vector", "semantic")
+
+## minimum semantic reranker score (0 to 4) per strictness level, as in the extensions endpoint's 1 to 5 scale
+RERANKER_THRESHOLDS = { 1: 0.0, 2: 0.5, 3: 1.0, 4: 1.5, 5: 2.0 }
+
+
+class AzureSearchRetriever(CachingRetriever):
+    """
+    Queries an Azure AI Search index from the app: keyword, vector and semantic
+    queries run in parallel and their rankings are merged by reciprocal rank fusion.
+    Query types without the fields or configuration they need are skipped.
+    """
+
+    def __init__(self, search_client, content_fields: list, title_field: str = None, url_field: str = None,
+                 filepath_field: str = None, vector_fields: list = None, semantic_configuration: str = None,
+                 embed=None, query_types=QUERY_TYPES, top_k: int = 5, strictness: int = 3,
+                 executor: ThreadPoolExecutor = None, timings: StageTimings = None,
+                 index_name: str = None, cache: RetrievalCache = None):
+        super().__init__(cache)
+        self.search_client = search_client
+        self.index_name = index_name or getattr(search_client, "_index_name", "")
+        self.content_fields = content_fields or []
+        self.title_field = title_field
+        self.url_field = url_field
+        self.filepath_field = filepath_field
+        self.vector_fields = vector_fields or []
+        self.semantic_configuration = semantic_configuration
+        self.embed = embed
+        self.top_k = top_k
+        self.strictness = strictness
+        self.executor = executor or ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+        self.timings = timings or StageTimings()
+
+        self.query_types = [t for t in query_types if t in QUERY_TYPES]
+        if not (self.vector_fields and embed):
+            self.query_types = [t for t in self.query_types if t != "vector"]
+        if not semantic_configuration:
+            self.query_types = [t for t in self.query_types if t != "semantic"]
+        if not self.query_types:
+            raise ValueError("No usable query type is configured for retrieval")
+
+    def to_passage(self, document: dict) -> dict:
+        content = "\n".join(str(document[field]) for field in self.content_fields if document.get(field))
+        return {
+            "id": document.get("id"),
+            "content": content,
+            "title": document.get(self.title_field) if self.title_field else None,
+            "url": document.get(self.url_field) if self.url_field else None,
+            "filepath": document.get(self.filepath_field) if self.filepath_field else None,
+            "chunk_id": document.get("chunk_id"),
+            "reranker_score": document.get("@search.reranker_score")
+        }
+
+    def _timed(self, stage, function):
+        started = time.monotonic()
+        try:
+            return function()
+        finally:
+            self.timings.record(stage, time.monotonic() - started)
+
+    def _search(self, query_type: str, query: str, filter: str, candidates: int) -> list:
+        if query_type == "vector":
+            vector = self._timed("embedding", lambda: self.embed(query))
+            results = self.search_client.search(search_text=None, vector=vector, top_k=candidates,
+                                                vector_fields=",".join(self.vector_fields), filter=filter, top=candidates)
+        elif query_type == "semantic":
+            results = self.search_client.search(search_text=query, query_type="semantic", filter=filter, top=candidates,
+                                                semantic_configuration_name=self.semantic_configuration)
+        else:
+            results = self.search_client.search(search_text=query, filter=filter, top=candidates)
+        return [self.to_passage(document) for document in results]
+
+    def _retrieve(self, query: str, filter: str = None) -> list:
+        started = time.monotonic()
+        candidates = max(self.top_k * 2, 10)
+        futures = { query_type: self.executor.submit(self._timed, query_type, lambda t=query_type: self._search(t, query, filter, candidates))
+                    for query_type in self.query_types }
+
+        ranked_lists = []
+        for query_type, future in futures.items():
+            try:
+                ranked_lists.append(future.result())
+            except Exception as e:
+                ## one failing query type degrades the ranking instead of failing the conversation
+                logging.error(f"{query_type} retrieval failed: {e}")
+        if not ranked_lists:
+            raise Exception("Every retrieval query failed")
+
+        passages = reciprocal_rank_fusion(ranked_lists)
+        threshold = RERANKER_THRESHOLDS.get(self.strictness, 0.0)
+        passages = [p for p in passages if p.get("reranker_score") is None or p["reranker_score"] >= threshold]
+        self.timings.record("retrieval", time.monotonic() - started)
+        return passages[:self.top_k], len(ranked_lists) == len(futures)
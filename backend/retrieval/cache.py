@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from backend.cache import SingleFlight
+
+## the generation row that invalidate() without an index bumps
+ALL_INDEXES = "*"
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS generations (indexName TEXT PRIMARY KEY, generation INTEGER NOT NULL)"
+BUMP_GENERATION = """INSERT INTO generations (indexName, generation) VALUES (?, 1)
+    ON CONFLICT(indexName) DO UPDATE SET generation = generation + 1"""
+SELECT_GENERATIONS = "SELECT indexName, generation FROM generations"
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+class RetrievalCache():
+    """
+    Ranked passages by query signature: the normalized query, the index, the query
+    types, top-k, strictness and a hash of the security filter, so users only ever
+    share results retrieved through the same filter. Entries expire after ttl and the
+    least recently used are evicted to stay under max_bytes of serialized passages.
+
+    invalidate() drops an index's entries once its content changes. Each worker process
+    has its own entries, so invalidations also bump a per-index generation counter in a
+    SQLite file the workers share; entries stored under an older generation are dropped
+    when read, within sync_interval of the invalidation in every worker.
+    """
+
+    def __init__(self, ttl: float = 300, max_bytes: int = 64 * 1024 * 1024, generations_path: str = None,
+                 sync_interval: float = 1.0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.generations_path = generations_path
+        self.sync_interval = sync_interval
+        ## key -> (expires, index, size, passages, generation)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        ## index name (or ALL_INDEXES) -> generation, as last read from the shared file
+        self._generations = {}
+        self._synced_at = float("-inf")
+        self._local = threading.local()
+
+        if generations_path:
+            directory = os.path.dirname(generations_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection().execute(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.generations_path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _generation_of(self, index, sync: bool = False):
+        ## called with the lock held; the shared counters are read at most every sync_interval
+        if self.generations_path and (sync or time.monotonic() - self._synced_at >= self.sync_interval):
+            self._generations = dict(self._connection().execute(SELECT_GENERATIONS).fetchall())
+            self._synced_at = time.monotonic()
+        return self._generations.get(ALL_INDEXES, 0), self._generations.get(index, 0)
+
+    def generation(self, index: str) -> tuple:
+        ## taken before retrieving, so set() can drop results an invalidation overtook
+        with self._lock:
+            return self._generation_of(index)
+
+    @staticmethod
+    def key(query: str, index: str, query_types, top_k: int, strictness: int, filter: str = None) -> tuple:
+        filter_hash = hashlib.sha256(filter.encode("utf-8")).hexdigest() if filter else ""
+        return (normalize_query(query), index, "|".join(sorted(query_types)), top_k, strictness, filter_hash)
+
+    def _remove(self, key):
+        _, _, size, _, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic() or item[4] != self._generation_of(item[1]):
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[3]
+
+    def set(self, key, passages: list, generation: tuple = None):
+        size = len(json.dumps(passages, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            current = self._generation_of(key[1])
+            if generation is not None and generation != current:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + self.ttl, key[1], size, passages, current)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, index: str = None) -> int:
+        ## drop the entries of one index, or of every index; returns how many this process dropped
+        with self._lock:
+            if self.generations_path:
+                self._connection().execute(BUMP_GENERATION, (index or ALL_INDEXES,))
+                self._generation_of(index, sync=True)
+            else:
+                self._generations[index or ALL_INDEXES] = self._generations.get(index or ALL_INDEXES, 0) + 1
+            keys = [key for key, item in self._data.items() if index is None or item[1] == index]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += 1
+            return len(keys)
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations
+            }
+
+
+class CachingRetriever(ABC):
+    """
+    Base class of the retrievers: retrieve() serves rankings from the cache when one is
+    set, and concurrent identical retrievals share one round of queries. Subclasses set
+    index_name, query_types, top_k and strictness, and implement _retrieve(query, filter)
+    returning (passages, complete), where complete is False when a query failed.
+    """
+
+    cache = None
+
+    def __init__(self, cache: RetrievalCache = None):
+        self.cache = cache
+        self._flight = SingleFlight()
+
+    def retrieve(self, query: str, filter: str = None) -> list:
+        """
+        Return the top_k passages for query, visible through filter, best first
+        """
+        if self.cache is None:
+            return self._retrieve(query, filter)[0]
+        key = RetrievalCache.key(query, self.index_name, self.query_types, self.top_k, self.strictness, filter)
+        passages = self.cache.get(key)
+        if passages is None:
+            generation = self.cache.generation(self.index_name)
+            passages, complete = self._flight.do(key, lambda: self._retrieve(query, filter))
+            ## a ranking missing a failed query type isn't worth keeping
+            if complete:
+                self.cache.set(key, passages, generation)
+        return passages
+
+    @abstractmethod
+    def _retrieve(self, query: str, filter: str = None) -> tuple:
+        pass
@@ -0,0 +1,165 @@
+import json
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from backend.retrieval.cache import CachingRetriever, RetrievalCache
+from backend.retrieval.passages import RRF_K, StageTimings, reciprocal_rank_fusion
+
+## minimum kNN similarity per strictness level, as in the extensions endpoint's 1 to 5 scale; BM25 scores
+## are unbounded, so like passages without a reranker score in Azure AI Search, keyword hits aren't thresholded
+KNN_SIMILARITY_THRESHOLDS = { 1: None, 2: 0.2, 3: 0.4, 4: 0.6, 5: 0.75 }
+
+
+class ElasticsearchRetriever(CachingRetriever):
+    """
+    Hybrid retrieval against an Elasticsearch index over a pooled HTTP session: BM25 on
+    the content fields and kNN on the vector fields, merged by reciprocal rank fusion
+    in a single request. With fusion="client" both queries go out in one _msearch and
+    are fused here; with fusion="server" Elasticsearch fuses the rankings itself
+    (rank.rrf, which needs a license that includes it), falling back to client fusion
+    when the cluster rejects it. Query vectors are built by Elasticsearch from
+    embedding_model_id when it is set, and by embed(text) otherwise.
+
+    The filter passed to retrieve() is a JSON-encoded query DSL clause (or list of
+    clauses) that every hit must match, e.g. a terms query on a permitted groups field.
+    """
+
+    def __init__(self, endpoint: str, index_name: str, content_fields: list, api_key: str = None,
+                 title_field: str = None, url_field: str = None, filepath_field: str = None,
+                 vector_fields: list = None, embedding_model_id: str = None, embed=None,
+                 top_k: int = 5, strictness: int = 3, fusion: str = "client", pool_size: int = 16,
+                 timeout=(5, 60), session: requests.Session = None, dependency=None,
+                 timings: StageTimings = None, cache: RetrievalCache = None):
+        super().__init__(cache)
+        if fusion not in ("server", "client"):
+            raise ValueError(f"Unknown fusion: {fusion}")
+        if not content_fields:
+            raise ValueError("Elasticsearch retrieval needs at least one content field")
+        self.endpoint = endpoint.rstrip("/")
+        self.index_name = index_name
+        self.content_fields = content_fields
+        self.title_field = title_field
+        self.url_field = url_field
+        self.filepath_field = filepath_field
+        self.vector_fields = vector_fields or []
+        self.embedding_model_id = embedding_model_id
+        self.embed = embed
+        self.top_k = top_k
+        self.strictness = strictness
+        self.fusion = fusion
+        self.timeout = timeout
+        self.dependency = dependency
+        self.timings = timings or StageTimings()
+        self.query_types = ["bm25"]
+        if self.vector_fields and (embedding_model_id or embed):
+            self.query_types.append("knn")
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.headers = { "Content-Type": "application/json" }
+        if api_key:
+            self.headers["Authorization"] = f"ApiKey {api_key}"
+
+    def source_fields(self):
+        return [f for f in self.content_fields + [self.title_field, self.url_field, self.filepath_field] if f]
+
+    @staticmethod
+    def filter_clauses(filter: str) -> list:
+        if not filter:
+            return []
+        clauses = json.loads(filter)
+        return clauses if isinstance(clauses, list) else [clauses]
+
+    def bm25_query(self, query: str, filters: list = None) -> dict:
+        match = { "multi_match": { "query": query, "fields": self.content_fields } }
+        if not filters:
+            return match
+        return { "bool": { "must": [match], "filter": filters } }
+
+    def knn_clauses(self, query: str, candidates: int, filters: list = None) -> list:
+        if "knn" not in self.query_types:
+            return []
+        if self.embedding_model_id:
+            vector = { "query_vector_builder": { "text_embedding": { "model_id": self.embedding_model_id, "model_text": query } } }
+        else:
+            started = time.monotonic()
+            vector = { "query_vector": self.embed(query) }
+            self.timings.record("embedding", time.monotonic() - started)
+        clause = dict(vector, k=candidates, num_candidates=candidates * 10)
+        ## kNN filters are applied while searching, so the k nearest are k matching hits
+        if filters:
+            clause["filter"] = filters
+        similarity = KNN_SIMILARITY_THRESHOLDS.get(self.strictness)
+        if similarity is not None:
+            clause["similarity"] = similarity
+        return [dict(clause, field=field) for field in self.vector_fields]
+
+    def to_passage(self, hit: dict) -> dict:
+        source = hit.get("_source", {})
+        return {
+            "id": hit.get("_id"),
+            "content": "\n".join(str(source[field]) for field in self.content_fields if source.get(field)),
+            "title": source.get(self.title_field) if self.title_field else None,
+            "url": source.get(self.url_field) if self.url_field else None,
+            "filepath": source.get(self.filepath_field) if self.filepath_field else None,
+            "chunk_id": source.get("chunk_id")
+        }
+
+    def _post(self, path: str, data: str, content_type: str = None):
+        headers = dict(self.headers, **{ "Content-Type": content_type }) if content_type else self.headers
+        post = lambda: self.session.post(f"{self.endpoint}/{path}", data=data.encode("utf-8"), headers=headers, timeout=self.timeout)
+        response = self.dependency.call(post, idempotent=True) if self.dependency else post()
+        response.raise_for_status()
+        return response.json()
+
+    def _server_fused(self, bm25: dict, knn: list, source: list, candidates: int) -> list:
+        body = { "size": self.top_k, "query": bm25, "knn": knn, "_source": source,
+                 "rank": { "rrf": { "window_size": candidates, "rank_constant": RRF_K } } }
+        hits = self._post(f"{self.index_name}/_search", json.dumps(body))["hits"]["hits"]
+        return [self.to_passage(hit) for hit in hits]
+
+    def _client_fused(self, bm25: dict, knn: list, source: list, candidates: int) -> list:
+        searches = [{ "size": candidates, "query": bm25, "_source": source }]
+        searches += [{ "size": candidates, "knn": clause, "_source": source } for clause in knn]
+        ## _msearch takes NDJSON: a header line naming the index before each search body
+        data = "".join(json.dumps({ "index": self.index_name }) + "\n" + json.dumps(search) + "\n" for search in searches)
+        responses = self._post("_msearch", data, "application/x-ndjson")["responses"]
+        failed = [r["error"] for r in responses if "error" in r]
+        if failed:
+            raise Exception(f"Elasticsearch search failed: {failed[0]}")
+        return reciprocal_rank_fusion([[self.to_passage(hit) for hit in r["hits"]["hits"]] for r in responses])[:self.top_k]
+
+    def _retrieve(self, query: str, filter: str = None) -> tuple:
+        started = time.monotonic()
+        candidates = max(self.top_k * 2, 10)
+        filters = self.filter_clauses(filter)
+        bm25 = self.bm25_query(query, filters)
+        knn = self.knn_clauses(query, candidates, filters)
+        source = self.source_fields()
+
+        if not knn:
+            body = { "size": self.top_k, "query": bm25, "_source": source }
+            hits = self._post(f"{self.index_name}/_search", json.dumps(body))["hits"]["hits"]
+            passages = [self.to_passage(hit) for hit in hits]
+        elif self.fusion == "server":
+            try:
+                passages = self._server_fused(bm25, knn, source, candidates)
+            except requests.HTTPError as e:
+                ## rank.rrf is refused by clusters whose license doesn't include it (403) or that predate it (400)
+                if e.response is None or e.response.status_code not in (400, 403):
+                    raise
+                logging.warning(f"Elasticsearch rejected server-side rank fusion, fusing in the app from now on: {e}")
+                self.fusion = "client"
+                passages = self._client_fused(bm25, knn, source, candidates)
+        else:
+            passages = self._client_fused(bm25, knn, source, candidates)
+
+        self.timings.record("retrieval", time.monotonic() - started)
+        return passages, True
@@ -0,0 +1,79 @@
+import hashlib
+import threading
+from collections import deque
+
+## rank offset of reciprocal rank fusion, the value from the original paper
+RRF_K = 60
+
+
+def passage_id(passage: dict) -> str:
+    ## the document key when the index has one, otherwise the content itself identifies the chunk
+    return passage.get("id") or passage.get("chunk_id") or hashlib.sha1((passage.get("content") or "").encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(ranked_lists: list, k: int = RRF_K) -> list:
+    """
+    Merge ranked passage lists into one, scoring each passage by the sum of
+    1 / (k + rank) over the lists it appears in. Fields a list left empty are
+    filled from the others (e.g. the semantic reranker score), and the fused
+    score is stored as "score".
+    """
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, passage in enumerate(ranked, start=1):
+            key = passage_id(passage)
+            entry = fused.get(key)
+            if entry is None:
+                entry = fused[key] = dict(passage, score=0.0)
+            else:
+                for name, value in passage.items():
+                    if entry.get(name) is None and value is not None:
+                        entry[name] = value
+            entry["score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda p: p["score"], reverse=True)
+
+
+def trim_to_budget(passages: list, max_tokens: int, estimator, min_tokens: int = 50) -> list:
+    ## keep passages in rank order until the token budget is spent, cutting the last one short
+    trimmed = []
+    remaining = max_tokens
+    for passage in passages:
+        if remaining < min_tokens:
+            break
+        content = passage.get("content") or ""
+        tokens = estimator.count(content)
+        if tokens > remaining:
+            content = content[:int(len(content) * remaining / tokens)]
+            tokens = remaining
+        trimmed.append(dict(passage, content=content))
+        remaining -= tokens
+    return trimmed
+
+
+class StageTimings():
+    """
+    Latency per stage (embedding, each query type, retrieval, generation) over the
+    last window_size samples, so retrieval and generation can be told apart in /metrics.
+    """
+
+    def __init__(self, window_size: int = 500):
+        self.window_size = window_size
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window_size)).append(seconds)
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    def metrics(self):
+        with self._lock:
+            samples = { stage: sorted(values) for stage, values in self._samples.items() }
+            counts = dict(self._counts)
+        return { stage: {
+            'count': counts[stage],
+            'avg_ms': round(1000 * sum(values) / len(values), 1),
+            'p50_ms': round(1000 * values[len(values) // 2], 1),
+            'p95_ms': round(1000 * values[max(0, int(len(values) * 0.95) - 1)], 1)
+        } for stage, values in samples.items() }
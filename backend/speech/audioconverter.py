@@ -0,0 +1,165 @@
+import io
+import queue
+import struct
+import subprocess
+import threading
+import wave
+
+## the format the speech recognition REST endpoint expects
+SAMPLE_RATE = 16000
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+BYTES_PER_SECOND = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+
+## data size written into the header of a WAV stream whose length isn't known yet
+STREAMING_DATA_SIZE = 0xFFFFFFFF - 36
+
+## how much of ffmpeg's error output is kept for the error message
+STDERR_TAIL_BYTES = 4096
+
+
+class AudioLimitError(ValueError):
+    pass
+
+
+def wav_header(data_size: int) -> bytes:
+    ## canonical 44 byte RIFF/WAVE header for 16 kHz mono PCM16
+    byte_rate = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", 36 + data_size, b"WAVE",
+                       b"fmt ", 16, 1, CHANNELS, SAMPLE_RATE, byte_rate, CHANNELS * SAMPLE_WIDTH, SAMPLE_WIDTH * 8,
+                       b"data", data_size)
+
+
+def wav_duration(data: bytes) -> float:
+    with wave.open(io.BytesIO(data)) as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def is_recognizer_wav(data: bytes) -> bool:
+    ## parses the header only; anything that isn't already 16 kHz mono PCM16 needs transcoding
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return False
+    try:
+        with wave.open(io.BytesIO(data)) as wav:
+            return (wav.getframerate() == SAMPLE_RATE and wav.getnchannels() == CHANNELS
+                    and wav.getsampwidth() == SAMPLE_WIDTH and wav.getcomptype() == "NONE")
+    except (wave.Error, EOFError):
+        return False
+
+
+class AudioConverter():
+    """
+    Converts uploaded recordings to the 16 kHz mono PCM16 WAV the speech endpoint
+    expects, entirely in memory. Recordings already in that format are passed through;
+    everything else is streamed through ffmpeg over pipes, with at most max_processes
+    ffmpeg processes running at once. A process's slot is freed as soon as it exits,
+    before the converted audio has necessarily been sent on.
+    """
+
+    def __init__(self, ffmpeg_path: str = "ffmpeg", max_processes: int = 4, timeout: float = 60):
+        self.ffmpeg_path = ffmpeg_path
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_processes)
+
+    def command(self):
+        return [self.ffmpeg_path, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+                "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"]
+
+    def stream_wav(self, data: bytes, max_duration: float = None, chunk_size: int = BYTES_PER_SECOND):
+        ## yields a WAV stream while ffmpeg is still converting, raising AudioLimitError once it runs past max_duration
+        if is_recognizer_wav(data):
+            if max_duration is not None and wav_duration(data) > max_duration:
+                raise AudioLimitError(f"The recording is longer than {max_duration:g} seconds")
+            yield data
+            return
+
+        ## the slot covers the ffmpeg process only: a conversion thread drains its output into memory
+        ## and frees the slot when it exits, however slowly the caller uploads what was converted
+        chunks = queue.Queue()
+        self._slots.acquire()
+        try:
+            process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except BaseException:
+            self._slots.release()
+            raise
+        threading.Thread(target=self._convert, args=(process, data, max_duration, chunk_size, chunks), daemon=True).start()
+
+        try:
+            yield wav_header(STREAMING_DATA_SIZE)
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            ## the caller stopped reading; don't keep converting for nobody
+            if process.poll() is None:
+                process.kill()
+
+    def _convert(self, process, data, max_duration, chunk_size, chunks):
+        ## puts the converted chunks on the queue, then None when done or the exception that ended the conversion
+        max_bytes = None if max_duration is None else int(max_duration * BYTES_PER_SECOND)
+        ## the watchdog kills ffmpeg at the deadline, which also unblocks a read from a stalled process
+        timed_out = threading.Event()
+        def expire():
+            timed_out.set()
+            process.kill()
+        watchdog = threading.Timer(self.timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        ## feed stdin and drain stderr from other threads so neither pipe can fill up and stall ffmpeg
+        stderr_tail = bytearray()
+        feeder = threading.Thread(target=self._feed, args=(process, data), daemon=True)
+        drainer = threading.Thread(target=self._drain, args=(process.stderr, stderr_tail), daemon=True)
+        feeder.start()
+        drainer.start()
+        try:
+            sent = 0
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                if max_bytes is not None and sent > max_bytes:
+                    raise AudioLimitError(f"The recording is longer than {max_duration:g} seconds")
+                chunks.put(chunk)
+            returncode = process.wait()
+            if timed_out.is_set():
+                raise TimeoutError(f"Audio conversion took longer than {self.timeout:g} seconds")
+            if returncode != 0:
+                drainer.join()
+                raise ValueError(f"Could not decode the audio: {stderr_tail.decode('utf-8', 'replace').strip()}")
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            drainer.join()
+            process.stdout.close()
+            process.stderr.close()
+            self._slots.release()
+
+    @staticmethod
+    def _drain(stream, tail):
+        for block in iter(lambda: stream.read(STDERR_TAIL_BYTES), b""):
+            tail.extend(block)
+            del tail[:-STDERR_TAIL_BYTES]
+
+    @staticmethod
+    def _feed(process, data):
+        try:
+            process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            ## ffmpeg exited early, or was killed after hitting a limit
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
@@ -194,7 +194,8 @@ const Chat = () => {
                                 obj.id = uuid();
                                 obj.date = new Date().toISOString();
                             })
-                            setShowLoadingMessage(false);
+                            // assistant status frames carry no messages yet, keep the loading message up
+                            if (result.choices[0].messages.length) setShowLoadingMessage(false);
                             result.choices[0].messages.forEach((resultObj) => {
                                 processResultMessage(resultObj, userMessage, conversationId);
                             })
@@ -326,7 +327,8 @@ const Chat = () => {
                                 obj.id = uuid();
                                 obj.date = new Date().toISOString();
                             })
-                            setShowLoadingMessage(false);
+                            // assistant status frames carry no messages yet, keep the loading message up
+                            if (result.choices[0].messages.length) setShowLoadingMessage(false);
                             result.choices[0].messages.forEach((resultObj) => {
                                 processResultMessage(resultObj, userMessage, conversationId);
                             })
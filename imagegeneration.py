@@ -1,9 +1,15 @@
+import hashlib
 import os
 import logging
+import time
 import uuid
+import requests
 from openai import AzureOpenAI
 import json
 from flask import jsonify
+from requests.adapters import HTTPAdapter
+
+from backend.images.imagestore import ImageStore
 
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
@@ -12,7 +18,19 @@ if DEBUG_LOGGING:
     logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
-def conversation_internal_with_dalle(client : AzureOpenAI, request_body : any, deployment_model : str) :
+# DALL-E settings
+AZURE_OPENAI_DALLE_SIZE = os.environ.get("AZURE_OPENAI_DALLE_SIZE", "1024x1024")
+
+# pooled session for downloading generated images before their temporary URLs expire
+dalle_download_session = requests.Session()
+dalle_download_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+def generation_key(prompt : str, deployment_model : str, size : str) -> str:
+    # identical prompts for the same deployment and size map to the same cached image
+    digest = hashlib.sha256(json.dumps([prompt, deployment_model, size]).encode("utf-8")).hexdigest()
+    return f"dalle-{digest}"
+
+def conversation_internal_with_dalle(client : AzureOpenAI, request_body : any, deployment_model : str, image_store : ImageStore) :
     # get the user messages and history metadata
     request_messages = request_body["messages"]
     history_metadata = request_body.get("history_metadata", {})
@@ -21,28 +39,34 @@ def conversation_internal_with_dalle(client : AzureOpenAI, request_body : any, d
     latest_message = request_messages[-1]
     content = latest_message["content"]
 
-    # logging.error(f"request_body: {request_body}")    
+    # logging.error(f"request_body: {request_body}")
     logging.error(f"content: {content}")
     logging.error(f"history_metadata: {history_metadata}")
 
-    result = client.images.generate(
-        model="Dalle3", # the name of your DALL-E 3 deployment
-        prompt=content,
-        n=1
-    )
+    def generate():
+        result = client.images.generate(
+            model=deployment_model or "Dalle3", # the name of your DALL-E 3 deployment
+            prompt=content,
+            size=AZURE_OPENAI_DALLE_SIZE,
+            n=1
+        )
+
+        logging.error(f"result: {result}")
 
-    logging.error(f"result: {result}")
+        return json.loads(result.model_dump_json())['data'][0]['url']
 
-    image_url = json.loads(result.model_dump_json())['data'][0]['url']
+    # only generate (and download) when this prompt hasn't been rendered before; concurrent duplicates share one generation
+    image_name, thumbnail_name = image_store.save_url(generation_key(content.strip(), deployment_model, AZURE_OPENAI_DALLE_SIZE),
+                                                      generate, dalle_download_session)
 
     assistantContent = f"Here is an image generated from your prompt:"
 
-    assistantContent += f"<img src=\"{image_url}\" alt=\"Example image\" width=\"100%\" height=\"auto\" display=\"block\" />"
+    assistantContent += f"<a href=\"./images/{image_name}\" target=\"_blank\"><img src=\"./images/{thumbnail_name}\" alt=\"Example image\" width=\"100%\" height=\"auto\" display=\"block\" /></a>"
 
     response_obj = {
         "id": str(uuid.uuid4()),
         "model": "gpt-3.5-turbo",
-        "created": result.created,
+        "created": int(time.time()),
         "choices": [{
             "messages": [{
                 "role": "assistant",
@@ -52,4 +76,4 @@ def conversation_internal_with_dalle(client : AzureOpenAI, request_body : any, d
         "history_metadata": history_metadata
     }
 
-    return jsonify(response_obj), 200
\ No newline at end of file
+    return jsonify(response_obj), 200
@@ -0,0 +1,222 @@
+"""Benchmark the native Elasticsearch retrieval mode (hybrid BM25 + kNN with reciprocal rank fusion).
+
+By default the benchmark starts a local Elasticsearch-compatible stand-in: an in-process HTTP server that
+serves _search (with knn, query_vector_builder and rank.rrf) and _msearch over a synthetic corpus, with an
+optional simulated latency. Pass --endpoint/--index (and --api-key) to run the same queries against a real
+cluster instead.
+
+Compares a pooled session against a new connection per request, and server-side fusion (rank.rrf) against
+client-side fusion (_msearch fused in the app), reporting throughput and p50/p95 latency.
+
+    python scripts/benchmark_elasticsearch.py --queries 500 --concurrency 16 --latency-ms 5
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from backend.retrieval.elasticsearch import ElasticsearchRetriever  # noqa: E402
+from backend.retrieval.passages import reciprocal_rank_fusion  # noqa: E402
+
+VOCABULARY = [f"term{i}" for i in range(2000)]
+DIMENSIONS = 64
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def hash_embedding(text, dimensions=DIMENSIONS):
+    # deterministic bag-of-words embedding, so queries land near documents that share their terms
+    vector = [0.0] * dimensions
+    for token in tokenize(text):
+        seed = int.from_bytes(hashlib.sha1(token.encode("utf-8")).digest()[:8], "little")
+        rng = random.Random(seed)
+        for i in range(dimensions):
+            vector[i] += rng.uniform(-1, 1)
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class StandInIndex:
+    """An in-memory index with BM25 and brute-force cosine kNN, enough to answer the retriever's requests."""
+
+    def __init__(self, documents, k1=1.2, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize(d["content"])) for d in documents]
+        self.lengths = [sum(c.values()) for c in self.term_counts]
+        self.average_length = sum(self.lengths) / len(self.lengths)
+        document_frequency = Counter()
+        for counts in self.term_counts:
+            document_frequency.update(counts.keys())
+        self.idf = {t: math.log(1 + (len(documents) - n + 0.5) / (n + 0.5)) for t, n in document_frequency.items()}
+        self.vectors = [d["contentVector"] for d in documents]
+
+    def bm25(self, query, size):
+        terms = tokenize(query)
+        scores = []
+        for i, counts in enumerate(self.term_counts):
+            score = 0.0
+            for t in terms:
+                tf = counts.get(t, 0)
+                if tf:
+                    score += self.idf[t] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average_length))
+            if score > 0:
+                scores.append((score, i))
+        return sorted(scores, reverse=True)[:size]
+
+    def knn(self, vector, k):
+        scores = [(sum(a * b for a, b in zip(vector, v)), i) for i, v in enumerate(self.vectors)]
+        return sorted(scores, reverse=True)[:k]
+
+    def hit(self, i, score, source_fields):
+        source = {f: self.documents[i][f] for f in source_fields if f in self.documents[i]}
+        return {"_id": self.documents[i]["id"], "_score": score, "_source": source}
+
+    def search(self, body):
+        size = body.get("size", 10)
+        source_fields = body.get("_source") or ["content", "title"]
+        rankings = []
+        if "query" in body:
+            rankings.append(self.bm25(body["query"]["multi_match"]["query"], max(size, body.get("rank", {}).get("rrf", {}).get("window_size", size))))
+        knn = body.get("knn", [])
+        for clause in knn if isinstance(knn, list) else [knn]:
+            if "query_vector_builder" in clause:
+                vector = hash_embedding(clause["query_vector_builder"]["text_embedding"]["model_text"])
+            else:
+                vector = clause["query_vector"]
+            rankings.append(self.knn(vector, clause["k"]))
+
+        if len(rankings) > 1 and "rank" in body:
+            fused = reciprocal_rank_fusion([[{"id": str(i), "i": i} for _, i in ranking] for ranking in rankings],
+                                           k=body["rank"]["rrf"].get("rank_constant", 60))
+            hits = [self.hit(p["i"], p["score"], source_fields) for p in fused[:size]]
+        else:
+            hits = [self.hit(i, score, source_fields) for score, i in rankings[0][:size]] if rankings else []
+        return {"took": 0, "hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+
+def stand_in_handler(index, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+            if latency:
+                time.sleep(latency)
+            if self.path.endswith("/_msearch"):
+                lines = [json.loads(line) for line in data.splitlines() if line.strip()]
+                result = {"responses": [index.search(body) for body in lines[1::2]]}
+            elif self.path.endswith("/_search"):
+                result = index.search(json.loads(data))
+            else:
+                self.send_error(404)
+                return
+            payload = json.dumps(result).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def start_stand_in(documents, latency_ms):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stand_in_handler(StandInIndex(documents), latency_ms / 1000))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def synthetic_corpus(size, rng):
+    documents = []
+    for i in range(size):
+        content = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(40, 120)))
+        documents.append({"id": str(i), "title": f"Document {i}", "content": content, "contentVector": hash_embedding(content)})
+    return documents
+
+
+class UnpooledSession:
+    # opens a new connection for every request, the behaviour before the pooled client
+    def post(self, *args, **kwargs):
+        with requests.Session() as session:
+            return session.post(*args, **kwargs)
+
+
+def run(retriever, queries, concurrency):
+    latencies = []
+
+    def one(query):
+        started = time.perf_counter()
+        retriever.retrieve(query)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, queries))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "queries_per_second": round(len(queries) / elapsed, 1),
+        "p50_ms": round(1000 * statistics.median(latencies), 2),
+        "p95_ms": round(1000 * latencies[max(0, int(len(latencies) * 0.95) - 1)], 2)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", type=str, help="Elasticsearch endpoint; a local stand-in is started when omitted")
+    parser.add_argument("--index", type=str, default="benchmark")
+    parser.add_argument("--api-key", type=str, help="Encoded API key for --endpoint")
+    parser.add_argument("--content-field", type=str, default="content")
+    parser.add_argument("--vector-field", type=str, default="contentVector")
+    parser.add_argument("--embedding-model-id", type=str, help="Let Elasticsearch build the query vectors with this model")
+    parser.add_argument("--documents", type=int, default=2000, help="Size of the stand-in's synthetic corpus")
+    parser.add_argument("--latency-ms", type=float, default=2, help="Latency the stand-in adds to every request")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    server = None
+    endpoint = args.endpoint
+    if not endpoint:
+        print(f"Starting a local Elasticsearch stand-in with {args.documents} documents...")
+        server, endpoint = start_stand_in(synthetic_corpus(args.documents, rng), args.latency_ms)
+    queries = [" ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(2, 6))) for _ in range(args.queries)]
+
+    results = {}
+    for fusion in ("server", "client"):
+        for pooled in (True, False):
+            retriever = ElasticsearchRetriever(
+                endpoint, args.index, [args.content_field], api_key=args.api_key, title_field="title",
+                vector_fields=[args.vector_field], embedding_model_id=args.embedding_model_id, embed=hash_embedding,
+                top_k=args.top_k, fusion=fusion, pool_size=args.concurrency, session=None if pooled else UnpooledSession())
+            name = f"{fusion} fusion, {'pooled' if pooled else 'new connection per request'}"
+            results[name] = run(retriever, queries, args.concurrency)
+            print(f"{name}: {results[name]}")
+
+    if server:
+        server.shutdown()
+    print(json.dumps(results, indent=2))
@@ -13,7 +13,7 @@ from azure.identity import AzureCliCredential
 from azure.search.documents import SearchClient
 from tqdm import tqdm
 
-from data_utils import chunk_directory, chunk_blob_container
+from data_utils import chunk_directory, chunk_blob_container, invalidate_retrieval_cache
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -299,6 +299,9 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
             raise Exception(f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
                             f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
 
+    # cached search results for this index are stale now
+    invalidate_retrieval_cache(index_name)
+
 def validate_index(service_name, subscription_id, resource_group, index_name):
     api_version = "2021-04-30-Preview"
     admin_key = json.loads(
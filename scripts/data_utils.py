@@ -1038,4 +1038,25 @@ class SingletonFormRecognizerClient:
 
     def __setstate__(self, state):
         url, key = state
-        self.instance = DocumentAnalysisClient(endpoint=url, credential=AzureKeyCredential(key))
\ No newline at end of file
+        self.instance = DocumentAnalysisClient(endpoint=url, credential=AzureKeyCredential(key))
+
+
+def invalidate_retrieval_cache(index_name: str):
+    """Tell the web app to drop its cached retrieval results for an index after it is re-indexed.
+
+    Does nothing unless RETRIEVAL_CACHE_INVALIDATION_URL (the app's /retrieval/invalidate URL) and
+    RETRIEVAL_CACHE_INVALIDATION_KEY are set. The worker that receives the call bumps the index's
+    generation in RETRIEVAL_CACHE_GENERATIONS_PATH, so every worker sharing that file drops its cached
+    results within a second. Instances on other hosts, which don't share the file, catch up within
+    RETRIEVAL_CACHE_TTL.
+    """
+    url = os.getenv("RETRIEVAL_CACHE_INVALIDATION_URL")
+    key = os.getenv("RETRIEVAL_CACHE_INVALIDATION_KEY")
+    if not url or not key:
+        return
+    try:
+        response = requests.post(url, headers={"X-Invalidation-Key": key}, json={"index": index_name}, timeout=30)
+        response.raise_for_status()
+        print(f"Invalidated {response.json().get('dropped', 0)} cached retrieval results for index {index_name}")
+    except Exception as e:
+        print(f"Failed to invalidate the retrieval cache for index {index_name}: {e}")
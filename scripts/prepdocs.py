@@ -23,7 +23,7 @@ from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, invalidate_retrieval_cache
 
 
 def create_search_index(index_name, index_client):
@@ -156,6 +156,7 @@ def create_and_populate_index(
     # upload documents to index
     print("Uploading documents to index...")
     upload_documents_to_index(result.chunks, search_client)
+    invalidate_retrieval_cache(index_name)
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -8,6 +8,7 @@ from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
 from data_preparation import create_or_update_search_index, upload_documents_to_index
+from data_utils import invalidate_retrieval_cache
 
 RETRY_COUNT = 5
 
@@ -65,5 +66,6 @@ if __name__ == "__main__":
             documents = [json.loads(line) for line in input_file]
         
         upload_documents_to_index(search_service_name, "", "", index_name, documents, admin_key=search_key)
+        invalidate_retrieval_cache(index_name)
         print("Done.")
 
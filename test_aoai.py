@@ -0,0 +1,131 @@
+import pytest
+
+from backend.aoai.deploymentpool import Deployment, DeploymentPool, DeploymentUnavailable
+from backend.aoai.usageledger import UsageLedger
+
+
+def make_pool(strategy="round_robin"):
+    return DeploymentPool([Deployment("https://east", "gpt", weight=2), Deployment("https://west", "gpt", weight=1)], strategy=strategy)
+
+
+def test_weighted_round_robin_spreads_by_weight():
+    pool = make_pool()
+    picked = [pool.run(lambda d: d.endpoint) for _ in range(6)]
+    assert picked.count("https://east/") == 4
+    assert picked.count("https://west/") == 2
+
+
+def test_throttled_deployment_fails_over_and_cools_down():
+    pool = make_pool()
+    calls = []
+
+    def call(deployment):
+        calls.append(deployment.endpoint)
+        if deployment.endpoint == "https://east/":
+            raise DeploymentUnavailable(429, retry_after=30)
+        return "ok"
+
+    assert pool.run(call) == "ok"
+    assert calls == ["https://east/", "https://west/"]
+    # east sits out its Retry-After, so the next calls go straight to west
+    assert [pool.run(call) for _ in range(3)] == ["ok"] * 3
+    assert calls[2:] == ["https://west/"] * 3
+    assert pool.metrics()[0]["errors"] == 1 and pool.metrics()[0]["cooling_down_seconds"] > 0
+
+
+def test_least_outstanding_and_request_errors():
+    pool = make_pool("least_outstanding")
+    held = [pool.run(lambda d: None, hold=True)[0] for _ in range(3)]
+    # east has twice the weight, so it takes two in-flight requests for west's one
+    assert [d.endpoint for d in held] == ["https://east/", "https://east/", "https://west/"]
+    for deployment in held:
+        pool.release(deployment)
+
+    # errors that aren't about the deployment are raised without failing over
+    with pytest.raises(ValueError):
+        pool.run(lambda d: (_ for _ in ()).throw(ValueError("bad request")))
+    assert all(d.outstanding == 0 for d in pool.deployments)
+
+
+def test_pool_config_is_validated_and_keys_stay_with_their_resource(monkeypatch):
+    import json
+    import time
+
+    with pytest.raises(ValueError):
+        DeploymentPool([Deployment("https://east", "gpt", name="a"), Deployment("https://west", "gpt", name="a")])
+
+    config = json.dumps([{"endpoint": "https://east/", "model": "gpt"}, {"endpoint": "https://west", "model": "gpt"},
+                         {"endpoint": "https://north", "model": "gpt", "key": "north-key"}])
+    pool = DeploymentPool.from_config(config, "https://east", "gpt", key="east-key", cooldown=0.5, max_attempts=4)
+    assert [d.key for d in pool.deployments] == ["east-key", None, "north-key"]
+
+    # a lone deployment is retried once its cool-down is over, without a second retry layer around the pool
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    single = DeploymentPool([Deployment("https://east", "gpt")], cooldown=0.5, max_attempts=2)
+    outcomes = [DeploymentUnavailable(503), "ok"]
+
+    def call(deployment):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert single.run(call) == "ok"
+    assert len(sleeps) == 1 and 0 < sleeps[0] <= 0.5
+
+
+def test_usage_ledger_aggregates_and_replays(tmp_path):
+    path = str(tmp_path / "usage.ndjson")
+    ledger = UsageLedger(path, flush_interval=3600)
+    ledger.record_usage("alice", "east", "chat", {"prompt_tokens": 10, "completion_tokens": 5})
+    ledger.record("alice", "west", "chat", prompt_messages=[{"role": "user", "content": "hello there"}], completion_text="hi")
+    ledger.record_usage("bob", "east", "title", None, completion_text="A title")
+    ledger.flush()
+
+    alice = ledger.usage("alice")
+    assert alice["total"]["requests"] == 2
+    assert alice["total"]["estimated_requests"] == 1
+    assert alice["deployments"]["east"]["prompt_tokens"] == 10
+    assert alice["deployments"]["west"]["completion_tokens"] > 0
+    assert set(ledger.usage()["users"]) == {"alice", "bob"}
+
+    # a restarted ledger picks the totals up from the file
+    assert UsageLedger(path, flush_interval=3600).usage() == ledger.usage()
+
+
+def test_usage_ledger_totals_are_shared_and_the_file_is_compacted(tmp_path):
+    path = str(tmp_path / "usage.ndjson")
+    first = UsageLedger(path, flush_interval=3600, compact_slack=2)
+    second = UsageLedger(path, flush_interval=3600, compact_slack=2)
+
+    # two workers record for the same key; each sees the other's flushed usage
+    for _ in range(3):
+        first.record_usage("alice", "east", "chat", {"prompt_tokens": 10, "completion_tokens": 5})
+        first.flush()
+        second.record_usage("alice", "east", "chat", {"prompt_tokens": 1, "completion_tokens": 1})
+        second.flush()
+    second.record_usage("alice", "east", "chat", {"prompt_tokens": 1, "completion_tokens": 1})
+
+    assert first.usage("alice")["total"]["requests"] == 6
+    assert second.usage("alice")["total"]["requests"] == 7
+    assert first.metrics()["compactions"] + second.metrics()["compactions"] > 0
+    with open(path) as f:
+        assert len(f.readlines()) <= 3
+    assert first.usage("alice")["total"]["prompt_tokens"] == 33
+
+
+def test_usage_ledger_drops_days_past_retention(tmp_path):
+    import json
+    path = str(tmp_path / "usage.ndjson")
+    with open(path, "w") as f:
+        f.write(json.dumps({"day": "2000-01-01", "user_id": "alice", "deployment": "east", "source": "chat",
+                            "requests": 1, "prompt_tokens": 100, "completion_tokens": 100, "estimated_requests": 0}) + "\n")
+    ledger = UsageLedger(path, flush_interval=3600, compact_slack=0, retention_days=30)
+    assert ledger.usage("alice")["total"]["requests"] == 0
+
+    ledger.record_usage("alice", "east", "chat", {"prompt_tokens": 1, "completion_tokens": 1})
+    ledger.flush()
+    assert ledger.usage("alice")["total"]["requests"] == 1
+    with open(path) as f:
+        assert "2000-01-01" not in f.read()
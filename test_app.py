@@ -4,3 +4,45 @@ from app import format_as_ndjson
 def test_format_as_ndjson():
     obj = {"message": "I ❤️ 🐍 \n and escaped newlines"}
     assert format_as_ndjson(obj) == '{"message": "I ❤️ 🐍 \\n and escaped newlines"}\n'
+
+
+def test_app_retrieval_stream_ends_with_an_error_frame(monkeypatch):
+    import json
+    from types import SimpleNamespace as NS
+    import app
+
+    def chunks():
+        yield NS(id="1", model="gpt", created=1, object="chunk", choices=[NS(delta=NS(content="Hello"))])
+        raise ConnectionError("stream reset")
+
+    released = []
+    deployment = NS(name="east")
+    monkeypatch.setattr(app, "SHOULD_STREAM", True)
+    monkeypatch.setattr(app, "search_retriever", NS(retrieve=lambda query, filter: [{"content": "passage", "title": "doc"}]))
+    monkeypatch.setattr(app, "run_on_pool", lambda dependency, call, hold=False: (deployment, chunks()))
+    monkeypatch.setattr(app.aoai_pool, "release", lambda d, error=None: released.append(error))
+
+    response = app.conversation_with_app_retrieval({"messages": [{"role": "user", "content": "hi"}]})
+    frames = [json.loads(line) for line in response.response]
+    assert frames[1]["choices"][0]["messages"][0]["content"] == "Hello"
+    assert frames[-1] == {"error": "stream reset"}
+    assert isinstance(released[0], ConnectionError)
+
+
+def test_failed_history_writes_keep_json_responses_valid():
+    import json
+    from concurrent.futures import Future
+    from flask import Flask, jsonify, Response
+    import app
+
+    failed = Future()
+    failed.set_exception(ConnectionError("cosmos unavailable"))
+
+    with Flask(__name__).app_context():
+        response = app.with_history_write_result(jsonify({"choices": [{"messages": []}]}), failed)
+        assert "cosmos unavailable" in response.get_json()["history_error"]
+        assert response.get_json()["choices"] == [{"messages": []}]
+
+        streamed = app.with_history_write_result(Response(iter([app.format_as_ndjson({"choices": []})])), failed)
+        frames = [json.loads(line) for line in streamed.response]
+        assert "cosmos unavailable" in frames[-1]["error"]
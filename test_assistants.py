@@ -0,0 +1,324 @@
+from backend.assistants.threadregistry import ThreadRegistry
+
+
+def test_thread_registry_keeps_types_apart_and_evicts(tmp_path):
+    registry = ThreadRegistry(str(tmp_path / "threads.db"), ttl=60, max_entries=2)
+    registry.put("user-1", "web", "thread-web")
+    registry.put("user-1", "math", "thread-math")
+    assert registry.get("user-1", "web") == "thread-web"
+    assert registry.get("user-1", "math") == "thread-math"
+
+    # a second worker sees the same entries
+    other_worker = ThreadRegistry(str(tmp_path / "threads.db"), ttl=60, max_entries=2)
+    assert other_worker.get("user-1", "web") == "thread-web"
+
+    # past capacity the least recently used thread is handed to the sweeper
+    registry.put("user-2", "dalle", "thread-dalle")
+    deleted = []
+    assert registry.sweep(lambda assistant_type, thread_id: deleted.append((assistant_type, thread_id))) == 1
+    assert deleted == [("math", "thread-math")]
+    assert registry.get("user-1", "math") is None
+
+    registry.ttl = 0
+    assert sorted(t for _, t in registry.evict()) == ["thread-dalle", "thread-web"]
+
+
+class FakeStreamingFiles:
+    def __init__(self, data):
+        self.data = data
+        self.downloads = 0
+
+    def content(self, file_id):
+        files = self
+
+        class Response:
+            def __enter__(self):
+                files.downloads += 1
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def iter_bytes(self, chunk_size):
+                for i in range(0, len(files.data), chunk_size):
+                    yield files.data[i:i + chunk_size]
+
+        return Response()
+
+
+def test_image_store_caches_by_file_id_and_trims(tmp_path):
+    import io
+    from types import SimpleNamespace
+    from PIL import Image
+    from backend.images.imagestore import ImageStore
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (2000, 1000), "red").save(buffer, "PNG")
+    files = FakeStreamingFiles(buffer.getvalue())
+    client = SimpleNamespace(files=SimpleNamespace(with_streaming_response=files))
+    store = ImageStore(str(tmp_path / "images"), str(tmp_path / "images.db"), min_age=0, thumbnail_size=500, chunk_size=1024)
+
+    assert store.save_file(client, "file-1") == ("file-1.png", "file-1.thumb.jpg")
+    assert store.save_file(client, "file-1") == ("file-1.png", "file-1.thumb.jpg")
+    assert files.downloads == 1
+    with Image.open(tmp_path / "images" / "file-1.thumb.jpg") as thumbnail:
+        assert thumbnail.size == (500, 250)
+
+    store.max_bytes = 0
+    store.cleanup()
+    assert list((tmp_path / "images").iterdir()) == []
+
+
+def test_image_store_keeps_images_saved_conversations_link_to(tmp_path):
+    import io
+    from types import SimpleNamespace
+    from PIL import Image
+    from backend.images.imagestore import ImageStore
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "green").save(buffer, "PNG")
+    client = SimpleNamespace(files=SimpleNamespace(with_streaming_response=FakeStreamingFiles(buffer.getvalue())))
+    store = ImageStore(str(tmp_path / "images"), str(tmp_path / "images.db"), min_age=0)
+    image_name, thumbnail_name = store.save_file(client, "file-1")
+    store.save_file(client, "file-2")
+
+    store.reference("user-1", "conversation-1", f'<a href="./images/{image_name}"><img src="./images/{thumbnail_name}" /></a>')
+    store.max_bytes = 0
+    store.cleanup()
+    assert sorted(p.name for p in (tmp_path / "images").iterdir()) == ["file-1.png", "file-1.thumb.jpg"]
+
+    # once the conversation is deleted the original goes together with its thumbnail
+    store.release("user-1", "conversation-1")
+    store.cleanup()
+    assert list((tmp_path / "images").iterdir()) == []
+
+
+def test_list_run_messages_stops_at_previous_turn():
+    from types import SimpleNamespace
+    import assistants
+
+    def message(id, role, run_id):
+        return SimpleNamespace(id=id, role=role, run_id=run_id)
+
+    # newest first, as listed with order="desc"
+    thread = [message("m5", "assistant", "run-2"), message("m4", "assistant", "run-2"), message("m3", "user", None),
+              message("m2", "assistant", "run-1"), message("m1", "user", None)]
+    listed = []
+
+    def list_messages(thread_id, order, limit):
+        for m in thread:
+            listed.append(m.id)
+            yield m
+
+    client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(messages=SimpleNamespace(list=list_messages))))
+    assert [m.id for m in assistants.list_run_messages(client, "thread", "run-2")] == ["m4", "m5"]
+    assert listed == ["m5", "m4", "m3"]
+
+
+def test_stream_run_sends_status_tool_and_text_frames(monkeypatch):
+    import json
+    from types import SimpleNamespace as NS
+    import assistants
+    from openai.types.beta.threads.message_content_text import MessageContentText
+
+    monkeypatch.setattr(assistants, "ASSISTANT_POLL_INITIAL_WAIT", 0)
+    monkeypatch.setattr(assistants, "ASSISTANT_POLL_MAX_WAIT", 0)
+    run = NS(id="run-1", model="gpt-4", created_at=1, status="queued")
+    statuses = iter(["in_progress", "in_progress", "completed"])
+    tool_step = NS(id="step-1", type="tool_calls", status="completed",
+                   step_details=NS(tool_calls=[NS(type="code_interpreter")]))
+    message_step = NS(id="step-2", type="message_creation", status="completed",
+                      step_details=NS(message_creation=NS(message_id="msg-1")))
+    text = MessageContentText(type="text", text={"value": "4", "annotations": []})
+    threads = NS(
+        runs=NS(retrieve=lambda thread_id, run_id: NS(id=run_id, status=next(statuses)),
+                steps=NS(list=lambda **kwargs: [tool_step, message_step])),
+        messages=NS(retrieve=lambda thread_id, message_id: NS(role="assistant", content=[text])))
+    client = NS(beta=NS(threads=threads))
+
+    frames = [json.loads(line) for line in assistants.stream_run(client, "thread-1", run, {})]
+    assert [f.get("assistant_status") for f in frames] == [
+        {"status": "queued"}, {"status": "in_progress"}, {"status": "tool_calls", "tools": ["code_interpreter"]}, None, {"status": "completed"}]
+    assert frames[3]["choices"][0]["messages"] == [{"role": "assistant", "content": "4"}]
+
+
+def test_assistant_jobs_record_and_stream_frames(tmp_path):
+    import json
+    from backend.assistants.jobs import AssistantJobs
+
+    jobs = AssistantJobs(str(tmp_path / "jobs.db"), max_workers=1, max_pending=1, poll_interval=0.01)
+
+    def frames():
+        yield json.dumps({"choices": [{"messages": []}]}) + "\n"
+        yield json.dumps({"choices": [{"messages": [{"role": "assistant", "content": "done"}]}]}) + "\n"
+
+    job_id = jobs.submit("user-1", frames)
+    assert job_id is not None
+    assert jobs.get(job_id, "user-2") is None
+
+    streamed = [json.loads(frame) for frame in jobs.stream(job_id)]
+    assert streamed[-1]["choices"][0]["messages"][0]["content"] == "done"
+    assert jobs.get(job_id, "user-1")["status"] == "completed"
+    assert jobs.get(job_id, "user-1")["frames"] == 2
+    assert len(list(jobs.stream(job_id, after=1))) == 1
+
+
+def test_jobs_abandoned_by_a_dead_worker_fail_and_expire(tmp_path):
+    import json
+    import time
+    from backend.assistants.jobs import AssistantJobs, INSERT_JOB
+
+    jobs = AssistantJobs(str(tmp_path / "jobs.db"), lease=60, poll_interval=0.01)
+    # a job a recycled worker was running: its heartbeat stopped two minutes ago
+    started = time.time() - 120
+    jobs._connection().execute(INSERT_JOB, ("job-1", "user-1", started, started))
+    jobs._connection().execute("UPDATE jobs SET status = 'running' WHERE id = 'job-1'")
+    jobs._connection().execute("INSERT INTO job_frames (jobId, seq, frame) VALUES ('job-1', 0, ?)", (json.dumps({"choices": []}) + "\n",))
+
+    frames = [json.loads(frame) for frame in jobs.stream("job-1")]
+    assert "abandoned" in frames[-1]["error"] and len(frames) == 2
+    assert jobs.get("job-1", "user-1")["status"] == "failed"
+
+    jobs.ttl = 0
+    time.sleep(0.01)
+    jobs.submit("user-2", lambda: iter([]))
+    assert jobs.get("job-1", "user-1") is None
+
+
+def test_dalle_generations_are_cached_by_prompt(tmp_path, monkeypatch):
+    import io
+    from types import SimpleNamespace as NS
+    from PIL import Image
+    from flask import Flask
+    from backend.images.imagestore import ImageStore
+    import imagegeneration
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "blue").save(buffer, "PNG")
+    generations = []
+
+    class Result:
+        created = 1
+
+        def model_dump_json(self):
+            return '{"data": [{"url": "https://example.invalid/image.png"}]}'
+
+    class Session:
+        def get(self, url, stream, timeout):
+            class Response:
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *args):
+                    pass
+
+                def raise_for_status(self):
+                    pass
+
+                def iter_content(self, chunk_size):
+                    yield buffer.getvalue()
+
+            return Response()
+
+    client = NS(images=NS(generate=lambda **kwargs: generations.append(kwargs) or Result()))
+    monkeypatch.setattr(imagegeneration, "dalle_download_session", Session())
+    store = ImageStore(str(tmp_path / "images"), str(tmp_path / "images.db"))
+
+    with Flask(__name__).app_context():
+        for _ in range(2):
+            response, status = imagegeneration.conversation_internal_with_dalle(client, {"messages": [{"content": "a blue square"}]}, "dalle-3", store)
+    assert status == 200
+    assert len(generations) == 1 and generations[0]["model"] == "dalle-3"
+    assert ".thumb.jpg" in response.json["choices"][0]["messages"][0]["content"]
+
+
+def test_serial_tool_calls_never_overlap_after_a_timeout():
+    import threading
+    import time
+    from types import SimpleNamespace
+    import assistants
+
+    running = []
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def slow(seconds):
+        with lock:
+            if running:
+                overlapped.set()
+            running.append(seconds)
+        time.sleep(seconds)
+        with lock:
+            running.remove(seconds)
+        return "done"
+
+    tools = {
+        "slow": assistants.AssistantTool("slow", slow, concurrent_safe=False, timeout=0.1),
+        "fast": assistants.AssistantTool("fast", lambda: "fast", timeout=1)
+    }
+    call = lambda id, name, arguments: SimpleNamespace(id=id, type="function", function=SimpleNamespace(name=name, arguments=arguments))
+    outputs = assistants.execute_tool_calls([
+        call("1", "slow", '{"seconds": 0.3}'),
+        call("2", "slow", '{"seconds": 0.2}'),
+        call("3", "fast", '{}')
+    ], tools)
+
+    assert "timed out" in outputs[0]["output"]
+    ## the second call waited for the first, which was still running when the wait ran out, so it never started
+    assert "timed out" in outputs[1]["output"]
+    assert outputs[2]["output"] == "fast"
+    time.sleep(0.3)
+    assert not overlapped.is_set()
+    assert not running
+
+
+def test_indexed_assistant_with_a_matching_hash_skips_the_service(tmp_path, monkeypatch):
+    import assistants
+    from backend.assistants.assistantindex import AssistantIndex
+
+    class NoService:
+        def __getattr__(self, name):
+            raise AssertionError(f"unexpected call to {name}")
+
+    monkeypatch.setattr(assistants, "assistant_index", AssistantIndex(str(tmp_path / "assistants.db")))
+    definition = assistants.assistant_definition("math")
+    assistants.assistant_index.put(definition["name"], "asst_1", assistants.definition_hash(definition, "gpt-4"))
+
+    assistant = assistants.retrieve_and_create_assistant(NoService(), "math", "gpt-4")
+    assert assistant.id == "asst_1"
+    assert assistant.instructions == definition["instructions"]
+
+
+def test_concurrent_first_messages_share_one_registered_thread(tmp_path, monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace as NS
+    import assistants
+
+    registry = ThreadRegistry(str(tmp_path / "threads.db"))
+    registry.put("user-1", "math", "thread-old")
+    monkeypatch.setattr(assistants, "thread_registry", registry)
+    created, deleted = [], []
+    both_created = threading.Barrier(2)
+
+    def create():
+        thread_id = f"thread-{threading.get_ident()}"
+        created.append(thread_id)
+        both_created.wait()
+        return NS(id=thread_id)
+
+    client = NS(beta=NS(threads=NS(create=create, delete=deleted.append)))
+    with ThreadPoolExecutor(2) as executor:
+        thread_ids = list(executor.map(lambda _: assistants.start_thread(client, "user-1", "math"), range(2)))
+
+    # both requests end up on the registered thread; the other new one and the old one are deleted
+    assert thread_ids[0] == thread_ids[1] == registry.get("user-1", "math")
+    assert sorted(deleted) == sorted(["thread-old"] + [t for t in created if t != thread_ids[0]])
+
+
+def test_only_one_worker_claims_the_thread_sweeper(tmp_path):
+    first = ThreadRegistry(str(tmp_path / "threads.db"))
+    second = ThreadRegistry(str(tmp_path / "threads.db"))
+    assert first._claim_sweeper()
+    assert not second._claim_sweeper()
+    assert first._claim_sweeper()
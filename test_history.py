@@ -0,0 +1,251 @@
+from backend.history.sqlitedbservice import SqliteConversationClient
+from backend.history.writebehind import WriteBehindHistoryWriter
+
+
+def test_sqlite_history_round_trip(tmp_path):
+    client = SqliteConversationClient(database_path=str(tmp_path / "history.db"))
+    first = client.create_conversation("user-1", title="first")
+    second = client.create_conversation("user-1", title="second")
+    client.create_conversation("user-2", title="someone else")
+
+    client.create_message(first["id"], "user-1", {"role": "user", "content": "hello"})
+    client.create_message(first["id"], "user-1", {"role": "assistant", "content": "hi"})
+
+    ## writing a message moves its conversation to the top of the list
+    assert [c["title"] for c in client.get_conversations("user-1", limit=25)] == ["first", "second"]
+    assert [m["content"] for m in client.get_messages("user-1", first["id"])] == ["hello", "hi"]
+    assert client.get_conversation("user-2", first["id"]) is None
+
+    assert len(client.delete_messages(first["id"], "user-1")) == 2
+    client.delete_conversation("user-1", first["id"])
+    assert [c["id"] for c in client.get_conversations("user-1", limit=None)] == [second["id"]]
+
+
+def test_replayed_message_batches_never_move_updated_at_back(tmp_path):
+    client = SqliteConversationClient(database_path=str(tmp_path / "history.db"))
+    second = client.create_conversation("user-1", title="second")
+    delayed = client.build_message(second["id"], "user-1", {"role": "user", "content": "sent first"})
+    client.create_conversation("user-1", title="first")
+    client.create_message(second["id"], "user-1", {"role": "user", "content": "hello"})
+    updated_at = client.get_conversation("user-1", second["id"])["updatedAt"]
+
+    # a write-behind batch built before the newer message lands after it
+    client.create_messages(second["id"], "user-1", [delayed])
+    assert client.get_conversation("user-1", second["id"])["updatedAt"] == updated_at
+    assert [c["title"] for c in client.get_conversations("user-1", limit=25)] == ["second", "first"]
+
+
+def test_write_behind_replays_unflushed_writes(tmp_path):
+    class FailingClient(SqliteConversationClient):
+        def create_messages(self, conversation_id, user_id, messages):
+            raise Exception("store unavailable")
+
+    database_path = str(tmp_path / "history.db")
+    conversation = SqliteConversationClient(database_path=database_path).create_conversation("user-1")
+
+    writer = WriteBehindHistoryWriter(FailingClient(database_path=database_path), str(tmp_path / "wal"), flush_interval=0.01)
+    writer.submit(conversation["id"], "user-1", {"role": "assistant", "content": "answer"})
+    assert [m["content"] for m in writer.pending_messages("user-1", conversation["id"])] == ["answer"]
+    writer.stop()
+
+    client = SqliteConversationClient(database_path=database_path)
+    writer = WriteBehindHistoryWriter(client, str(tmp_path / "wal"), flush_interval=0.01)
+    assert writer.flush(timeout=5)
+    writer.stop()
+    assert [m["content"] for m in client.get_messages("user-1", conversation["id"])] == ["answer"]
+
+
+def test_citations_are_stored_once_and_rehydrated(tmp_path):
+    import json
+    from backend.history.citationstore import CitationStore
+
+    client = SqliteConversationClient(database_path=str(tmp_path / "history.db"), citation_store=CitationStore())
+    conversation = client.create_conversation("user-1")
+    citation = {"content": "chunk text " * 100, "title": "handbook.pdf", "url": None}
+    tool_content = json.dumps({"citations": [citation], "intent": "[\"benefits\"]"})
+
+    client.create_message(conversation["id"], "user-1", {"role": "tool", "content": tool_content})
+    client.create_message(conversation["id"], "user-1", {"role": "tool", "content": tool_content})
+
+    stored = client._connection().execute("SELECT document FROM messages").fetchall()
+    assert all("chunk text" not in row[0] for row in stored)
+    assert client._connection().execute("SELECT COUNT(*) FROM citations").fetchone()[0] == 1
+
+    ## a fresh store has nothing remembered, so reads go back to the citations table
+    client.citation_store = CitationStore()
+    messages = client.get_messages("user-1", conversation["id"])
+    assert [json.loads(m["content"])["citations"] for m in messages] == [[citation], [citation]]
+
+
+def test_background_event_loop_cancels_stalled_calls():
+    import asyncio
+    import concurrent.futures
+    import pytest
+    from backend.history.cosmosdbservice_async import BackgroundEventLoop
+
+    cancelled = []
+
+    async def stall():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    event_loop = BackgroundEventLoop(timeout=0.05)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        event_loop.run(stall())
+    assert event_loop.run(asyncio.sleep(0, result="ok")) == "ok"
+    assert cancelled == [True]
+
+
+def test_async_history_client_writes_through_the_aio_container():
+    import asyncio
+    from backend.history.cosmosdbservice_async import AsyncCosmosConversationClient, BackgroundEventLoop, LoopContainerClient
+
+    class FakeAioContainer:
+        def __init__(self):
+            self.items = {}
+            self.loops = set()
+
+        async def upsert_item(self, body, **kwargs):
+            self.loops.add(asyncio.get_running_loop())
+            self.items[body['id']] = dict(body, _etag=str(len(self.items)))
+            return self.items[body['id']]
+
+        async def query_items(self, query, parameters=None, **kwargs):
+            self.loops.add(asyncio.get_running_loop())
+            values = {p['name']: p['value'] for p in parameters}
+            for item in list(self.items.values()):
+                if item['userId'] == values['@userId'] and item.get('conversationId', item['id']) == values['@conversationId']:
+                    if ("type='message'" in query) == (item['type'] == 'message'):
+                        yield item
+
+    container = FakeAioContainer()
+    client = AsyncCosmosConversationClient.__new__(AsyncCosmosConversationClient)
+    client.cache = None
+    client.citation_store = None
+    client.event_loop = BackgroundEventLoop()
+    client.aio_container_client = container
+    client.container_client = LoopContainerClient(container, client.event_loop)
+    client._semaphore = asyncio.Semaphore(4)
+
+    conversation = client.create_conversation("user-1", "hello")
+    client.create_messages(conversation['id'], "user-1", [client.build_message(conversation['id'], "user-1", {"role": "user", "content": "hi"})])
+    assert [m['content'] for m in client.get_messages("user-1", conversation['id'])] == ["hi"]
+    assert client.update_title("user-1", conversation['id'], "greeting", if_title="hello")['title'] == "greeting"
+    assert container.loops == {client.event_loop.loop}
+
+
+def test_write_behind_discard_waits_for_an_in_flight_flush(tmp_path):
+    import threading
+
+    started, release = threading.Event(), threading.Event()
+
+    class SlowClient(SqliteConversationClient):
+        def create_messages(self, conversation_id, user_id, messages):
+            started.set()
+            release.wait(5)
+            return super().create_messages(conversation_id, user_id, messages)
+
+    client = SlowClient(database_path=str(tmp_path / "history.db"))
+    conversation = client.create_conversation("user-1")
+    writer = WriteBehindHistoryWriter(client, str(tmp_path / "wal"), flush_interval=0.01)
+    writer.submit(conversation["id"], "user-1", {"role": "assistant", "content": "answer"})
+    assert started.wait(5)
+
+    discard = threading.Thread(target=writer.discard, args=("user-1", conversation["id"]))
+    discard.start()
+    discard.join(0.2)
+    assert discard.is_alive()
+
+    release.set()
+    discard.join(5)
+    assert not discard.is_alive()
+    ## the flush finished before discard returned, so a delete issued now removes everything it wrote
+    assert client.delete_messages(conversation["id"], "user-1")
+    writer.stop()
+
+
+def test_rehydration_survives_eviction_of_the_blob_cache(tmp_path):
+    import json
+    from backend.history.citationstore import CitationStore
+
+    client = SqliteConversationClient(database_path=str(tmp_path / "history.db"), citation_store=CitationStore())
+    conversation = client.create_conversation("user-1")
+    citations = [{"content": f"chunk {i}", "title": f"doc{i}.pdf"} for i in range(3)]
+    client.create_message(conversation["id"], "user-1", {"role": "tool", "content": json.dumps({"citations": citations})})
+
+    ## a store smaller than one message's citations evicts blobs while they are being fetched
+    client.citation_store = CitationStore(maxsize=1)
+    messages = client.get_messages("user-1", conversation["id"])
+    assert json.loads(messages[0]["content"])["citations"] == citations
+
+
+class FakeContainer:
+    ## just enough of a CosmosDB container client for conditional writes
+    def __init__(self):
+        self.items = {}
+        self.version = 0
+        self.before_upsert = None
+
+    def upsert_item(self, body, etag=None, match_condition=None):
+        from azure.cosmos import exceptions
+        if self.before_upsert and body.get('type') == 'conversation':
+            hook, self.before_upsert = self.before_upsert, None
+            hook()
+        current = self.items.get(body['id'])
+        if etag is not None and (current is None or current['_etag'] != etag):
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        self.version += 1
+        self.items[body['id']] = dict(body, _etag=f"etag-{self.version}")
+        return dict(self.items[body['id']])
+
+    def query_items(self, query, parameters, enable_cross_partition_query=None):
+        values = {p['name']: p['value'] for p in parameters}
+        return [dict(item) for item in self.items.values()
+                if item.get('type') == 'conversation' and item['id'] == values.get('@conversationId') and item['userId'] == values['@userId']]
+
+
+def cosmos_client(container, cache=None):
+    from backend.history.cosmosdbservice import CosmosConversationClient
+
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = container
+    client.cache = cache
+    client.citation_store = None
+    return client
+
+
+def test_generated_titles_are_written_on_the_current_version_only():
+    container = FakeContainer()
+    client = cosmos_client(container)
+    conversation = container.upsert_item(dict(client.build_conversation("user-1", "provisional")))
+
+    ## a message write touches the conversation between the title write's read and its upsert
+    def touch():
+        container.upsert_item(dict(container.items[conversation['id']], updatedAt="2030-01-01T00:00:00"))
+    container.before_upsert = touch
+
+    assert client.update_title("user-1", conversation['id'], "Generated", if_title="provisional")
+    assert container.items[conversation['id']]['title'] == "Generated"
+    assert container.items[conversation['id']]['updatedAt'] == "2030-01-01T00:00:00"
+
+    ## renamed by the user in the meantime
+    assert not client.update_title("user-1", conversation['id'], "Other", if_title="provisional")
+    assert container.items[conversation['id']]['title'] == "Generated"
+
+
+def test_message_writes_never_overwrite_a_concurrent_title():
+    container = FakeContainer()
+    client = cosmos_client(container)
+    conversation = client.create_conversation("user-1", "provisional")
+
+    ## the generated title lands after the message write read the conversation
+    container.before_upsert = lambda: client.update_title("user-1", conversation['id'], "Generated", if_title="provisional")
+    message = client.build_message(conversation['id'], "user-1", {"role": "user", "content": "hello"})
+    assert client.create_messages(conversation['id'], "user-1", [message])
+
+    stored = container.items[conversation['id']]
+    assert stored['title'] == "Generated"
+    assert stored['updatedAt'] == message['createdAt']
@@ -0,0 +1,114 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from backend.aoai.deploymentpool import DeploymentUnavailable
+from backend.resilience import CircuitBreaker, CircuitOpenError, Dependency
+
+
+def test_retry_waits_at_least_retry_after(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    dependency = Dependency("aoai", max_attempts=3, base_delay=0.01, max_delay=8)
+    outcomes = [DeploymentUnavailable(429, retry_after=2), "ok"]
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert dependency.call(call) == "ok"
+    assert sleeps and sleeps[0] >= 2
+    assert dependency.metrics()["retries"] == 1
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    dependency = Dependency("graph")
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise KeyError("bad request")
+
+    with pytest.raises(KeyError):
+        dependency.call(call)
+    assert len(calls) == 1
+
+
+def test_breaker_opens_and_lets_a_trial_through_after_reset():
+    dependency = Dependency("bing", max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.05))
+
+    def failing():
+        raise DeploymentUnavailable(503)
+
+    for _ in range(2):
+        with pytest.raises(DeploymentUnavailable):
+            dependency.call(failing)
+    with pytest.raises(CircuitOpenError):
+        dependency.call(lambda: "ok")
+
+    time.sleep(0.06)
+    assert dependency.call(lambda: "ok") == "ok"
+    assert dependency.metrics()["breaker"] == "closed"
+    assert dependency.metrics()["trips"] == 1
+
+
+def test_slow_idempotent_calls_are_hedged():
+    dependency = Dependency("google_search", hedging=True, hedge_executor=ThreadPoolExecutor(max_workers=2))
+    dependency._latencies.extend([0.01] * 20)
+    delays = [0.5, 0.0]
+
+    def call():
+        time.sleep(delays.pop(0))
+        return "ok"
+
+    assert dependency.call(call, idempotent=True) == "ok"
+    assert dependency.metrics()["hedges"] == 1
+    assert dependency.metrics()["hedge_wins"] == 1
+
+
+def test_request_errors_leave_the_breaker_alone():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    dependency = Dependency("aoai", max_attempts=1, breaker=breaker)
+
+    def unavailable():
+        raise DeploymentUnavailable(503)
+
+    def bad_request():
+        raise KeyError("bad request")
+
+    with pytest.raises(DeploymentUnavailable):
+        dependency.call(unavailable)
+    with pytest.raises(KeyError):
+        dependency.call(bad_request)
+    with pytest.raises(DeploymentUnavailable):
+        dependency.call(unavailable)
+    assert dependency.metrics()["breaker"] == "open"
+
+
+def test_losing_hedged_responses_are_closed():
+    import threading
+
+    closed = threading.Event()
+
+    class Response:
+        def __init__(self, name):
+            self.name = name
+
+        def close(self):
+            if self.name == "slow":
+                closed.set()
+
+    dependency = Dependency("google_search", hedging=True, hedge_executor=ThreadPoolExecutor(max_workers=2))
+    dependency._latencies.extend([0.01] * 20)
+    delays = [("slow", 0.3), ("fast", 0.0)]
+
+    def call():
+        name, delay = delays.pop(0)
+        time.sleep(delay)
+        return Response(name)
+
+    assert dependency.call(call, idempotent=True).name == "fast"
+    assert closed.wait(2)
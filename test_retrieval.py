@@ -0,0 +1,176 @@
+import json
+
+from backend.aoai.usageledger import TokenEstimator
+from backend.retrieval.azuresearch import AzureSearchRetriever
+from backend.retrieval.cache import RetrievalCache
+from backend.retrieval.elasticsearch import ElasticsearchRetriever
+from backend.retrieval.passages import reciprocal_rank_fusion, trim_to_budget
+
+
+class FakeSearchClient():
+    def __init__(self):
+        self.calls = []
+
+    def search(self, search_text=None, vector=None, query_type=None, **kwargs):
+        self.calls.append((search_text, vector, query_type, kwargs.get("filter")))
+        if vector is not None:
+            return [{"id": "b", "content": "vector hit"}, {"id": "c", "content": "only vector"}]
+        if query_type == "semantic":
+            return [{"id": "b", "content": "vector hit", "@search.reranker_score": 3.1},
+                    {"id": "a", "content": "keyword hit", "@search.reranker_score": 0.2}]
+        return [{"id": "a", "content": "keyword hit"}, {"id": "b", "content": "vector hit"}]
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([[{"id": "a"}, {"id": "b"}], [{"id": "b"}, {"id": "c"}]])
+    assert [p["id"] for p in fused] == ["b", "a", "c"]
+
+
+def test_trim_to_budget_cuts_the_last_passage():
+    passages = [{"content": "x" * 400}, {"content": "y" * 400}, {"content": "z" * 400}]
+    trimmed = trim_to_budget(passages, 150, TokenEstimator(), min_tokens=10)
+    assert len(trimmed) == 2
+    assert trimmed[0]["content"] == passages[0]["content"]
+    assert len(trimmed[1]["content"]) < 400
+
+
+def test_retriever_fuses_query_types_and_applies_filter_and_strictness():
+    client = FakeSearchClient()
+    retriever = AzureSearchRetriever(client, content_fields=["content"], vector_fields=["contentVector"],
+                                     semantic_configuration="default", embed=lambda text: [0.1, 0.2], top_k=5, strictness=3)
+    passages = retriever.retrieve("what is b", filter="groups/any(g:search.in(g, 'x'))")
+
+    assert len(client.calls) == 3
+    assert all(call[3] == "groups/any(g:search.in(g, 'x'))" for call in client.calls)
+    # "a" falls below the strictness 3 reranker threshold, "b" is ranked by every query type
+    assert [p["id"] for p in passages] == ["b", "c"]
+    assert set(retriever.timings.metrics()) >= {"keyword", "vector", "semantic", "embedding", "retrieval"}
+
+
+def test_retrieval_cache_is_keyed_by_filter_and_invalidated_per_index():
+    client = FakeSearchClient()
+    cache = RetrievalCache(ttl=60)
+    retriever = AzureSearchRetriever(client, content_fields=["content"], index_name="docs", cache=cache)
+
+    first = retriever.retrieve("What is B?", filter="f1")
+    assert retriever.retrieve("  what is b? ", filter="f1") == first
+    assert len(client.calls) == 1
+    # another security filter never sees the first filter's results
+    retriever.retrieve("what is b?", filter="f2")
+    assert len(client.calls) == 2
+
+    assert cache.invalidate("other") == 0
+    assert cache.invalidate("docs") == 2
+    retriever.retrieve("what is b?", filter="f1")
+    assert len(client.calls) == 3
+
+
+def test_retrieval_cache_stays_within_its_byte_budget():
+    cache = RetrievalCache(ttl=60, max_bytes=300)
+    for i in range(5):
+        cache.set(RetrievalCache.key(f"q{i}", "docs", ["keyword"], 5, 3), [{"content": "x" * 100}])
+    assert cache.metrics()["bytes"] <= 300
+    assert cache.get(RetrievalCache.key("q0", "docs", ["keyword"], 5, 3)) is None
+    assert cache.get(RetrievalCache.key("q4", "docs", ["keyword"], 5, 3)) is not None
+
+
+class FakeResponse():
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class FakeElasticsearchSession():
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.requests.append((url, data.decode("utf-8"), headers))
+        hit = lambda i: {"_id": i, "_source": {"content": f"passage {i}"}}
+        if url.endswith("/_msearch"):
+            return FakeResponse({"responses": [{"hits": {"hits": [hit("a"), hit("b")]}}, {"hits": {"hits": [hit("b"), hit("c")]}}]})
+        return FakeResponse({"hits": {"hits": [hit("b"), hit("a")]}})
+
+
+def test_elasticsearch_hybrid_query_is_one_rrf_request():
+    session = FakeElasticsearchSession()
+    retriever = ElasticsearchRetriever("https://es:9200/", "docs", ["content"], api_key="key", vector_fields=["contentVector"],
+                                       embedding_model_id="e5", fusion="server", session=session)
+    passages = retriever.retrieve("what is b")
+
+    assert [p["id"] for p in passages] == ["b", "a"]
+    assert len(session.requests) == 1
+    url, data, headers = session.requests[0]
+    body = json.loads(data)
+    assert url == "https://es:9200/docs/_search"
+    assert headers["Authorization"] == "ApiKey key"
+    assert body["query"]["multi_match"]["fields"] == ["content"]
+    assert body["knn"][0]["query_vector_builder"]["text_embedding"] == {"model_id": "e5", "model_text": "what is b"}
+    assert "rrf" in body["rank"]
+
+
+def test_elasticsearch_client_fusion_uses_one_msearch():
+    session = FakeElasticsearchSession()
+    retriever = ElasticsearchRetriever("https://es:9200", "docs", ["content"], vector_fields=["contentVector"],
+                                       embed=lambda text: [0.1, 0.2], session=session)
+    passages = retriever.retrieve("what is b")
+
+    assert [p["id"] for p in passages] == ["b", "a", "c"]
+    assert len(session.requests) == 1
+    url, data, _ = session.requests[0]
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert url == "https://es:9200/_msearch"
+    assert lines[0] == {"index": "docs"} and lines[3]["knn"]["query_vector"] == [0.1, 0.2]
+
+
+def test_elasticsearch_filters_thresholds_and_falls_back_to_client_fusion():
+    import requests
+
+    class Rejected():
+        status_code = 403
+
+        def raise_for_status(self):
+            raise requests.HTTPError("current license is non-compliant for [Reciprocal Rank Fusion (RRF)]", response=self)
+
+    class UnlicensedSession(FakeElasticsearchSession):
+        def post(self, url, data=None, headers=None, timeout=None):
+            response = super().post(url, data, headers, timeout)
+            return Rejected() if "rank" in json.loads(data.splitlines()[0]) else response
+
+    session = UnlicensedSession()
+    retriever = ElasticsearchRetriever("https://es:9200", "docs", ["content"], vector_fields=["contentVector"],
+                                       embed=lambda text: [0.1, 0.2], strictness=4, fusion="server", session=session)
+    groups = json.dumps({"terms": {"groups": ["g1"]}})
+    passages = retriever.retrieve("what is b", groups)
+
+    assert [p["id"] for p in passages] == ["b", "a", "c"]
+    assert retriever.fusion == "client"
+    assert [url for url, _, _ in session.requests] == ["https://es:9200/docs/_search", "https://es:9200/_msearch"]
+    lines = [json.loads(line) for line in session.requests[1][1].splitlines()]
+    assert lines[1]["query"]["bool"]["filter"] == [{"terms": {"groups": ["g1"]}}]
+    assert lines[3]["knn"]["filter"] == [{"terms": {"groups": ["g1"]}}]
+    assert lines[3]["knn"]["similarity"] == 0.6
+
+
+def test_an_invalidation_reaches_every_worker(tmp_path):
+    path = str(tmp_path / "retrieval_cache.db")
+    key = RetrievalCache.key("q", "docs", ["keyword"], 5, 3)
+    workers = [RetrievalCache(ttl=60, generations_path=path, sync_interval=0) for _ in range(2)]
+    for cache in workers:
+        cache.set(key, [{"content": "old"}], cache.generation("docs"))
+        assert cache.get(key) is not None
+
+    # the ingestion script's request lands on the first worker only
+    workers[0].invalidate("docs")
+    assert workers[1].get(key) is None
+
+    # a retrieval that started before the invalidation isn't stored
+    stale = workers[1].generation("other")
+    workers[0].invalidate()
+    workers[1].set(RetrievalCache.key("q", "other", ["keyword"], 5, 3), [{"content": "old"}], stale)
+    assert workers[1].get(RetrievalCache.key("q", "other", ["keyword"], 5, 3)) is None
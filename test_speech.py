@@ -0,0 +1,79 @@
+import io
+import wave
+
+import pytest
+
+from backend.speech.audioconverter import AudioConverter, AudioLimitError, is_recognizer_wav, wav_header
+
+
+def make_wav(rate, channels, frames=1600):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b"\x00\x01" * channels * frames)
+    return buffer.getvalue()
+
+
+def test_recognizer_wav_takes_the_fast_path():
+    data = make_wav(16000, 1)
+    assert is_recognizer_wav(data)
+    assert not is_recognizer_wav(make_wav(44100, 2))
+    assert not is_recognizer_wav(b"\x1aE\xdf\xa3webm")
+    # no ffmpeg process is started for audio that is already in the right format
+    assert list(AudioConverter(ffmpeg_path="/nonexistent/ffmpeg").stream_wav(data)) == [data]
+    with pytest.raises(AudioLimitError):
+        list(AudioConverter(ffmpeg_path="/nonexistent/ffmpeg").stream_wav(data, max_duration=0.05))
+
+
+def test_wav_header_matches_the_wave_module():
+    assert wav_header(3200) == make_wav(16000, 1)[:44]
+
+
+def test_converted_audio_is_streamed_and_cut_off_at_the_limit(tmp_path):
+    # stands in for ffmpeg: passes the input through as "PCM"
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text("#!/bin/sh\ncat\n")
+    fake_ffmpeg.chmod(0o755)
+    converter = AudioConverter(ffmpeg_path=str(fake_ffmpeg))
+
+    chunks = list(converter.stream_wav(b"\x00" * 40000, chunk_size=16000))
+    assert chunks[0][:4] == b"RIFF"
+    assert sum(len(c) for c in chunks[1:]) == 40000
+
+    with pytest.raises(AudioLimitError):
+        list(converter.stream_wav(b"\x00" * 40000, max_duration=1, chunk_size=16000))
+
+
+def test_the_conversion_slot_is_freed_before_the_upload_finishes(tmp_path):
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text("#!/bin/sh\ncat\n")
+    fake_ffmpeg.chmod(0o755)
+    converter = AudioConverter(ffmpeg_path=str(fake_ffmpeg), max_processes=1)
+
+    # the caller (an upload) reads the first chunk, then stalls
+    stream = converter.stream_wav(b"\x00" * 40000, chunk_size=16000)
+    next(stream)
+    next(stream)
+    assert converter._slots.acquire(timeout=5)
+    converter._slots.release()
+    assert sum(len(c) for c in stream) == 40000 - 16000
+
+
+def test_chatty_or_stalled_ffmpeg_never_hangs_the_conversion(tmp_path):
+    # fills the stderr pipe well past its buffer before writing any output
+    chatty_ffmpeg = tmp_path / "chatty"
+    chatty_ffmpeg.write_text("#!/bin/sh\nhead -c 200000 /dev/zero >&2\ncat\n")
+    chatty_ffmpeg.chmod(0o755)
+    chunks = list(AudioConverter(ffmpeg_path=str(chatty_ffmpeg), timeout=10).stream_wav(b"\x00" * 40000))
+    assert sum(len(c) for c in chunks[1:]) == 40000
+
+    # never writes or exits on its own
+    stalled_ffmpeg = tmp_path / "stalled"
+    stalled_ffmpeg.write_text("#!/bin/sh\nexec sleep 30\n")
+    stalled_ffmpeg.chmod(0o755)
+    converter = AudioConverter(ffmpeg_path=str(stalled_ffmpeg), max_processes=1, timeout=0.5)
+    with pytest.raises(TimeoutError):
+        list(converter.stream_wav(b"\x00" * 40000))
+    assert converter._slots.acquire(timeout=1)